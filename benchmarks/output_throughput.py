@@ -0,0 +1,111 @@
+"""doc
+# output_throughput.py
+
+> Compares the throughput of the output pipeline (`rempy.runtime.output`) to the logger it replaced.
+
+The input mimics a training job: a colored progress bar, which redraws its line via carriage returns, and a log line every 100 updates.
+It is fed in reads of 1 KB like pexpect delivers them.
+
+Usage: `python -m benchmarks.output_throughput [--size MB]` (from the root of the repository)
+
+License: MIT (see main license)
+Authors:
+* Michael Fuerst (Lead)
+"""
+import re
+import time
+import argparse
+from contextlib import redirect_stdout
+
+from rempy.runtime.output import OutputStream
+
+
+def escape_ansi(line):
+    ansi_escape =re.compile(r'(\x9B|\x1B\[)[0-?]*[ -\/]*[@-~]')
+    return ansi_escape.sub('', line)
+
+
+class LegacyLogger(object):
+    """
+    The logger before the output pipeline, kept for comparison.
+    """
+    def __init__(self) -> None:
+        self.output = True
+        self.command = "python train.py"
+
+    def write(self, data):
+        try:
+            data = data.decode("utf-8")
+            data = escape_ansi(data)
+        except:
+            pass
+        if self.output:
+            try:
+                if self.command not in data:
+                    print(data, end="")
+            except Exception as e:
+                print("REMPY EXCEPTION", e)
+
+    def flush(self):
+        pass
+
+
+def generate_output(size):
+    data = []
+    total = 0
+    i = 0
+    while total < size:
+        line = f"\r\x1b[32mepoch 3: {i % 100:3d}%|{'#' * (i % 100 // 4):<25}| loss=0.{i:06d}\x1b[0m".encode("utf-8")
+        if i % 100 == 99:
+            line += f"\r\nepoch 3 step {i}: val_loss=0.{i:06d} ✓\r\n".encode("utf-8")
+        data.append(line)
+        total += len(line)
+        i += 1
+    data = b"".join(data)
+    return [data[i:i + 1024] for i in range(0, len(data), 1024)]
+
+
+class CountingSink(object):
+    """
+    A terminal that is infinitely fast, but counts how much it had to draw.
+    """
+    def __init__(self):
+        self.written = 0
+
+    def write(self, text):
+        self.written += len(text)
+
+    def flush(self):
+        pass
+
+
+def measure(logger, chunks, sink):
+    start = time.perf_counter()
+    with redirect_stdout(sink):
+        for chunk in chunks:
+            logger.write(chunk)
+            logger.flush()
+        if hasattr(logger, "close"):
+            logger.close()
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--size", default=32, type=int, help="Megabytes of output to process. Defaults to 32.")
+    args = parser.parse_args()
+    chunks = generate_output(args.size * 1024 * 1024)
+    size = sum(len(chunk) for chunk in chunks)
+    legacy_sink = CountingSink()
+    legacy = measure(LegacyLogger(), chunks, legacy_sink)
+    pipeline_sink = CountingSink()
+    output = OutputStream(out=pipeline_sink)
+    output.output = True
+    pipeline = measure(output, chunks, pipeline_sink)
+    for name, duration, sink in [("legacy logger", legacy, legacy_sink), ("output pipeline", pipeline, pipeline_sink)]:
+        print(f"{name:<16} {duration:7.3f}s {size / duration / 1024 / 1024:8.1f} MB/s {sink.written / 1024 / 1024:8.1f} MB drawn")
+    print(f"speedup          {legacy / pipeline:7.2f}x")
+
+
+if __name__ == "__main__":
+    main()
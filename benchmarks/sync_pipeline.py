@@ -0,0 +1,177 @@
+"""doc
+# sync_pipeline.py
+
+> Benchmarks every stage of the sync pipeline on synthetic trees and reports the timings as json.
+
+Scenarios:
+* `small_files`: thousands of small source files.
+* `huge_files`: a few files of 64 MB.
+* `deep_nesting`: a few files on every level of a deep folder hierarchy.
+* `ignore_rules`: many `.syncignore` files with rules, which exclude about half of the files.
+
+Stages:
+* `walk`: listing the files with the ignore rules.
+* `hash_cold` and `hash_warm`: `get_files_hash_map` without and with a filled hash index.
+* `diff`: comparing the local hashes to a remote, which has 90% of the files.
+* `pack_zip`: `pack_patch` of all files.
+* `pack_stream`: producing the compressed tar stream of all files.
+* `sync_initial`, `sync_noop` and `sync_modified`: `SyncManager.sync` to an empty remote, again without changes and after modifying 1% of the files.
+
+Syncs use a `LocalConnection` to a folder on this machine, so no network is needed.
+Usage: `python -m benchmarks.sync_pipeline [--scale 1.0] [--repeat 3] [--output results.json]` (from the root of the repository)
+
+License: MIT (see main license)
+Authors:
+* Michael Fuerst (Lead)
+"""
+import io
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import tempfile
+from contextlib import redirect_stdout
+
+from rempy.connection import LocalConnection
+from rempy.sync import patcher
+from rempy.sync.hash_index import get_hash_index
+from rempy.sync.hashing import DEFAULT_ALGORITHM
+from rempy.sync.ignore import IgnoreMatcher
+from rempy.sync.manager import SyncManager
+
+
+SCENARIOS = ["small_files", "huge_files", "deep_nesting", "ignore_rules"]
+# Files older than the racy window of the hash index, so they can be cached.
+OLD_MTIME = time.time() - 3600
+
+
+def _write(path, size, rng):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        # Half text like, half random, so compression has something to do.
+        text = (b"def f(x):\n    return x * 2\n" * (size // 56 + 1))[:size // 2]
+        f.write(text + rng.randbytes(size - len(text)))
+    os.utime(path, (OLD_MTIME, OLD_MTIME))
+
+
+def generate(scenario, root, scale, rng):
+    if scenario == "small_files":
+        for i in range(int(5000 * scale)):
+            _write(os.path.join(root, f"pkg{i % 50}", f"module{i}.py"), rng.randint(512, 8192), rng)
+    elif scenario == "huge_files":
+        for i in range(max(1, int(3 * scale))):
+            _write(os.path.join(root, "data", f"blob{i}.bin"), 64 * 1024 * 1024, rng)
+    elif scenario == "deep_nesting":
+        folder = root
+        for depth in range(int(40 * scale)):
+            folder = os.path.join(folder, f"level{depth}")
+            for i in range(5):
+                _write(os.path.join(folder, f"file{i}.py"), 2048, rng)
+    elif scenario == "ignore_rules":
+        for i in range(int(50 * scale)):
+            folder = os.path.join(root, f"pkg{i}")
+            os.makedirs(folder, exist_ok=True)
+            with open(os.path.join(folder, ".syncignore"), "w") as f:
+                f.write("\n".join(["*.tmp", "/build", "cache/", "**/*.npy", "!keep.npy", "logs/**", "# comment", "data_[0-9].bin"]) + "\n")
+            for j in range(40):
+                name = rng.choice(["module.py", "out.tmp", "keep.npy", "x.npy", "data_1.bin", "README.md"])
+                sub = rng.choice(["", "build", "cache", "logs/a", "src/deep"])
+                _write(os.path.join(folder, sub, f"{j}_{name}"), 1024, rng)
+    else:
+        raise NotImplementedError(f"No scenario '{scenario}' implemented.")
+
+
+def _timed(fn):
+    start = time.perf_counter()
+    result = fn()
+    return time.perf_counter() - start, result
+
+
+def _modify(root, files, fraction, rng):
+    for path in rng.sample(files, max(1, int(len(files) * fraction))):
+        with open(os.path.join(root, path), "ab") as f:
+            f.write(b"# modified\n")
+
+
+def run_scenario(scenario, workdir, scale, repeat, seed):
+    rng = random.Random(seed)
+    root = os.path.join(workdir, "project")
+    remote = os.path.join(workdir, "remote")
+    generate(scenario, root, scale, rng)
+    files = IgnoreMatcher(root).walk()
+    result = {"files": len(files), "bytes": sum(st.st_size for _, st in files), "stages": {}}
+    stages = result["stages"]
+    index = get_hash_index(root, DEFAULT_ALGORITHM)
+
+    def measure(name, fn, setup=None):
+        times = []
+        for _ in range(repeat):
+            if setup is not None:
+                setup()
+            duration, value = _timed(fn)
+            times.append(duration)
+        stages[name] = min(times)
+        return value
+
+    measure("walk", lambda: IgnoreMatcher(root).walk())
+    measure("hash_cold", lambda: patcher.get_files_hash_map(root, []), setup=index.clear)
+    hashes = measure("hash_warm", lambda: patcher.get_files_hash_map(root, []))
+    remote_hashes = {f: h for f, h in hashes.items() if rng.random() < 0.9}
+    diff = getattr(patcher, "__diff")
+    measure("diff", lambda: diff(hashes, remote_hashes))
+
+    def pack():
+        patch_path, _, _ = patcher.pack_patch(root, {})
+        os.remove(patch_path)
+    measure("pack_zip", pack)
+
+    def stream():
+        size = 0
+        for chunk in patcher.iter_patch(root, sorted(hashes), patcher.dump_manifest(hashes)):
+            size += len(chunk)
+        return size
+    result["stream_bytes"] = measure("pack_stream", stream)
+
+    manager = SyncManager("localhost", "", root, remote, "project", delta_threshold=0, connection=LocalConnection())
+    with redirect_stdout(io.StringIO()):
+        measure("sync_initial", manager.sync, setup=lambda: shutil.rmtree(remote, ignore_errors=True))
+        measure("sync_noop", manager.sync)
+        measure("sync_modified", manager.sync, setup=lambda: _modify(root, sorted(hashes), 0.01, rng))
+    index.clear()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--scale", default=1.0, type=float, help="Scales the number and size of the generated files. Defaults to 1.0.")
+    parser.add_argument("--repeat", default=3, type=int, help="How often every stage is measured, the fastest run is reported. Defaults to 3.")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="Comma separated scenarios to run. Defaults to all.")
+    parser.add_argument("--seed", default=42, type=int, help="Seed for generating the trees. Defaults to 42.")
+    parser.add_argument("--output", default=None, help="Write the json results to this file instead of printing them.")
+    args = parser.parse_args()
+    report = {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "scale": args.scale,
+        "repeat": args.repeat,
+        "scenarios": {},
+    }
+    for scenario in args.scenarios.split(","):
+        with tempfile.TemporaryDirectory(prefix="rempy_benchmark_") as workdir:
+            print(f"Running {scenario}...", file=sys.stderr)
+            report["scenarios"][scenario] = run_scenario(scenario, workdir, args.scale, args.repeat, args.seed)
+    data = json.dumps(report, indent=2)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            f.write(data + "\n")
+    else:
+        print(data)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,83 @@
+"""doc
+# config.py
+
+> Reads the host config (`~/.rempy_hosts.json`) and creates the sync managers of the hosts, used by the CLI and the Python API.
+
+```
+hosts = get_hosts("gpus")  # A host, a comma separated list of hosts or a host group.
+manager = create_sync_manager(hosts[0], "foo", ".", None, "rempy", "md5", "", None, False)
+```
+
+License: MIT (see main license)
+Authors:
+* Michael Fuerst (Lead)
+"""
+import os
+import json
+
+from rempy.sync.compression import DEFAULT_COMPRESSION
+from rempy.sync.delta import DELTA_THRESHOLD
+from rempy.sync.manager import SyncManager
+
+
+_HOSTS_CONFIG = {}
+
+
+def get_hosts_config():
+    """
+    The config of $HOME/.rempy_hosts.json, the file is only read again when it changed.
+    """
+    config_path = os.path.join(os.environ["HOME"], ".rempy_hosts.json")
+    try:
+        mtime = os.stat(config_path).st_mtime_ns
+    except FileNotFoundError:
+        return {}
+    if _HOSTS_CONFIG.get("path", None) != config_path or _HOSTS_CONFIG["mtime"] != mtime:
+        with open(config_path, "r") as f:
+            data = f.read()
+        _HOSTS_CONFIG.update(path=config_path, mtime=mtime, config=json.loads(data))
+    return _HOSTS_CONFIG["config"]
+
+
+def get_hosts(host):
+    """
+    Resolve a host, a comma separated list of hosts or a host group from the config (an entry with a list of "hosts") into a list of hosts.
+    """
+    config = get_hosts_config()
+    hosts = []
+    for name in host.split(","):
+        if name in config and "hosts" in config[name]:
+            hosts.extend(config[name]["hosts"])
+        else:
+            hosts.append(name)
+    return hosts
+
+
+def try_file_reading(args):
+    if os.path.exists(args):
+        with open(args, "r") as f:
+            args = f.read().replace("\n", " ")
+    return args
+
+
+def get_sync_settings(host, user, dir, remote_path, package_name, hash, ssh_args, compression, verify, gitignore=False):
+    """
+    Get the arguments of the SyncManager for a host from the command line and the host config.
+    """
+    host_config = get_hosts_config().get(host, {})
+    transport = host_config.get("transport", "stream")
+    delta_threshold = host_config.get("delta_threshold", DELTA_THRESHOLD)
+    python = host_config.get("python", "python3")
+    parallel_streams = host_config.get("parallel_streams", 1)
+    verify = verify or host_config.get("verify", False)
+    lazy_threshold = host_config.get("lazy_threshold", 0)
+    if compression is None:
+        compression = host_config.get("compression", DEFAULT_COMPRESSION)
+    if remote_path is None:
+        remote_path = host_config["remote_path"]
+    ssh_args = try_file_reading(ssh_args)
+    return dict(host=host, user=user, local_workdir=dir, remote_workdir=remote_path, package_name=package_name, hash_algorithm=hash, ssh_args=ssh_args, transport=transport, delta_threshold=delta_threshold, python=python, compression=compression, parallel_streams=parallel_streams, verify=verify, lazy_threshold=lazy_threshold, gitignore=gitignore)
+
+
+def create_sync_manager(host, user, dir, remote_path, package_name, hash, ssh_args, compression, verify, gitignore=False):
+    return SyncManager(**get_sync_settings(host, user, dir, remote_path, package_name, hash, ssh_args, compression, verify, gitignore))
@@ -0,0 +1,140 @@
+"""doc
+# connection.py
+
+> A pool of multiplexed ssh connections, so the ssh handshake is only paid once per host.
+
+All ssh and scp commands built by a `Connection` share an OpenSSH ControlMaster socket in `~/.rempy_cache/ssh`.
+The first command opens the master connection, every later command (also from later invocations of rempy) reuses it.
+The master stays alive for `CONTROL_PERSIST` seconds after the last command finished, or until `close_all` stops the masters of all pooled connections.
+
+```
+conn = get_connection("example.com", "foo")
+conn.run("mkdir -p /home/foo/Testing")
+output = conn.check_output("cat /home/foo/Testing/.md5.json")
+```
+
+License: MIT (see main license)
+Authors:
+* Michael Fuerst (Lead)
+"""
+import os
+import shlex
+import subprocess
+
+from rempy.profiling import phase
+from rempy.remote import abbreviate
+
+
+CONTROL_FOLDER = os.path.join(os.path.expanduser("~"), ".rempy_cache", "ssh")
+CONTROL_PERSIST = 600
+
+
+class Connection(object):
+    def __init__(self, host, user, ssh_args="", control_persist=CONTROL_PERSIST):
+        self.host = host
+        self.user = user
+        self.ssh_args = ssh_args
+        self._control_persist = control_persist
+        os.makedirs(CONTROL_FOLDER, mode=0o700, exist_ok=True)
+
+    @property
+    def target(self):
+        return f"{self.user}@{self.host}"
+
+    @property
+    def options(self):
+        # %C is a hash of the connection parameters, which keeps the socket path short.
+        control_path = os.path.join(CONTROL_FOLDER, "%C")
+        return f"-o ControlMaster=auto -o ControlPath={control_path} -o ControlPersist={self._control_persist}"
+
+    def ssh(self, command=None, extra_args="", multiplex=True):
+        """
+        Build an ssh command line, which runs the command on the remote or opens a shell if command is None.
+
+        Set multiplex to False to open a separate TCP connection, e.g. for parallel transfers.
+        """
+        options = self.options if multiplex else "-o ControlMaster=no -o ControlPath=none"
+        ssh = f"ssh {options} {self.ssh_args} {extra_args} {self.target}"
+        if command is not None:
+            ssh = f"{ssh} {shlex.quote(command)}"
+        return ssh
+
+    def scp(self, src, dst):
+        """
+        Build an scp command line. Prefix remote paths with ':', e.g. conn.scp("patch.zip", ":/tmp/patch.zip").
+        """
+        src = self.target + src if src.startswith(":") else src
+        dst = self.target + dst if dst.startswith(":") else dst
+        return f"scp {self.options} {self.ssh_args} {src} {dst}"
+
+    def run(self, command):
+        cmd = self.ssh(command)
+        print(f"> {abbreviate(cmd)}")
+        with phase("ssh", self.host, commands=1):
+            return os.system(cmd)
+
+    def check_output(self, command):
+        cmd = self.ssh(command)
+        print(f"> {abbreviate(cmd)}")
+        with phase("ssh", self.host, commands=1):
+            result = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE)
+        if result.returncode != 0:
+            return None
+        return result.stdout
+
+    def popen(self, command, multiplex=True, **kwargs):
+        cmd = self.ssh(command, multiplex=multiplex)
+        print(f"> {abbreviate(cmd)}")
+        return subprocess.Popen(cmd, shell=True, **kwargs)
+
+    def forward(self, port, cancel=False):
+        """
+        Forward a local port to the same port on the remote via the master connection.
+        """
+        operation = "cancel" if cancel else "forward"
+        return os.system(f"ssh {self.options} {self.ssh_args} -O {operation} -L {port}:localhost:{port} {self.target}")
+
+    def close(self):
+        # Unlike exit, stop lets commands still running on the master (e.g. a script started by another call) finish.
+        os.system(f"ssh {self.options} {self.ssh_args} -O stop {self.target} 2> /dev/null")
+
+
+class LocalConnection(Connection):
+    def __init__(self):
+        """
+        A stand-in for a connection, which runs all commands on this machine, e.g. to benchmark without a network.
+        """
+        super().__init__("localhost", os.environ.get("USER", ""))
+
+    def ssh(self, command=None, extra_args="", multiplex=True):
+        if command is None:
+            return "bash"
+        return f"bash -c {shlex.quote(command)}"
+
+    def scp(self, src, dst):
+        return f"cp {src.lstrip(':')} {dst.lstrip(':')}"
+
+    def forward(self, port, cancel=False):
+        return 0
+
+    def close(self):
+        pass
+
+
+_CONNECTIONS = {}
+
+
+def get_connection(host, user, ssh_args=""):
+    """
+    Get the connection to a host, creating it on first use.
+    """
+    key = (host, user, ssh_args)
+    if key not in _CONNECTIONS:
+        _CONNECTIONS[key] = Connection(host, user, ssh_args)
+    return _CONNECTIONS[key]
+
+
+def close_all():
+    for conn in _CONNECTIONS.values():
+        conn.close()
+    _CONNECTIONS.clear()
@@ -0,0 +1,242 @@
+"""doc
+# daemon.py
+
+> A background process per project, which keeps the local hashes up to date and the connections to recently used hosts open.
+
+Without the daemon every call of rempy starts cold: it walks and hashes the project and opens the ssh connection again.
+The daemon watches the project (inotify, see `rempy.sync.watcher`), so its hashes are always current, and keeps a session open to every host it synced to, so the master connection does not expire.
+The CLI sends its syncs to the daemon over a Unix socket in `~/.rempy_cache/daemon` and only has to wait for the patch itself.
+If no daemon is running for the project, the CLI syncs on its own like before.
+
+```
+start_daemon("/home/foo/Code/rempy", "blake2b")
+result = request("/home/foo/Code/rempy", "blake2b", {"command": "sync", "managers": [settings], "lazy": False})
+stop_daemon("/home/foo/Code/rempy", "blake2b")
+```
+
+`settings` are the keyword arguments of a `SyncManager` (see `rempy.config.get_sync_settings`).
+The result tells if all hosts are in sync (`in_sync`), the CLI does not start a script otherwise.
+The daemon stops itself after `idle_timeout` seconds without a request and then closes the master connections it kept open.
+
+License: MIT (see main license)
+Authors:
+* Michael Fuerst (Lead)
+"""
+import os
+import sys
+import json
+import time
+import select
+import socket
+import hashlib
+import subprocess
+from contextlib import redirect_stdout
+
+from rempy.connection import close_all
+from rempy.sync.manager import MultiSyncManager, SyncManager
+from rempy.sync.patcher import get_files_hash_map, update_files_hash_map
+from rempy.sync.watcher import create_watcher
+
+
+DAEMON_FOLDER = os.path.join(os.path.expanduser("~"), ".rempy_cache", "daemon")
+IDLE_TIMEOUT = 30 * 60
+# How long the CLI waits for a new daemon to listen.
+START_TIMEOUT = 10
+
+
+def socket_path(folder, algorithm, gitignore=False):
+    key = hashlib.md5(f"{os.path.abspath(folder)}:{algorithm}{':gitignore' if gitignore else ''}".encode("utf-8")).hexdigest()
+    return os.path.join(DAEMON_FOLDER, f"{key}.sock")
+
+
+class _SocketWriter(object):
+    def __init__(self, f):
+        self._f = f
+
+    def write(self, text):
+        # Outputs of the daemon are forwarded as they are printed, so the CLI shows the progress of a sync.
+        self._f.write(json.dumps({"output": text}) + "\n")
+        return len(text)
+
+    def flush(self):
+        self._f.flush()
+
+
+class Daemon(object):
+    def __init__(self, folder, algorithm, gitignore=False, idle_timeout=IDLE_TIMEOUT):
+        """
+        Serve syncs of the folder with the given hash algorithm (and .gitignore files) until there was no request for idle_timeout seconds.
+        """
+        self._folder = os.path.abspath(folder)
+        self._algorithm = algorithm
+        self._gitignore = gitignore
+        self._idle_timeout = idle_timeout
+        self._hashes = None
+        self._watcher = None
+        self._managers = {}
+        self._sessions = {}
+        self._last_request = time.time()
+
+    def serve(self):
+        path = socket_path(self._folder, self._algorithm, self._gitignore)
+        os.makedirs(DAEMON_FOLDER, mode=0o700, exist_ok=True)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Only appear under the final path once listening, clients remove sockets they cannot connect to.
+        server.bind(f"{path}.{os.getpid()}.tmp")
+        server.listen()
+        os.replace(f"{path}.{os.getpid()}.tmp", path)
+        try:
+            # Requests arriving during the first scan wait in the backlog of the socket.
+            self._watcher = create_watcher(self._folder, gitignore=self._gitignore)
+            self._hashes = get_files_hash_map(self._folder, [], algorithm=self._algorithm, gitignore=self._gitignore)
+            print(f"Serving {self._folder} on {path}.", flush=True)
+            self._loop(server)
+        finally:
+            server.close()
+            os.remove(path)
+            for session in self._sessions.values():
+                session.stdin.close()
+            close_all()
+            if self._watcher is not None:
+                self._watcher.close()
+
+    def _loop(self, server):
+        sources = [server] if self._watcher is None else [server, self._watcher]
+        while True:
+            remaining = self._last_request + self._idle_timeout - time.time()
+            if remaining <= 0:
+                print("Stopping after being idle.", flush=True)
+                return
+            readable, _, _ = select.select(sources, [], [], remaining)
+            if self._watcher in readable:
+                self._update()
+            if server in readable:
+                conn, _ = server.accept()
+                with conn, conn.makefile("rw") as f:
+                    if not self._handle(f):
+                        return
+                self._last_request = time.time()
+
+    def _update(self):
+        if self._watcher is None:
+            # Without inotify the whole tree is checked on every request, the hash index still skips unchanged files.
+            self._hashes = get_files_hash_map(self._folder, [], algorithm=self._algorithm, gitignore=self._gitignore)
+            return
+        paths = self._watcher.wait_for_changes(debounce=0, timeout=0)
+        if paths is None:
+            self._hashes = get_files_hash_map(self._folder, [], algorithm=self._algorithm, gitignore=self._gitignore)
+        elif len(paths) > 0:
+            self._hashes, _ = update_files_hash_map(self._folder, self._hashes, paths, algorithm=self._algorithm, gitignore=self._gitignore)
+
+    def _handle(self, f):
+        try:
+            message = json.loads(f.readline())
+        except ValueError:
+            return True
+        result = {}
+        if message["command"] == "sync":
+            with redirect_stdout(_SocketWriter(f)):
+                try:
+                    # Changes written right before the request are already queued by inotify, so they are included.
+                    self._update()
+                    result["in_sync"] = self._sync(message["managers"], message.get("lazy", False))
+                except Exception as e:
+                    # A failed sync must not take down the daemon, the next request tries again.
+                    print(f"ERROR: Syncing in the daemon failed: {e}")
+                    result["in_sync"] = False
+        f.write(json.dumps({"result": result}) + "\n")
+        f.flush()
+        return message["command"] != "stop"
+
+    def _sync(self, settings, lazy):
+        managers = [self._get_manager(s) for s in settings]
+        if len(managers) > 1:
+            manager = MultiSyncManager(managers)
+        else:
+            manager = managers[0]
+        manager.sync(local_hashes=dict(self._hashes), lazy=lazy)
+        for m in managers:
+            self._hold(m.connection)
+        return manager.in_sync
+
+    def _get_manager(self, settings):
+        key = json.dumps(settings, sort_keys=True)
+        if key not in self._managers:
+            self._managers[key] = SyncManager(**settings)
+        return self._managers[key]
+
+    def _hold(self, conn):
+        # A session doing nothing keeps the master connection open, it ends when the daemon closes its stdin.
+        session = self._sessions.get(conn.target, None)
+        if session is None or session.poll() is not None:
+            self._sessions[conn.target] = conn.popen("cat > /dev/null", stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+def _connect(folder, algorithm, gitignore):
+    path = socket_path(folder, algorithm, gitignore)
+    if not os.path.exists(path):
+        return None
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        client.connect(path)
+    except ConnectionRefusedError:
+        # The daemon died without cleaning up.
+        client.close()
+        os.remove(path)
+        return None
+    except OSError:
+        client.close()
+        return None
+    return client
+
+
+def request(folder, algorithm, message, gitignore=False):
+    """
+    Send a request to the daemon of the folder and print its output. Returns the result or None if no daemon is running.
+    """
+    client = _connect(folder, algorithm, gitignore)
+    if client is None:
+        return None
+    with client, client.makefile("rw") as f:
+        f.write(json.dumps(message) + "\n")
+        f.flush()
+        for line in f:
+            reply = json.loads(line)
+            if "result" in reply:
+                return reply["result"]
+            sys.stdout.write(reply["output"])
+    print("WARNING: The daemon stopped while handling the request.")
+    return None
+
+
+def start_daemon(folder, algorithm, gitignore=False, idle_timeout=IDLE_TIMEOUT):
+    """
+    Start a daemon for the folder in the background, unless one is running already.
+    """
+    if request(folder, algorithm, {"command": "ping"}, gitignore) is not None:
+        print("The daemon is running already.")
+        return True
+    os.makedirs(DAEMON_FOLDER, mode=0o700, exist_ok=True)
+    path = socket_path(folder, algorithm, gitignore)
+    log_path = path[:-len(".sock")] + ".log"
+    with open(log_path, "a") as log:
+        subprocess.Popen([sys.executable, "-m", "rempy.daemon", os.path.abspath(folder), algorithm, str(int(gitignore)), str(idle_timeout)], stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+    start = time.time()
+    while time.time() - start < START_TIMEOUT:
+        if os.path.exists(path):
+            print(f"Started the daemon, it stops after {idle_timeout // 60} minutes without a call (log: {log_path}).")
+            return True
+        time.sleep(0.05)
+    print(f"ERROR: The daemon did not start, see {log_path}.")
+    return False
+
+
+def stop_daemon(folder, algorithm, gitignore=False):
+    if request(folder, algorithm, {"command": "stop"}, gitignore) is None:
+        print("No daemon is running for this folder.")
+    else:
+        print("Stopped the daemon.")
+
+
+if __name__ == "__main__":
+    Daemon(sys.argv[1], sys.argv[2], sys.argv[3] == "1", int(sys.argv[4])).serve()
@@ -1,11 +1,21 @@
 import argparse
-import json
 import os
+import sys
 import time as __time
 import datetime as __datetime
 
+from rempy.config import create_sync_manager, get_hosts, get_hosts_config, get_sync_settings, try_file_reading
+from rempy.connection import get_connection
+from rempy.daemon import request, start_daemon, stop_daemon
+from rempy.profiling import Profile, phase
+from rempy.runtime.environment import cached_pre_launch, find_pre_launch_inputs, pre_launch_fingerprint
 from rempy.runtime.remote_cli import remoteExecute
-from rempy.sync.manager import SyncManager
+from rempy.runtime.slurm import SlurmArray, find_allocation, get_allocation, submit_array
+from rempy.sync.compression import DEFAULT_COMPRESSION
+from rempy.sync.hashing import DEFAULT_ALGORITHM, HASH_ALGORITHMS
+from rempy.sync.manager import MultiSyncManager
+from rempy.sync.patcher import get_hashes, is_ignored
+from rempy.sync.pull import PULL_FOLDER, PullManager
 
 
 def get_timestamp() -> str:
@@ -18,14 +28,6 @@ def get_env(name):
     else:
         return None
 
-def get_hosts_config():
-    config_path = os.path.join(os.environ["HOME"], ".rempy_hosts.json")
-    if os.path.exists(config_path):
-        with open(config_path, "r") as f:
-            data = f.read()
-        return json.loads(data)
-    return {}
-
 
 def parse_args():
     USER = get_env("USER")
@@ -40,11 +42,37 @@ def parse_args():
     parser.add_argument("--interface", default="ssh", required=False, help="How to connect to the remote. Currently 'ssh' and 'slurm' are supported. Defaults to 'ssh'.")
     parser.add_argument("--ssh_args", default="", required=False, help="A string containing args to pass to the respective command or a path to a file containing the string. Defaults to an empty string.")
     parser.add_argument("--slurm_args", default="", required=False, help="A string containing args to pass to the respective command or a path to a file containing the string. Defaults to an empty string.")
-    parser.add_argument("--watch", default=0, type=int, required=False, help="When larger than 0 continously syncs files every N seconds. Like sync does not execute any script.")
+    parser.add_argument("--hash", default=DEFAULT_ALGORITHM, choices=HASH_ALGORITHMS, required=False, help="The hash algorithm used to detect changed files. 'blake2b' is faster than the default 'md5', 'xxh3' is even faster but requires the xxhash package. 'git' takes the hashes of unmodified files from the index of git.")
+    parser.add_argument("--gitignore", action="store_true", help="Also skip the files ignored by the .gitignore files, not only by the .syncignore files.")
+    parser.add_argument("--compression", default=None, required=False, help="How patches are compressed as 'codec:level', e.g. 'gzip:1' or 'none' on fast networks. Codecs are gzip, zstd and none. Defaults to the compression of the host config or 'gzip:6'.")
+    parser.add_argument("--verify", action="store_true", help="Let the remote check its files against the manifest before syncing and send files that were modified on the remote again (requires python 3 on the remote).")
+    parser.add_argument("--watch", default=0, type=int, required=False, help="When larger than 0 continously syncs changed files. Like sync does not execute any script. Without inotify support, files are checked every N seconds.")
+    parser.add_argument("--debounce", default=0.2, type=float, required=False, help="In watch mode, wait until no file changed for this many seconds before syncing. Defaults to 0.2.")
     parser.add_argument("--pre_launch", default="", type=str, required=False, help="A command that is executed in the working directory before running your code.")
     parser.add_argument("--package_name", default=None, required=False, help="A custom name for the folder in remote_path where to store the code. (If you do not want a subfolder use '.'!)")
+    parser.add_argument("--cache_pre_launch", action="store_true", help="Skip the pre_launch on the remote, if it already succeeded there with the same command, conda env and input files. Only use it for steps that change the environment (e.g. installing requirements) and not the code folder.")
+    parser.add_argument("--pre_launch_env", action="store_true", help="Run the pre_launch once in a virtualenv on the remote, which is shared by all runs with the same command, conda env and input files, and run the code in it.")
+    parser.add_argument("--pre_launch_inputs", default="", required=False, help="Comma separated files of the project, which are inputs of the pre_launch besides the files named in its command, e.g. 'setup.py,environment.yml'.")
     parser.add_argument("--conda", default=None, required=False, help="Specify a conda environment to use.")
     parser.add_argument("--logfile", default=None, required=False, help="Specify a file where to log all outputs of the main process.")
+    parser.add_argument("--mirror", default=None, required=False, help="Specify a local file where to append all outputs of the main process.")
+    parser.add_argument("--allocate", action="store_true", help="Keep a slurm allocation for the slurm_args and run in it, so later runs do not wait in the queue again.")
+    parser.add_argument("--idle_timeout", default=30, type=int, required=False, help="Minutes after the last run, when an allocation of --allocate is released or the daemon of --daemon stops. Defaults to 30.")
+    parser.add_argument("--release", action="store_true", help="Release the allocation of --allocate for the slurm_args now.")
+    parser.add_argument("--daemon", action="store_true", help="Start a daemon for --dir in the background, which keeps the hashes of the files up to date and the connections to the hosts open. Later calls of rempy sync through it, which saves the scan and the ssh handshake.")
+    parser.add_argument("--stop_daemon", action="store_true", help="Stop the daemon of --daemon for --dir.")
+    parser.add_argument("--array", default=None, required=False, help="A file with one set of arguments per line. Submits a single slurm job array with one task per line instead of running the script once (requires a run_path).")
+    parser.add_argument("--max_parallel", default=0, type=int, required=False, help="How many tasks of a job array may run at the same time. Defaults to no limit.")
+    parser.add_argument("--detach", action="store_true", help="Only submit the job array and do not wait for it to finish.")
+    parser.add_argument("--status", default=None, required=False, help="Show the status of the tasks of a submitted job array given its job id.")
+    parser.add_argument("--tail", default=None, required=False, help="Show the logs of a job array given as 'JOB_ID' (last lines of all tasks) or 'JOB_ID:TASK' (follows the log of the task).")
+    parser.add_argument("--pull", default=None, required=False, help="Pull new and changed files from this folder on the remote (absolute or relative to the remote code folder) instead of running a script. Combine with --watch to follow a running job.")
+    parser.add_argument("--pull_to", default=None, required=False, help="The local folder to pull into. Defaults to the same relative path in .rempy_pulled in --dir (which is never synced) or, for absolute paths, a folder with the same name in there.")
+    parser.add_argument("--include", default="", required=False, help="Comma separated glob patterns of files to pull, e.g. '*.csv,*_log.txt'. Defaults to all files.")
+    parser.add_argument("--exclude", default="", required=False, help="Comma separated glob patterns of files and folders not to pull, e.g. '*.pt,checkpoints'.")
+    parser.add_argument("--max_size", default=None, type=float, required=False, help="Do not pull files larger than this many MB.")
+    parser.add_argument("--profile", action="store_true", help="Print how long every phase of the sync and the run took and how many files and bytes it handled.")
+    parser.add_argument("--profile_output", default=None, required=False, help="Write the profile of --profile as json to this file instead of printing it.")
     parser.add_argument("--args", default="", required=False, type=str, help="Arugments for the script called.")
     parser.add_argument("--run_path", default="", required=False, type=str, help="A folder where to copy the code to before executing it.")
     parser.add_argument("--run_name", default="", required=False, type=str, help="A name for the run that is executed. (Requires rnu_path from config or as argument.)")
@@ -55,6 +83,7 @@ def parse_args():
     if args["m"]:
         args["launcher"] = "python -m"
     args["script"], args["host"], args["remote_path"] = parse_main(args['script@host[:/remote/path]'])
+    args["hosts"] = get_hosts(args["host"])
     if args["package_name"] is None:
         args["package_name"] = os.path.basename(os.path.abspath(args["dir"]))
     del args['script@host[:/remote/path]']
@@ -76,6 +105,10 @@ def parse_main(url):
     script, host = tokens
     tokens = host.split(":")
     host = tokens[0]
+    hosts = get_hosts(host)
+    if len(hosts) == 1:
+        # A group of a single host stands for that host, so its own entry of the config is used.
+        host = hosts[0]
     if len(tokens) > 2:
         print("ERROR: You provided more than one remote path. Make sure you only provide one.")
         print("  Example: main.py@example.com:/home/foo/Code")
@@ -84,7 +117,10 @@ def parse_main(url):
         remote_path = tokens[1]
     else:
         config = get_hosts_config()
-        if host in config and "remote_path" in config[host]:
+        if len(hosts) > 1 and all(h in config and "remote_path" in config[h] for h in hosts):
+            # Every host uses the remote_path of its own config.
+            remote_path = None
+        elif host in config and "remote_path" in config[host]:
             remote_path = config[host]["remote_path"]
         else:
             print("ERROR: No remote path provided and no valid configuration found.")
@@ -96,15 +132,13 @@ def parse_main(url):
     return script, host, remote_path
 
 
-def try_file_reading(args):
-    if os.path.exists(args):
-        with open(args, "r") as f:
-            args = f.read().replace("\n", " ")
-    return args
-
-
-def run_remote(host, user, remote_path, interface, ssh_args, slurm_args, launcher, script, args, debug, pre_launch, package_name, conda, logfile, run_path, run_name, **ignore):
+def get_pre_launch(host, pre_launch, conda, dir=".", hash=DEFAULT_ALGORITHM, cache_pre_launch=False, pre_launch_env=False, pre_launch_inputs=""):
     config = get_hosts_config()
+    if pre_launch != "" and (cache_pre_launch or pre_launch_env):
+        extra = [p for p in pre_launch_inputs.split(",") if p != ""]
+        hashes = get_hashes(dir, find_pre_launch_inputs(dir, pre_launch, extra), algorithm=hash)
+        fingerprint = pre_launch_fingerprint(pre_launch, conda, hashes, pre_launch_env)
+        pre_launch = cached_pre_launch(pre_launch, fingerprint, pre_launch_env, config.get(host, {}).get("python", "python3"))
     if conda is not None:
         if host in config and "conda_init" in config[host]:
             conda_init = config[host]["conda_init"]
@@ -116,6 +150,14 @@ def run_remote(host, user, remote_path, interface, ssh_args, slurm_args, launche
         if pre_launch != "":
             pre_launch = f"&& {pre_launch}"
         pre_launch = f"{conda_init} && conda activate {conda}{pre_launch}"
+    return pre_launch
+
+
+def get_run_path(host, run_path, run_name):
+    """
+    Get the folder for a run (and its timestamp) from the run_path and run_name or an empty string if there is no run_path.
+    """
+    config = get_hosts_config()
     if run_path == "" and host in config and "run_path" in config[host]:
         run_path = config[host]["run_path"]
     if run_name != "" and run_path == "":
@@ -123,14 +165,21 @@ def run_remote(host, user, remote_path, interface, ssh_args, slurm_args, launche
         print("  When setting a run_name, the run_path must also be set.")
         print("  You can set the run_path in the config or as a command line argument.")
         print("  Example Config: {'example.com': {'run_path': '/foo/bar/MyRuns'")
-        os.exit(0)
+        os._exit(0)
+    timestamp = get_timestamp()
     if run_path != "":
-        timestamp = get_timestamp()
         if run_name != "":
             run_name = "_" + run_name
         run_name = timestamp + run_name
         run_path = os.path.join(run_path, run_name)
+    return run_path, timestamp
+
 
+def run_remote(host, user, dir, remote_path, interface, ssh_args, slurm_args, launcher, script, args, debug, pre_launch, package_name, conda, logfile, run_path, run_name, mirror, allocate, idle_timeout, hash, cache_pre_launch, pre_launch_env, pre_launch_inputs, **ignore):
+    config = get_hosts_config()
+    pre_launch = get_pre_launch(host, pre_launch, conda, dir, hash, cache_pre_launch, pre_launch_env, pre_launch_inputs)
+    run_path, timestamp = get_run_path(host, run_path, run_name)
+    if run_path != "":
         if logfile is not None:
             logfile = "_" + logfile
         else:
@@ -139,19 +188,169 @@ def run_remote(host, user, remote_path, interface, ssh_args, slurm_args, launche
     ssh_args = try_file_reading(ssh_args)
     slurm_args = try_file_reading(slurm_args)
     remote_path = os.path.join(remote_path, package_name)
-    remoteExecute(host, user, remote_path, script, args, launcher, debug, interface, ssh_args, slurm_args, pre_launch, logfile, run_path)
+    snapshot = config.get(host, {}).get("snapshot", "link")
+    python = config.get(host, {}).get("python", "python3")
+    allocation = None
+    if interface == "slurm" and (allocate or config.get(host, {}).get("allocate", False)):
+        with phase("allocation", host):
+            allocation = get_allocation(get_connection(host, user, ssh_args), slurm_args, idle_timeout * 60)
+        if allocation is None:
+            print("Running without an allocation instead.")
+    remoteExecute(host, user, remote_path, script, args, launcher, debug, interface, ssh_args, slurm_args, pre_launch, logfile, run_path, snapshot, python, mirror, allocation)
+    if allocation is not None:
+        allocation.used()
+
+
+def release_allocation(host, user, ssh_args, slurm_args, **ignore):
+    ssh_args = try_file_reading(ssh_args)
+    slurm_args = try_file_reading(slurm_args)
+    allocation = find_allocation(get_connection(host, user, ssh_args), slurm_args)
+    if allocation is None:
+        print("No allocation for these slurm_args found.")
+    else:
+        allocation.release()
+
+
+def run_array(host, user, dir, remote_path, ssh_args, slurm_args, launcher, script, array, max_parallel, detach, pre_launch, package_name, conda, run_path, run_name, hash, cache_pre_launch, pre_launch_env, pre_launch_inputs, **ignore):
+    config = get_hosts_config()
+    pre_launch = get_pre_launch(host, pre_launch, conda, dir, hash, cache_pre_launch, pre_launch_env, pre_launch_inputs)
+    run_path, _ = get_run_path(host, run_path, run_name)
+    if run_path == "":
+        print("ERROR: No run_path in host configuration found.")
+        print("  A job array needs a run_path for the code and the logs of its tasks.")
+        print("  Example Config: {'example.com': {'run_path': '/foo/bar/MyRuns'")
+        os._exit(0)
+    with open(array, "r") as f:
+        arg_sets = [line.strip() for line in f.read().split("\n") if line.strip() != ""]
+    ssh_args = try_file_reading(ssh_args)
+    slurm_args = try_file_reading(slurm_args)
+    remote_path = os.path.join(remote_path, package_name)
+    snapshot = config.get(host, {}).get("snapshot", "link")
+    python = config.get(host, {}).get("python", "python3")
+    job_array = submit_array(get_connection(host, user, ssh_args), remote_path, run_path, script, arg_sets, launcher, slurm_args, pre_launch, max_parallel, snapshot, python)
+    if job_array is not None and not detach:
+        print(f"Waiting for the job array, check it later with '--status {job_array.job_id}' if you stop waiting.")
+        try:
+            job_array.wait()
+            show_array_status(job_array)
+        except KeyboardInterrupt:
+            print()
+
+
+def show_array_status(job_array):
+    states = job_array.status()
+    for task, state in states.items():
+        print(f"{task:>5} {state:<14} {job_array.arg_sets[task]}")
+    print(f"Logs are in {job_array.run_dir}/logs.")
+
+
+def follow_array(status, tail, **ignore):
+    job_id, _, task = (status if status is not None else tail).partition(":")
+    job_array = SlurmArray.load(job_id)
+    if job_array is None:
+        print(f"ERROR: No job array {job_id} was submitted from this machine.")
+        os._exit(0)
+    if status is not None:
+        show_array_status(job_array)
+    else:
+        job_array.tail(int(task) if task != "" else None)
+
+
+def get_pull_manager(host, user, dir, remote_path, package_name, pull, pull_to, include, exclude, max_size, hash, ssh_args, compression):
+    host_config = get_hosts_config().get(host, {})
+    remote_dir = pull if os.path.isabs(pull) else os.path.join(remote_path, package_name, pull)
+    if pull_to is None:
+        pull_to = os.path.join(dir, PULL_FOLDER, pull if not os.path.isabs(pull) else os.path.basename(pull.rstrip("/")))
+    relative = os.path.relpath(os.path.abspath(pull_to), os.path.abspath(dir))
+    if not relative.startswith("..") and not is_ignored(dir, relative.replace(os.sep, "/"), [], is_dir=True):
+        print(f"WARNING: {pull_to} is synced to the remote, list it in a .syncignore to not push the pulled files back.")
+    include = [p for p in include.split(",") if p != ""]
+    exclude = [p for p in exclude.split(",") if p != ""]
+    if max_size is not None:
+        max_size = int(max_size * 1024 * 1024)
+    python = host_config.get("python", "python3")
+    if compression is None:
+        compression = host_config.get("compression", DEFAULT_COMPRESSION)
+    ssh_args = try_file_reading(ssh_args)
+    return PullManager(host, user, remote_dir, pull_to, hash_algorithm=hash, ssh_args=ssh_args, include=include, exclude=exclude, max_size=max_size, python=python, compression=compression)
+
+
+def pull_remote(host, user, dir, remote_path, package_name, pull, pull_to, include, exclude, max_size, watch, hash, ssh_args, compression, **ignore):
+    puller = get_pull_manager(host, user, dir, remote_path, package_name, pull, pull_to, include, exclude, max_size, hash, ssh_args, compression)
+    if watch > 0:
+        try:
+            puller.watch(watch)
+        except KeyboardInterrupt:
+            print()
+    else:
+        puller.pull()
 
 
-def sync_remote(host, user, dir, remote_path, watch, package_name, **ignore):
-    sync = SyncManager(host, user, dir, remote_path, package_name)
+def sync_remote(host, hosts, user, dir, remote_path, watch, debounce, package_name, hash, ssh_args, compression, verify, sync, gitignore, **ignore):
+    if watch <= 0:
+        settings = [get_sync_settings(h, user, os.path.abspath(dir), remote_path, package_name, hash, ssh_args, compression, verify, gitignore) for h in hosts]
+        with phase("daemon"):
+            # Large files can be held back when only syncing, a run needs all of them.
+            result = request(dir, hash, {"command": "sync", "managers": settings, "lazy": sync}, gitignore)
+            if result is not None:
+                return result["in_sync"]
+    if len(hosts) > 1:
+        manager = MultiSyncManager([create_sync_manager(h, user, dir, remote_path, package_name, hash, ssh_args, compression, verify, gitignore) for h in hosts])
+    else:
+        manager = create_sync_manager(hosts[0], user, dir, remote_path, package_name, hash, ssh_args, compression, verify, gitignore)
     if watch > 0:
-        sync.watch(watch)
+        manager.watch(watch, debounce)
     else:
-        sync.sync()
+        manager.sync(lazy=sync)
+    return manager.in_sync
 
 
 def main():
     args = parse_args()
-    sync_remote(**args)
-    if not args["sync"] and args["watch"] <= 0:
+    if not args["profile"] and args["profile_output"] is None:
+        run(args)
+        return
+    with Profile() as profile:
+        try:
+            run(args)
+        finally:
+            if args["profile_output"] is not None:
+                profile.save(args["profile_output"])
+                print(f"Wrote the profile to {args['profile_output']}.")
+            else:
+                profile.print_report()
+
+
+def run(args):
+    if args["daemon"]:
+        start_daemon(args["dir"], args["hash"], args["gitignore"], args["idle_timeout"] * 60)
+        return
+    if args["stop_daemon"]:
+        stop_daemon(args["dir"], args["hash"], args["gitignore"])
+        return
+    if args["status"] is not None or args["tail"] is not None:
+        follow_array(**args)
+        return
+    if args["release"]:
+        release_allocation(**args)
+        return
+    if args["pull"] is not None:
+        if len(args["hosts"]) > 1:
+            print("ERROR: Files can only be pulled from a single host.")
+            os._exit(0)
+        pull_remote(**args)
+        return
+    if len(args["hosts"]) > 1 and not args["sync"] and args["watch"] <= 0:
+        print("ERROR: Scripts can only be run on a single host. Use --sync or --watch to mirror to several hosts.")
+        os._exit(0)
+    in_sync = sync_remote(**args)
+    if args["sync"] or args["watch"] > 0:
+        return
+    if not in_sync:
+        # The script would run against stale code.
+        print("ERROR: Syncing the code failed, not starting the script.")
+        sys.exit(1)
+    if args["array"] is not None:
+        run_array(**args)
+    else:
         run_remote(**args)
@@ -0,0 +1,172 @@
+"""doc
+# profiling.py
+
+> Measures the time, files and bytes of every phase of a sync or a run, so it is clear where the time goes.
+
+Every phase reports itself to the registered hooks once it ended.
+A `Profile` is such a hook, which collects the phases and reports a breakdown per phase and host.
+
+```
+with Profile() as profile:
+    SyncManager("example.com", "foo", ".", "/home/foo/Code", "rempy").sync()
+profile.print_report()
+profile.save("profile.json")
+```
+
+Any callable taking a `Phase` can be a hook, e.g. `add_hook(lambda phase: print(phase.name, phase.duration))`.
+Hooks are called from the thread that ran the phase, so they must be thread safe.
+
+Phases:
+* `sync`: a complete sync of a host.
+* `scan`: walking and hashing the local files (`files`, `hashed` and `cached` in the hash index).
+* `manifest`: fetching the manifest of the remote (`bytes`).
+* `verify`: checking the remote against its manifest (`drifted` files).
+* `diff`: comparing the local to the remote hashes (`changed` and `deleted` files).
+* `deltas`: fetching signatures and computing block deltas (`files` and delta `bytes`).
+* `pack`: writing a zip patch (`files`, `raw_bytes` and `compressed_bytes`).
+* `transfer`: packing and streaming a tar patch, which is applied while it arrives (`files`, `raw_bytes` and `transferred_bytes`).
+* `upload`: copying a zip patch (`transferred_bytes`).
+* `apply`: applying an uploaded patch on the remote.
+* `ssh`: every remote command rempy waits for, including the handshake if no master connection is open (`commands`).
+* `allocation`: getting a slurm allocation.
+* `connect`, `queue` and `run`: opening the shell for a run, waiting for slurm to start it and running it (`output_bytes`).
+
+Phases nest (e.g. `ssh` within `manifest` within `sync`), so the times of all phases do not add up to the total.
+
+License: MIT (see main license)
+Authors:
+* Michael Fuerst (Lead)
+"""
+import sys
+import json
+import time
+import threading
+from contextlib import contextmanager
+
+
+_HOOKS = []
+
+
+class Phase(object):
+    def __init__(self, name, host=None, **counters):
+        self.name = name
+        self.host = host
+        self.counters = counters
+        self.start = time.time()
+        self.duration = None
+        self._lock = threading.Lock()
+
+    def add(self, counter, value=1):
+        # Shards of a patch are counted from several threads.
+        with self._lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    def to_dict(self):
+        return {"name": self.name, "host": self.host, "start": self.start, "duration": self.duration, "counters": dict(self.counters)}
+
+
+def add_hook(hook):
+    """
+    Call hook with every Phase once it ended.
+    """
+    _HOOKS.append(hook)
+
+
+def remove_hook(hook):
+    if hook in _HOOKS:
+        _HOOKS.remove(hook)
+
+
+@contextmanager
+def phase(name, host=None, **counters):
+    """
+    Measure the code within the with block as a phase, counters can be added to the yielded Phase.
+    """
+    current = Phase(name, host, **counters)
+    start = time.perf_counter()
+    try:
+        yield current
+    finally:
+        current.duration = time.perf_counter() - start
+        for hook in list(_HOOKS):
+            hook(current)
+
+
+def count_bytes(chunks, current, counter):
+    """
+    Pass the chunks through and add their size to a counter of the phase.
+    """
+    for chunk in chunks:
+        current.add(counter, len(chunk))
+        yield chunk
+
+
+def format_counter(counter, value):
+    if counter.endswith("bytes"):
+        for unit in ["B", "KB", "MB", "GB"]:
+            if value < 1024 or unit == "GB":
+                return f"{counter}={value:.1f}{unit}" if unit != "B" else f"{counter}={value}B"
+            value /= 1024
+    return f"{counter}={value}"
+
+
+class Profile(object):
+    def __init__(self):
+        """
+        Collect all phases while it is registered as hook (with add_hook or by using it as context manager).
+        """
+        self.phases = []
+        self._start = time.perf_counter()
+        self._end = None
+        self._lock = threading.Lock()
+
+    def __call__(self, phase):
+        with self._lock:
+            self.phases.append(phase)
+
+    def __enter__(self):
+        add_hook(self)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        remove_hook(self)
+        self._end = time.perf_counter()
+
+    @property
+    def total(self):
+        end = self._end if self._end is not None else time.perf_counter()
+        return end - self._start
+
+    def summary(self):
+        """
+        Sum up the phases per name and host in the order they first ended.
+        """
+        rows = {}
+        with self._lock:
+            phases = list(self.phases)
+        for p in phases:
+            row = rows.setdefault((p.name, p.host), {"name": p.name, "host": p.host, "count": 0, "seconds": 0.0, "counters": {}})
+            row["count"] += 1
+            row["seconds"] += p.duration
+            for counter, value in p.counters.items():
+                row["counters"][counter] = row["counters"].get(counter, 0) + value
+        return list(rows.values())
+
+    def to_json(self):
+        with self._lock:
+            phases = [p.to_dict() for p in self.phases]
+        return json.dumps({"total": self.total, "summary": self.summary(), "phases": phases}, indent=2)
+
+    def save(self, path):
+        with open(path, "w") as f:
+            f.write(self.to_json() + "\n")
+
+    def print_report(self, out=None):
+        out = out if out is not None else sys.stdout
+        out.write(f"Profile (total {self.total:.2f}s, phases nest so their times do not add up):\n")
+        out.write(f"{'Phase':<12} {'Host':<24} {'Count':>5} {'Time':>9}  Counters\n")
+        for row in self.summary():
+            counters = " ".join(format_counter(c, v) for c, v in row["counters"].items())
+            host = row["host"] if row["host"] is not None else "local"
+            out.write(f"{row['name']:<12} {host:<24} {row['count']:>5} {row['seconds']:>8.2f}s  {counters}\n")
+        out.flush()
@@ -0,0 +1,48 @@
+"""doc
+# remote
+
+> Small python scripts, which rempy runs on the remote.
+
+The scripts only use the standard library and are sent inline with the command.
+So nothing has to be installed on the remote except for a python 3.
+Helpers shared by the scripts (and the local side) are in `common.py`, its source is sent in place of the line importing it.
+```
+command = remote_python("verify", ["/home/foo/Testing/rempy"], python="python3")
+output = conn.check_output(command)
+```
+
+License: MIT (see main license)
+Authors:
+* Michael Fuerst (Lead)
+"""
+import os
+import re
+import zlib
+import shlex
+import base64
+
+
+COMMON_IMPORT = re.compile(rb"^from rempy\.remote\.common import .*$", re.MULTILINE)
+
+
+def _read_script(script):
+    with open(os.path.join(os.path.dirname(__file__), script + ".py"), "rb") as f:
+        return f.read()
+
+
+def remote_python(script, args=[], python="python3"):
+    """
+    Build a shell command, which runs one of the scripts in this folder on the remote.
+    """
+    # rempy is not installed on the remote, so the shared helpers are inlined.
+    source = COMMON_IMPORT.sub(lambda _: _read_script("common"), _read_script(script), count=1)
+    code = base64.b64encode(zlib.compress(source, 9)).decode("ascii")
+    args = " ".join(shlex.quote(str(arg)) for arg in args)
+    return f"{python} -c \"import base64,zlib;exec(zlib.decompress(base64.b64decode('{code}')))\" {args}"
+
+
+def abbreviate(command):
+    """
+    Shorten the inline code of remote scripts in a command for printing.
+    """
+    return re.sub(r"b64decode\([^)]{32,}\)", "b64decode(...)", command)
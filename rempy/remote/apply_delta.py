@@ -0,0 +1,79 @@
+"""doc
+# apply_delta.py
+
+> Runs on the remote: rebuilds files from the deltas in `.rempy_delta` after a patch was extracted into a staging folder.
+
+Usage: `python3 apply_delta.py TARGET_FOLDER STAGING_FOLDER`
+
+Every file in `STAGING_FOLDER/.rempy_delta` holds a json header line followed by the literal data.
+The header contains a list of operations, `["c", first_block, count]` copies blocks of the old file (in the target) and `["l", length]` takes the next bytes of literal data.
+The rebuilt files are written to the staging folder, which `commit_staging.py` then moves into place with the rest of the patch.
+Copied blocks and the result are verified, so a remote that drifted from its manifest never ends up with a broken file.
+
+License: MIT (see main license)
+Authors:
+* Michael Fuerst (Lead)
+"""
+import os
+import sys
+import json
+import shutil
+import hashlib
+
+
+DELTA_FOLDER = ".rempy_delta"
+
+
+def block_hash(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def _rebuild(delta_path, target_path, tmp_path):
+    result_hash = hashlib.blake2b(digest_size=16)
+    with open(delta_path, "rb") as delta, open(target_path, "rb") as old, open(tmp_path, "wb") as new:
+        header = json.loads(delta.readline().decode("utf-8"))
+        block_size = header["block_size"]
+        for op in header["ops"]:
+            if op[0] == "c":
+                old.seek(op[1] * block_size)
+                for i in range(op[1], op[1] + op[2]):
+                    block = old.read(block_size)
+                    if block_hash(block) != header["blocks"][str(i)]:
+                        raise ValueError(f"Block {i} of {target_path} does not match the signature.")
+                    result_hash.update(block)
+                    new.write(block)
+            else:
+                remaining = op[1]
+                while remaining > 0:
+                    data = delta.read(min(remaining, 1024 * 1024))
+                    if not data:
+                        raise ValueError(f"Delta for {target_path} is truncated.")
+                    remaining -= len(data)
+                    result_hash.update(data)
+                    new.write(data)
+    if result_hash.hexdigest() != header["hash"]:
+        raise ValueError(f"Rebuilt {target_path} does not match the local file.")
+
+
+def apply_delta(delta_path, target_path, staged_path):
+    os.makedirs(os.path.dirname(staged_path), exist_ok=True)
+    _rebuild(delta_path, target_path, staged_path)
+    shutil.copymode(target_path, staged_path)
+
+
+def main(target, staging):
+    delta_folder = os.path.join(staging, DELTA_FOLDER)
+    try:
+        for path, _, files in os.walk(delta_folder):
+            for name in files:
+                relative = os.path.relpath(os.path.join(path, name), delta_folder)
+                apply_delta(os.path.join(path, name), os.path.join(target, relative), os.path.join(staging, relative))
+    except (OSError, ValueError) as e:
+        print(f"REMPY DELTA ERROR: {e}")
+        sys.exit(1)
+    finally:
+        shutil.rmtree(delta_folder, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1], sys.argv[2])
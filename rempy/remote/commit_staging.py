@@ -0,0 +1,117 @@
+"""doc
+# commit_staging.py
+
+> Runs on the remote: applies a patch that was extracted into a staging folder to the target folder and removes the staging folder.
+
+Usage: `python3 commit_staging.py STAGING_FOLDER TARGET_FOLDER`
+
+Every patch ends with a `.rempy_patch.json` with the files to delete and the folders, which are empty afterwards.
+Without it the patch did not arrive completely (tar accepts an archive that ends early between two files), so nothing is applied and the staging folder is removed.
+These are removed first, then all other files are moved into place and the manifest (`.md5.json`) is moved last, so it never describes files that are not in place yet.
+A manifest can leave out the folders which did not change (see `rempy.sync.merkle`), these are taken from the old manifest.
+If the old manifest does not have them, the remote changed since the patch was computed.
+Then nothing is applied and the script fails, so rempy fetches the manifest again and computes a new patch.
+Staging and target must be on the same filesystem, so files are renamed and not copied.
+Nothing is transferred anymore at this point, so a connection that drops while committing does not interrupt it.
+
+License: MIT (see main license)
+Authors:
+* Michael Fuerst (Lead)
+"""
+import os
+import sys
+import json
+import shutil
+import signal
+
+from rempy.remote.common import MANIFEST, load_tree
+
+
+PATCH_INFO = ".rempy_patch.json"
+
+
+def remove(path):
+    try:
+        if os.path.isdir(path) and not os.path.islink(path):
+            shutil.rmtree(path)
+        else:
+            os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def fill_tree(node, old):
+    for name, child in node.get("d", {}).items():
+        old_child = old.get("d", {}).get(name, None) if old is not None else None
+        if isinstance(child, str):
+            if old_child is None or old_child["h"] != child:
+                return False
+            node["d"][name] = old_child
+        elif not fill_tree(child, old_child):
+            return False
+    return True
+
+
+def merge_manifest(path, old_path):
+    """
+    Fill the unchanged folders of the manifest at path in from the old manifest, returns False if they do not match.
+    """
+    with open(path, "r") as f:
+        manifest = json.loads(f.read())
+    if not manifest.pop("partial", False):
+        return True
+    try:
+        old, _, _ = load_tree(old_path)
+    except (OSError, ValueError):
+        return False
+    if not fill_tree(manifest["tree"], old):
+        return False
+    with open(path, "w") as f:
+        f.write(json.dumps(manifest, separators=(",", ":")))
+    return True
+
+
+def main(staging, target):
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    info_path = os.path.join(staging, PATCH_INFO)
+    if not os.path.exists(info_path):
+        print("ERROR: The patch did not arrive completely, the patch is not applied.")
+        shutil.rmtree(staging, ignore_errors=True)
+        sys.exit(1)
+    manifest = os.path.join(staging, MANIFEST)
+    if os.path.exists(manifest) and not merge_manifest(manifest, os.path.join(target, MANIFEST)):
+        # Checked before touching the target, so the remote keeps its files and its manifest.
+        print("ERROR: The remote changed since the patch was computed, the patch is not applied.")
+        sys.exit(1)
+    with open(info_path, "r") as f:
+        info = json.loads(f.read())
+    os.remove(info_path)
+    # Delete first, a deleted file might be replaced by a folder of the same name and vice versa.
+    for name in info.get("deleted", []):
+        remove(os.path.join(target, name))
+    for folder in sorted(info.get("folders", []), key=len, reverse=True):
+        try:
+            # Only if empty, the remote might have created files (e.g. outputs) in it.
+            os.rmdir(os.path.join(target, folder))
+        except OSError:
+            pass
+    for path, _, files in os.walk(staging):
+        relative = os.path.relpath(path, staging)
+        os.makedirs(os.path.join(target, relative), exist_ok=True)
+        for name in files:
+            if relative == "." and name == MANIFEST:
+                continue
+            os.replace(os.path.join(path, name), os.path.join(target, relative, name))
+    if os.path.exists(manifest):
+        os.replace(manifest, os.path.join(target, MANIFEST))
+    shutil.rmtree(staging)
+    try:
+        # Remove the folder holding all staging folders, unless another patch is staged in parallel.
+        os.rmdir(os.path.dirname(staging.rstrip("/")))
+    except OSError:
+        pass
+
+
+if __name__ == "__main__":
+    main(sys.argv[1], sys.argv[2])
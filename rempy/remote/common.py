@@ -0,0 +1,116 @@
+"""doc
+# common.py
+
+> Helpers shared by the scripts in this folder: reading the manifest, the digests of its folders and hashing files.
+
+The scripts import them with `from rempy.remote.common import ...`, `remote_python` replaces that line by this file when sending a script to the remote.
+The local side uses the same functions (e.g. `rempy.sync.merkle`), so the digests of both sides never differ.
+Like the scripts, this only uses the standard library.
+
+License: MIT (see main license)
+Authors:
+* Michael Fuerst (Lead)
+"""
+import os
+import json
+import hashlib
+
+
+MANIFEST = ".md5.json"
+# Files modified this recently are not cached, as a second write within the timestamp resolution would go unnoticed.
+RACY_WINDOW_NS = 2 * 10**9
+BUFFER_SIZE = 1024 * 1024
+
+
+def get_hasher(algorithm, size=0):
+    """
+    Create a hasher like `rempy.sync.hashing.get_hasher`, the size is only needed for git blob ids.
+    """
+    if algorithm == "git":
+        # The blob id of git, a sha1 over a header with the size and the content.
+        hasher = hashlib.sha1()
+        hasher.update(b"blob %d\0" % size)
+        return hasher
+    if algorithm == "blake2b":
+        return hashlib.blake2b(digest_size=16)
+    if algorithm in ("xxh3", "xxh64"):
+        import xxhash
+        return xxhash.xxh3_128() if algorithm == "xxh3" else xxhash.xxh64()
+    return hashlib.new(algorithm)
+
+
+def hash_file(path, algorithm):
+    buffer = bytearray(BUFFER_SIZE)
+    view = memoryview(buffer)
+    with open(path, "rb", buffering=0) as f:
+        hasher = get_hasher(algorithm, os.fstat(f.fileno()).st_size)
+        while True:
+            n = f.readinto(buffer)
+            if not n:
+                break
+            hasher.update(view[:n])
+    return hasher.hexdigest()
+
+
+def tree_digest(files, folders):
+    """
+    Compute the digest of a folder from the hashes of its files and the digests of its subfolders.
+    """
+    hasher = hashlib.blake2b(digest_size=16)
+    for name in sorted(files):
+        hasher.update(f"f\0{name}\0{files[name]}\0".encode("utf-8", "surrogatepass"))
+    for name in sorted(folders):
+        hasher.update(f"d\0{name}\0{folders[name]}\0".encode("utf-8", "surrogatepass"))
+    return hasher.hexdigest()
+
+
+def add_digests(node):
+    """
+    Set the digest ("h") of a folder node and all its subfolders, returns the digest of the node.
+    """
+    folders = {name: add_digests(child) for name, child in node.get("d", {}).items()}
+    node["h"] = tree_digest(node.get("f", {}), folders)
+    return node["h"]
+
+
+def build_tree(hashes):
+    """
+    Build the tree of a dict of hashes (with paths separated by '/'), every folder node has its digest ("h"), its files ("f") and its subfolders ("d").
+    """
+    root = {}
+    for path, h in hashes.items():
+        node = root
+        parts = path.split("/")
+        for name in parts[:-1]:
+            node = node.setdefault("d", {}).setdefault(name, {})
+        node.setdefault("f", {})[parts[-1]] = h
+    add_digests(root)
+    return root
+
+
+def flatten_tree(node, prefix="", hashes=None):
+    """
+    Get the hashes of all files in a tree, paths are prefixed with prefix.
+    """
+    if hashes is None:
+        hashes = {}
+    for name, h in node.get("f", {}).items():
+        hashes[prefix + name] = h
+    for name, child in node.get("d", {}).items():
+        flatten_tree(child, f"{prefix}{name}/", hashes)
+    return hashes
+
+
+def load_tree(path):
+    """
+    Read a manifest file into its tree, the hash algorithm and the files held back by a lazy sync.
+
+    Older manifests, a dict of hashes (optionally in "files"), are converted to a tree.
+    """
+    with open(path, "r") as f:
+        manifest = json.loads(f.read())
+    if isinstance(manifest.get("tree", None), dict):
+        return manifest["tree"], manifest["algorithm"], manifest.get("pending", {})
+    if isinstance(manifest.get("files", None), dict):
+        return build_tree(manifest["files"]), manifest.get("algorithm", "md5"), manifest.get("pending", {})
+    return build_tree(manifest), "md5", {}
@@ -0,0 +1,100 @@
+"""doc
+# manifest.py
+
+> Runs on the remote: hashes the files of a folder (e.g. the outputs of a run) and prints them as json, so they can be pulled incrementally.
+
+Usage: `python3 manifest.py TARGET_FOLDER ALGORITHM OPTIONS_JSON`
+
+The options can contain `include` and `exclude` lists of glob patterns and a `max_size` in bytes.
+A pattern matches the path relative to the target or the name of a file, excluded folders are not entered at all.
+Files larger than `max_size` are not hashed but reported as skipped with their size.
+Hashes are cached by `(size, mtime_ns, inode)` in `~/.rempy_cache/manifest` on the remote, so following a live run only reads files that were written since the last call.
+
+License: MIT (see main license)
+Authors:
+* Michael Fuerst (Lead)
+"""
+import os
+import sys
+import json
+import time
+import fnmatch
+import hashlib
+
+from rempy.remote.common import MANIFEST, RACY_WINDOW_NS, get_hasher, hash_file
+
+
+CACHE_FOLDER = os.path.join(os.path.expanduser("~"), ".rempy_cache", "manifest")
+
+
+def matches(path, patterns):
+    name = path.rsplit("/", 1)[-1]
+    return any(fnmatch.fnmatch(path, p) or fnmatch.fnmatch(name, p) for p in patterns)
+
+
+def walk(target, include, exclude):
+    for path, dirs, files in os.walk(target):
+        relative = os.path.relpath(path, target).replace(os.sep, "/")
+        prefix = "" if relative == "." else relative + "/"
+        # Staging folders and snapshot stores of rempy are never outputs.
+        dirs[:] = [d for d in dirs if not d.startswith(".rempy") and not matches(prefix + d, exclude)]
+        for name in files:
+            f = prefix + name
+            if name == MANIFEST or matches(f, exclude):
+                continue
+            if len(include) > 0 and not matches(f, include):
+                continue
+            yield f
+
+
+def main(target, algorithm, options):
+    target = os.path.abspath(target)
+    options = json.loads(options)
+    include = options.get("include", [])
+    exclude = options.get("exclude", [])
+    max_size = options.get("max_size", None)
+    try:
+        get_hasher(algorithm)
+    except (ValueError, ImportError) as e:
+        print(json.dumps({"error": str(e)}))
+        return
+    cache_path = os.path.join(CACHE_FOLDER, hashlib.md5(target.encode("utf-8")).hexdigest() + f"_{algorithm}.json")
+    try:
+        with open(cache_path, "r") as f:
+            cache = json.loads(f.read())
+    except (OSError, ValueError):
+        cache = {}
+    new_cache = {}
+    hashes = {}
+    skipped = {}
+    hashed = 0
+    now = time.time_ns()
+    for path in walk(target, include, exclude):
+        full_path = os.path.join(target, path)
+        try:
+            st = os.stat(full_path)
+            if max_size is not None and st.st_size > max_size:
+                skipped[path] = st.st_size
+                continue
+            key = [st.st_size, st.st_mtime_ns, st.st_ino]
+            entry = cache.get(path, None)
+            if entry is not None and entry[:3] == key:
+                hashes[path] = entry[3]
+            else:
+                hashes[path] = hash_file(full_path, algorithm)
+                hashed += 1
+        except OSError:
+            # Deleted while walking, e.g. a temporary file of the run.
+            continue
+        if now - st.st_mtime_ns > RACY_WINDOW_NS:
+            new_cache[path] = key + [hashes[path]]
+    os.makedirs(CACHE_FOLDER, exist_ok=True)
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(json.dumps(new_cache))
+    os.replace(tmp_path, cache_path)
+    print(json.dumps({"files": hashes, "skipped": skipped, "hashed": hashed}))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1], sys.argv[2], sys.argv[3])
@@ -0,0 +1,46 @@
+"""doc
+# signature.py
+
+> Runs on the remote: prints the block signatures of files as json.
+
+Usage: `python3 signature.py BLOCK_SIZE FILE [FILE ...]`
+Files that do not exist get a signature of null.
+
+License: MIT (see main license)
+Authors:
+* Michael Fuerst (Lead)
+"""
+import sys
+import json
+import zlib
+import hashlib
+
+
+def file_signature(path, block_size):
+    blocks = []
+    weak = []
+    size = 0
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            size += len(block)
+            blocks.append(hashlib.blake2b(block, digest_size=16).hexdigest())
+            # The weak checksum of rsync, which the local side rolls over its file.
+            weak.append(zlib.adler32(block))
+    return {"block_size": block_size, "size": size, "blocks": blocks, "weak": weak}
+
+
+def main(block_size, paths):
+    signatures = {}
+    for path in paths:
+        try:
+            signatures[path] = file_signature(path, block_size)
+        except OSError:
+            signatures[path] = None
+    print(json.dumps(signatures))
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]), sys.argv[2:])
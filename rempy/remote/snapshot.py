@@ -0,0 +1,88 @@
+"""doc
+# snapshot.py
+
+> Runs on the remote: creates a run folder from the synced code as a farm of hardlinks into a content addressed store.
+
+Usage: `python3 snapshot.py CODE_FOLDER RUN_FOLDER STORE_FOLDER`
+
+Every file listed in the manifest (`.md5.json`) of the code folder is stored once as `STORE_FOLDER/objects/ALGORITHM/AB/ABCDEF...`.
+The run folder then only consists of hardlinks to those blobs, so creating it only copies files that are new to the store.
+New blobs are copied from the code folder, so they do not change with it, and made read-only, so a run writing to one of its files in place fails instead of changing the file for all other runs.
+Their content is verified against the manifest once, so a file that drifted on the remote never ends up in the store.
+Files that are not in the manifest are copied.
+
+License: MIT (see main license)
+Authors:
+* Michael Fuerst (Lead)
+"""
+import os
+import sys
+import stat
+import shutil
+
+from rempy.remote.common import MANIFEST, flatten_tree, hash_file, load_tree
+
+
+def file_hash(path, algorithm):
+    try:
+        return hash_file(path, algorithm)
+    except (ValueError, ImportError):
+        # The algorithm is not available on the remote, so the blob cannot be verified.
+        return None
+
+
+def link_or_copy(src, dst):
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+        os.chmod(dst, os.stat(dst).st_mode | stat.S_IWUSR)
+
+
+def is_blob(path):
+    # Blobs are read-only, a writable one is a hardlink of a code file made by an older version of rempy.
+    try:
+        return not os.stat(path).st_mode & (stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH)
+    except OSError:
+        return False
+
+
+def add_blob(src, blob, expected, algorithm):
+    os.makedirs(os.path.dirname(blob), exist_ok=True)
+    tmp = f"{blob}.{os.getpid()}.tmp"
+    shutil.copy2(src, tmp)
+    actual = file_hash(tmp, algorithm)
+    if actual is not None and actual != expected:
+        os.remove(tmp)
+        return False
+    os.chmod(tmp, os.stat(tmp).st_mode & ~(stat.S_IWUSR | stat.S_IWGRP | stat.S_IWOTH))
+    os.replace(tmp, blob)
+    return True
+
+
+def main(code, run, store):
+    tree, algorithm, _ = load_tree(os.path.join(code, MANIFEST))
+    hashes = flatten_tree(tree)
+    os.makedirs(run, exist_ok=True)
+    for name, h in hashes.items():
+        src = os.path.join(code, name)
+        dst = os.path.join(run, name)
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        blob = os.path.join(store, "objects", algorithm, h[:2], h)
+        if is_blob(blob) or add_blob(src, blob, h, algorithm):
+            link_or_copy(blob, dst)
+        else:
+            print(f"REMPY: {name} does not match the manifest, copying it.")
+            shutil.copy2(src, dst)
+    for path, folders, files in os.walk(code):
+        relative = os.path.relpath(path, code)
+        folders[:] = [f for f in folders if not f.startswith(".rempy_")]
+        for name in files:
+            name = os.path.normpath(os.path.join(relative, name))
+            if name.replace(os.sep, "/") not in hashes and not os.path.exists(os.path.join(run, name)):
+                os.makedirs(os.path.join(run, os.path.dirname(name)), exist_ok=True)
+                shutil.copy2(os.path.join(code, name), os.path.join(run, name))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1], sys.argv[2], sys.argv[3])
@@ -0,0 +1,66 @@
+"""doc
+# tree.py
+
+> Runs on the remote: answers which folders of the manifest differ from the local files.
+
+Usage: `python3 tree.py TARGET_FOLDER`
+
+Replies with the digest of the root folder of the manifest (see `rempy.sync.merkle`) and the files held back by a lazy sync first.
+Then it reads requests as json lines from stdin until it is closed.
+A request is a list of folders, for each the files and the digests of the subfolders are sent.
+For a request of null, the whole tree is sent.
+Every reply is compressed json (zlib) prefixed by its length as 4 bytes (big endian), the hashes of a large tree are megabytes of json.
+Older manifests without digests are converted to a tree first.
+
+License: MIT (see main license)
+Authors:
+* Michael Fuerst (Lead)
+"""
+import os
+import sys
+import json
+import zlib
+
+from rempy.remote.common import MANIFEST, load_tree
+
+
+def find(tree, folder):
+    node = tree
+    for name in folder.split("/") if folder != "" else []:
+        node = node["d"][name]
+    return node
+
+
+def reply(message):
+    data = zlib.compress(json.dumps(message, separators=(",", ":")).encode("utf-8"))
+    sys.stdout.buffer.write(len(data).to_bytes(4, "big") + data)
+    sys.stdout.buffer.flush()
+
+
+def main(target):
+    try:
+        tree, algorithm, pending = load_tree(os.path.join(target, MANIFEST))
+    except FileNotFoundError:
+        reply({"root": None})
+        return
+    except (OSError, ValueError) as e:
+        reply({"error": str(e)})
+        return
+    reply({"root": tree["h"], "algorithm": algorithm, "pending": pending})
+    while True:
+        line = sys.stdin.readline()
+        if line == "":
+            return
+        wanted = json.loads(line)
+        if wanted is None:
+            reply(tree)
+            continue
+        listing = {}
+        for folder in wanted:
+            node = find(tree, folder)
+            listing[folder] = {"f": node.get("f", {}), "d": {name: child["h"] for name, child in node.get("d", {}).items()}}
+        reply(listing)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1])
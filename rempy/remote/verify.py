@@ -0,0 +1,72 @@
+"""doc
+# verify.py
+
+> Runs on the remote: checks that the files still match the manifest and prints the files that drifted as json.
+
+Usage: `python3 verify.py TARGET_FOLDER`
+
+Files that were modified on the remote or are missing (e.g. after an interrupted patch) are reported as drift.
+Hashes are cached by `(size, mtime_ns, inode)` in `~/.rempy_cache/verify` on the remote, so only files that were touched since the last check are read again.
+
+License: MIT (see main license)
+Authors:
+* Michael Fuerst (Lead)
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+
+from rempy.remote.common import MANIFEST, RACY_WINDOW_NS, flatten_tree, get_hasher, hash_file, load_tree
+
+
+CACHE_FOLDER = os.path.join(os.path.expanduser("~"), ".rempy_cache", "verify")
+
+
+def main(target):
+    target = os.path.abspath(target)
+    try:
+        tree, algorithm, _ = load_tree(os.path.join(target, MANIFEST))
+        hashes = flatten_tree(tree)
+        get_hasher(algorithm)
+    except (OSError, ValueError, ImportError) as e:
+        print(json.dumps({"error": str(e)}))
+        return
+    cache_path = os.path.join(CACHE_FOLDER, hashlib.md5(target.encode("utf-8")).hexdigest() + f"_{algorithm}.json")
+    try:
+        with open(cache_path, "r") as f:
+            cache = json.loads(f.read())
+    except (OSError, ValueError):
+        cache = {}
+    new_cache = {}
+    drift = []
+    hashed = 0
+    now = time.time_ns()
+    for path, expected in hashes.items():
+        full_path = os.path.join(target, path)
+        try:
+            st = os.stat(full_path)
+            key = [st.st_size, st.st_mtime_ns, st.st_ino]
+            entry = cache.get(path, None)
+            if entry is not None and entry[:3] == key:
+                actual = entry[3]
+            else:
+                actual = hash_file(full_path, algorithm)
+                hashed += 1
+            if now - st.st_mtime_ns > RACY_WINDOW_NS:
+                new_cache[path] = key + [actual]
+        except OSError:
+            actual = None
+        if actual != expected:
+            drift.append(path)
+    os.makedirs(CACHE_FOLDER, exist_ok=True)
+    tmp_path = f"{cache_path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(json.dumps(new_cache))
+    os.replace(tmp_path, cache_path)
+    print(json.dumps({"files": len(hashes), "hashed": hashed, "drift": sorted(drift)}))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1])
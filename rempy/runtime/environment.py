@@ -0,0 +1,74 @@
+"""doc
+# environment.py
+
+> Skips pre launch steps (e.g. installing requirements) on the remote, if they already ran with the same inputs.
+
+The fingerprint of a pre launch step covers the command, the conda env it runs in and the hashes of its input files (e.g. `requirements.txt`).
+Input files are the files of the project named in the command, more can be given explicitly.
+Once the step succeeded, a marker named after the fingerprint is written to `~/.rempy_cache/pre_launch` on the remote and later runs skip the step.
+This assumes the step only changes the environment and not the code folder, so it is opt-in.
+
+Alternatively the step runs in a virtualenv in `~/.rempy_cache/envs/<fingerprint>` on the remote, which is built once and activated by all runs with the same fingerprint.
+The env is built while holding a lock (`flock`), so runs starting at the same time wait for it instead of building it twice.
+
+```
+inputs = find_pre_launch_inputs(".", "pip install -r requirements.txt")  # ["requirements.txt"]
+fingerprint = pre_launch_fingerprint("pip install -r requirements.txt", "base", get_hashes(".", inputs))
+command = cached_pre_launch("pip install -r requirements.txt", fingerprint, env=True)
+```
+
+License: MIT (see main license)
+Authors:
+* Michael Fuerst (Lead)
+"""
+import os
+import json
+import shlex
+import hashlib
+
+
+MARKER_FOLDER = "~/.rempy_cache/pre_launch"
+ENV_FOLDER = "~/.rempy_cache/envs"
+ENV_READY = ".rempy_ready"
+
+
+def find_pre_launch_inputs(folder, pre_launch, extra=[]):
+    """
+    Find the files of the folder named in the pre launch command (e.g. 'pip install -r requirements.txt') and add the extra files.
+    """
+    try:
+        tokens = shlex.split(pre_launch)
+    except ValueError:
+        tokens = pre_launch.split()
+    inputs = list(extra)
+    for token in tokens:
+        # Also options like --requirement=requirements.txt.
+        path = token.split("=", 1)[-1]
+        if path not in inputs and not os.path.isabs(path) and os.path.isfile(os.path.join(folder, path)):
+            inputs.append(path)
+    return inputs
+
+
+def pre_launch_fingerprint(pre_launch, conda, hashes, env=False):
+    """
+    Compute the fingerprint of a pre launch step from its command, conda env and the hashes of its inputs.
+    """
+    data = json.dumps({"command": pre_launch, "conda": conda, "inputs": hashes, "env": env}, sort_keys=True)
+    return hashlib.md5(data.encode("utf-8")).hexdigest()
+
+
+def cached_pre_launch(pre_launch, fingerprint, env=False, python="python3"):
+    """
+    Wrap the pre launch command, so it is skipped if it already succeeded with the same fingerprint on the remote.
+
+    With env, the command runs in a virtualenv for the fingerprint, which stays active for the run.
+    """
+    if not env:
+        marker = f"{MARKER_FOLDER}/{fingerprint}"
+        return f"{{ test -f {marker} || {{ {pre_launch} && mkdir -p {MARKER_FOLDER} && touch {marker}; }}; }}"
+    env_path = f"{ENV_FOLDER}/{fingerprint}"
+    activate = f". {env_path}/bin/activate"
+    build = f"rm -rf {env_path} && {python} -m venv {env_path} && {activate} && {pre_launch} && touch {env_path}/{ENV_READY}"
+    # Runs starting at the same time wait for the one building the env, a venv cannot be built elsewhere and moved into place.
+    locked = f"( flock 9 && {{ test -f {env_path}/{ENV_READY} || {{ {build}; }}; }} ) 9> {env_path}.lock"
+    return f"{{ test -f {env_path}/{ENV_READY} || {{ mkdir -p {ENV_FOLDER} && {locked}; }}; }} && {activate}"
@@ -0,0 +1,209 @@
+"""doc
+# output.py
+
+> Streams the output of remote processes to the terminal with low latency and little CPU.
+
+The raw bytes read from the remote are
+* decoded incrementally, so multi-byte characters split between reads are not broken,
+* rendered line by line, where a carriage return redraws the current line like a terminal would,
+* stripped of ANSI escape sequences (with a precompiled pattern), but only what is actually shown.
+
+Progress bars, which redraw their line many times per second, are rendered at most every `min_interval` seconds.
+Complete lines are shown immediately and optionally mirrored to a local file (without the intermediate redraws).
+
+```
+output = OutputStream(mirror="run.log")
+output.expect_echo("python train.py")  # Hide the echo of a command sent to a shell.
+output.write(b"epoch 1/10\\r\\nloss: 0.3\\r")
+output.close()
+```
+
+License: MIT (see main license)
+Authors:
+* Michael Fuerst (Lead)
+"""
+import re
+import sys
+import time
+import codecs
+import threading
+
+from rempy.remote import abbreviate
+
+
+ANSI_ESCAPE = re.compile(r'(\x9B|\x1B\[)[0-?]*[ -\/]*[@-~]')
+# An escape at the end of the current line, which is not terminated after this many characters, is no escape sequence.
+MAX_ESCAPE_LENGTH = 32
+WHITESPACE = re.compile(r"\s+")
+MIN_INTERVAL = 0.05
+MAX_BUFFER = 64 * 1024
+
+
+def escape_ansi(line):
+    return ANSI_ESCAPE.sub('', line)
+
+
+class OutputStream(object):
+    def __init__(self, out=None, mirror=None, min_interval=MIN_INTERVAL, max_buffer=MAX_BUFFER) -> None:
+        """
+        Render the output of a remote process to out (default sys.stdout) and optionally append complete lines to the file mirror.
+
+        pexpect uses it as logfile, so write and flush are called for every read.
+        """
+        self.output = False
+        self.received = 0
+        self._out = out
+        self._mirror = open(mirror, "a") if mirror is not None else None
+        self._min_interval = min_interval
+        self._max_buffer = max_buffer
+        self._decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        self._echo = None
+        self._held = ""
+        # Lines completed since the last render, the current line and what the terminal shows of it.
+        self._completed = []
+        self._completed_size = 0
+        self._line = ""
+        self._cursor = 0
+        self._shown = ""
+        self._last_render = 0.0
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def current_command(self, command):
+        print(f"> {abbreviate(command)}")
+
+    def expect_echo(self, command):
+        """
+        Hide the echo of a command sent to an interactive shell from the output.
+        """
+        self._decoder.reset()
+        self._echo = WHITESPACE.sub("", command)
+        self._held = ""
+
+    def write(self, data):
+        if isinstance(data, bytes):
+            self.received += len(data)
+            data = self._decoder.decode(data)
+        if not self.output:
+            return
+        if self._echo is not None:
+            data = self._skip_echo(data)
+        if data == "":
+            return
+        with self._lock:
+            self._feed(data)
+            if self._completed_size >= self._max_buffer or time.monotonic() - self._last_render >= self._min_interval:
+                self._render()
+            elif self._timer is None:
+                # Nothing might follow for a while, so render the rest once the interval is over.
+                self._timer = threading.Timer(self._min_interval, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        with self._lock:
+            if self._timer is not None and self._timer is not threading.current_thread():
+                return
+            self._render()
+
+    def close(self):
+        with self._lock:
+            self._render()
+            if self._mirror is not None:
+                if self._line != "":
+                    self._mirror.write(ANSI_ESCAPE.sub("", self._line) + "\n")
+                self._mirror.close()
+                self._mirror = None
+
+    def _strip(self, line):
+        line = ANSI_ESCAPE.sub("", line)
+        start = max(line.rfind("\x1b"), line.rfind("\x9b"))
+        if start >= 0 and len(line) - start < MAX_ESCAPE_LENGTH:
+            # The escape sequence is continued by the next read.
+            line = line[:start]
+        return line
+
+    def _skip_echo(self, text):
+        self._held += text
+        start = 0
+        while True:
+            end = self._held.find("\n", start)
+            if end < 0:
+                break
+            if self._echo in WHITESPACE.sub("", ANSI_ESCAPE.sub("", self._held[:end])):
+                text = self._held[end + 1:]
+                self._echo = None
+                self._held = ""
+                return text
+            start = end + 1
+        if len(self._held) > 2 * len(self._echo) + 1024:
+            # The echo is not coming (e.g. the shell does not echo), show what was held back.
+            text = self._held
+            self._echo = None
+            self._held = ""
+            return text
+        return ""
+
+    def _put(self, text):
+        # Write at the cursor like a terminal does, a carriage return moves the cursor to the start of the line.
+        if self._cursor == len(self._line):
+            self._line += text
+        else:
+            self._line = self._line[:self._cursor] + text + self._line[self._cursor + len(text):]
+        self._cursor += len(text)
+
+    def _feed(self, text):
+        for i, piece in enumerate(text.split("\n")):
+            if i > 0:
+                self._completed.append(self._line)
+                self._completed_size += len(self._line)
+                self._line = ""
+                self._cursor = 0
+            segments = piece.split("\r")
+            self._put(segments[0])
+            if len(segments) > 1:
+                # Only the last redraw and what earlier (longer) redraws left behind it are visible.
+                line = segments[-1]
+                for segment in segments[-2:0:-1]:
+                    if len(segment) > len(line):
+                        line += segment[len(line):]
+                self._cursor = 0
+                self._put(line)
+                self._cursor = len(segments[-1])
+
+    def _update(self, line):
+        shown = self._shown
+        self._shown = line
+        if line.startswith(shown):
+            return line[len(shown):]
+        return "\r" + line + " " * max(0, len(shown) - len(line))
+
+    def _render(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        self._last_render = time.monotonic()
+        parts = []
+        completed = [ANSI_ESCAPE.sub("", line) for line in self._completed]
+        for line in completed:
+            parts.append(self._update(line))
+            parts.append("\n")
+            self._shown = ""
+        if self._mirror is not None and len(completed) > 0:
+            self._mirror.write("\n".join(completed) + "\n")
+            self._mirror.flush()
+        self._completed = []
+        self._completed_size = 0
+        # Only what is shown is stripped of escape sequences, intermediate redraws are never looked at.
+        parts.append(self._update(self._strip(self._line)))
+        if len(self._line) > self._max_buffer:
+            # Do not keep endless lines (without any newline) in memory.
+            if self._mirror is not None:
+                self._mirror.write(self._shown)
+            self._line = self._shown = ""
+            self._cursor = 0
+        text = "".join(parts)
+        if text != "":
+            out = self._out if self._out is not None else sys.stdout
+            out.write(text)
+            out.flush()
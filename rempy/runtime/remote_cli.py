@@ -8,58 +8,54 @@ Authors:
 * Michael Fuerst (Lead)
 """
 from uuid import uuid4
-from pexpect import spawn as pexpect_spawn
-import re
 import os
 
-def escape_ansi(line):
-    ansi_escape =re.compile(r'(\x9B|\x1B\[)[0-?]*[ -\/]*[@-~]')
-    return ansi_escape.sub('', line)
-
-
-class CustomLogger(object):
-    def __init__(self) -> None:
-        self.output = False
-        self.command = ""
-    
-    def current_command(self, command):
-        print(f"> {command}")
-        self.command = command
-
-    def write(self, data):
-        try:
-            data = data.decode("utf-8")
-            data = escape_ansi(data)
-        except:
-            pass
-        if self.output:
-            try:
-                if self.command not in data:
-                    print(data, end="")
-            except Exception as e:
-                print("REMPY EXCEPTION", e)
-    
-    def flush(self):
-        pass
+from rempy.connection import get_connection
+from rempy.profiling import phase
+from rempy.remote import remote_python
+from rempy.runtime.output import OutputStream
+
+
+STORE_FOLDER = ".rempy_store"
 
 
 def _run(command, conn, logger):
     logger.current_command(command)
     if conn is None:
+        # Imported on first use, syncing and the other commands of rempy do not need it.
+        from pexpect import spawn as pexpect_spawn
         conn = pexpect_spawn(command, timeout=None, logfile=logger)
     else:
+        logger.expect_echo(command)
         conn.sendline(command)
     return conn
 
 
-def remoteExecute(host, user, code_path, script, args, launcher, debug=0, interface="ssh", ssh_args="", slurm_args="", pre_launch="", logfile=None, run_path=""):
+def snapshot_command(code_path, run_path, snapshot="link", python="python3"):
+    """
+    Build the command that creates the run folder from the code.
+
+    With snapshot "link", the run folder is a farm of hardlinks into a content addressed store next to the run folders.
+    If that fails (e.g. no python on the remote), the code is copied.
+    """
+    copy = f"cp -R {code_path} {run_path}"
+    if snapshot != "link":
+        return copy
+    store = os.path.join(os.path.dirname(run_path.rstrip("/")), STORE_FOLDER)
+    link = remote_python("snapshot", [code_path, run_path, store], python)
+    return f"{{ {link} || {{ rm -rf {run_path} && {copy}; }}; }}"
+
+
+def remoteExecute(host, user, code_path, script, args, launcher, debug=0, interface="ssh", ssh_args="", slurm_args="", pre_launch="", logfile=None, run_path="", snapshot="link", python="python3", mirror=None, allocation=None):
     # Initialize variables with defaults
     _conn = None
     _debug_conn = None
+    _forwarded = False
+    connection = get_connection(host, user, ssh_args)
     uuid = ""
     debug_prefix = ""
-    logger = CustomLogger()
-    debug_conn_logger = CustomLogger()
+    logger = OutputStream(mirror=mirror)
+    debug_conn_logger = OutputStream()
     try:
         if run_path != "":
             remote_workdir = run_path
@@ -82,44 +78,54 @@ def remoteExecute(host, user, code_path, script, args, launcher, debug=0, interf
             command = f"echo > {logfile} && {command} 2>&1 | tee {logfile}"
         if interface in ["slurm"]:
             command = f"bash -c '{command}'"
-            command = f"srun {slurm_args} -v {command}"
+            if allocation is not None:
+                # Run as a step of the allocation (see rempy.runtime.slurm.Allocation), the resources are already reserved.
+                command = f"{allocation.touch_command()} && {allocation.srun()} -v {command}"
+            else:
+                command = f"srun {slurm_args} -v {command}"
         if run_path != "":
-            command = f"cp -R {code_path} {run_path} && {command}"
+            command = f"{snapshot_command(code_path, run_path, snapshot, python)} && {command}"
         if interface in ["ssh", "slurm"]:
             uuid = str(uuid4())
             if host != "localhost":
-                _conn = _run(f"ssh {ssh_args} {user}@{host}", _conn, logger)
-                _conn.expect("\n.*@.*:.*")
+                with phase("connect", host):
+                    _conn = _run(connection.ssh(), _conn, logger)
+                    _conn.expect("\n.*@.*:.*")
             command = command.replace("'", "'\\''")
             command = f"bash -c '{command}'"
             command = f"screen -S {uuid} {command}"
 
         logger.output = True
-        _conn = _run(command, _conn, logger)
-        if interface in ["slurm"]:
-            _conn.expect("srun: Node (.*), .* tasks started")
-            node = _conn.match.groups()[0].decode("utf-8")
-            if debug > 0:
-                inner_forward = f"ssh -o StrictHostKeyChecking=no -N -L {debug}:localhost:{debug} {node}"
-                if host != "localhost":
-                    # Forward port again if not on localhost.
-                    _debug_conn = _run(f"ssh {ssh_args} -L {debug}:localhost:{debug} {user}@{host} {inner_forward}", _debug_conn, debug_conn_logger)
-                else:
-                    # Only use inner forward if on slurm head node.
-                    _debug_conn = _run(inner_forward)
-        if interface in ["ssh"] and debug:
-            # Forward port if not on localhost.
-            if debug > 0 and host != "localhost":
-                _debug_conn = _run(f"ssh {ssh_args} -N -L {debug}:localhost:{debug} {user}@{host}", _debug_conn, debug_conn_logger)
-
-        if uuid != "":
-            _conn.expect("screen is terminating")
-            logger.output = False
-            _conn = _run("exit", _conn, logger)
-            _conn.expect("exit")
-        else:
-            while _conn.isalive():
-                _conn.read()
+        received = logger.received
+        with phase("run", host) as run:
+            _conn = _run(command, _conn, logger)
+            if interface in ["slurm"]:
+                with phase("queue", host):
+                    _conn.expect("srun: Node (.*), .* tasks started")
+                node = _conn.match.groups()[0].decode("utf-8")
+                if debug > 0:
+                    inner_forward = f"ssh -o StrictHostKeyChecking=no -N -L {debug}:localhost:{debug} {node}"
+                    if host != "localhost":
+                        # Forward port again if not on localhost.
+                        _debug_conn = _run(connection.ssh(inner_forward), _debug_conn, debug_conn_logger)
+                        _forwarded = connection.forward(debug) == 0
+                    else:
+                        # Only use inner forward if on slurm head node.
+                        _debug_conn = _run(inner_forward, _debug_conn, debug_conn_logger)
+            if interface in ["ssh"] and debug:
+                # Forward port if not on localhost.
+                if debug > 0 and host != "localhost":
+                    _forwarded = connection.forward(debug) == 0
+
+            if uuid != "":
+                _conn.expect("screen is terminating")
+                logger.output = False
+                _conn = _run("exit", _conn, logger)
+                _conn.expect("exit")
+            else:
+                while _conn.isalive():
+                    _conn.read()
+            run.add("output_bytes", logger.received - received)
     except KeyboardInterrupt:
         print()  # Break line so ^C is not at start of next line when returning.
     if _conn is not None:
@@ -127,3 +133,7 @@ def remoteExecute(host, user, code_path, script, args, launcher, debug=0, interf
 
     if _debug_conn is not None:
         _debug_conn.kill(9)
+
+    if _forwarded:
+        connection.forward(debug, cancel=True)
+    logger.close()
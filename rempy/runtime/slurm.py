@@ -0,0 +1,326 @@
+"""doc
+# slurm.py
+
+> Submits sweeps as a single slurm job array and follows their progress and keeps allocations for repeated runs.
+
+Instead of one blocking `srun` per run, all argument sets of a sweep are written into one batch script, which is submitted with `sbatch --array`.
+Every task picks its arguments by `SLURM_ARRAY_TASK_ID` and logs to `logs/task_<i>.log` in the run folder.
+Submitted arrays are remembered in `~/.rempy_cache/slurm`, so their status and logs can be checked later by the job id.
+
+```
+array = submit_array(conn, "/home/foo/Testing/rempy", "/home/foo/Runs/2021-01-01_120000_sweep", "train.py", ["--lr=0.1", "--lr=0.01"], "python", "--partition=batch")
+print(array.job_id)
+array = SlurmArray.load(array.job_id)
+print(array.status())  # {0: "COMPLETED", 1: "RUNNING"}
+array.tail(1)
+```
+
+For repeated short runs, waiting in the queue for every srun costs more than the run itself.
+An `Allocation` is a placeholder job, which holds the resources of the slurm args, and runs are started in it as job steps (`srun --jobid`).
+The placeholder ends itself once no step ran for the idle timeout, the job id is remembered in `~/.rempy_cache/slurm/allocations.json`.
+```
+allocation = get_allocation(conn, "--partition=batch --gpus=1", idle_timeout=1800)
+conn.run(f"{allocation.touch_command()} && {allocation.srun()} python train.py")
+```
+
+License: MIT (see main license)
+Authors:
+* Michael Fuerst (Lead)
+"""
+import os
+import re
+import json
+import time
+import shlex
+import hashlib
+import subprocess
+from collections import Counter
+
+from rempy.connection import get_connection
+from rempy.runtime.remote_cli import snapshot_command
+
+
+STATE_FOLDER = os.path.join(os.path.expanduser("~"), ".rempy_cache", "slurm")
+BATCH_SCRIPT = "rempy_array.sh"
+LOG_FOLDER = "logs"
+FINAL_STATES = ["COMPLETED", "FAILED", "CANCELLED", "TIMEOUT", "OUT_OF_MEMORY", "NODE_FAIL", "PREEMPTED", "BOOT_FAIL", "DEADLINE"]
+ALLOCATIONS = os.path.join(STATE_FOLDER, "allocations.json")
+IDLE_TIMEOUT = 30 * 60
+# The placeholder job checks this often if it is still used.
+IDLE_CHECK_INTERVAL = 30
+ARRAY_TASK = re.compile(r"^(\d+)_(\d+|\[[^\]]*\])$")
+
+
+def batch_script(run_dir, script, arg_sets, launcher, pre_launch="", max_parallel=0):
+    """
+    Create the batch script, which runs the arguments of its array task in run_dir.
+    """
+    array = f"0-{len(arg_sets) - 1}"
+    if max_parallel > 0:
+        array += f"%{max_parallel}"
+    lines = [
+        "#!/bin/bash",
+        f"#SBATCH --array={array}",
+        f"#SBATCH --output={run_dir}/{LOG_FOLDER}/task_%a.log",
+        "ARGS=(",
+    ]
+    lines += [f"  {shlex.quote(args)}" for args in arg_sets]
+    lines += [
+        ")",
+        f"cd {run_dir}",
+    ]
+    if pre_launch != "":
+        lines.append(pre_launch)
+    # eval, so the arguments are split like on a command line.
+    lines.append(f"eval \"{launcher} {script} ${{ARGS[$SLURM_ARRAY_TASK_ID]}}\"")
+    return "\n".join(lines) + "\n"
+
+
+def _expand_tasks(spec):
+    # Pending tasks are reported as a range, e.g. "[3-5,8%2]".
+    tasks = []
+    for part in spec.strip("[]").split("%")[0].split(","):
+        if "-" in part:
+            first, last = part.split("-")
+            tasks.extend(range(int(first), int(last) + 1))
+        elif part != "":
+            tasks.append(int(part))
+    return tasks
+
+
+class SlurmArray(object):
+    def __init__(self, host, user, ssh_args, job_id, run_dir, arg_sets):
+        self.host = host
+        self.user = user
+        self.ssh_args = ssh_args
+        self.job_id = job_id
+        self.run_dir = run_dir
+        self.arg_sets = arg_sets
+
+    @property
+    def _conn(self):
+        return get_connection(self.host, self.user, self.ssh_args)
+
+    def save(self):
+        os.makedirs(STATE_FOLDER, exist_ok=True)
+        state = {"host": self.host, "user": self.user, "ssh_args": self.ssh_args, "job_id": self.job_id, "run_dir": self.run_dir, "arg_sets": self.arg_sets}
+        with open(os.path.join(STATE_FOLDER, f"{self.job_id}.json"), "w") as f:
+            f.write(json.dumps(state))
+
+    @staticmethod
+    def load(job_id):
+        """
+        Load a previously submitted array by its job id or return None if it is unknown.
+        """
+        path = os.path.join(STATE_FOLDER, f"{job_id}.json")
+        if not os.path.exists(path):
+            return None
+        with open(path, "r") as f:
+            state = json.loads(f.read())
+        return SlurmArray(state["host"], state["user"], state["ssh_args"], state["job_id"], state["run_dir"], state["arg_sets"])
+
+    def status(self):
+        """
+        Get the state of every task as a dict, tasks slurm does not report (yet) are UNKNOWN.
+        """
+        states = {i: "UNKNOWN" for i in range(len(self.arg_sets))}
+        data = self._conn.check_output(f"sacct -j {self.job_id} --format=JobID,State --parsable2 --noheader")
+        if data is None:
+            return states
+        for line in data.decode("utf-8").splitlines():
+            fields = line.split("|")
+            match = ARRAY_TASK.match(fields[0])
+            if match is None or len(fields) < 2:
+                # Job steps (e.g. 1234_0.batch) or other jobs.
+                continue
+            # States can have a suffix, e.g. "CANCELLED by 1000".
+            state = fields[1].split(" ")[0]
+            for task in _expand_tasks(match.group(2)):
+                if task in states:
+                    states[task] = state
+        return states
+
+    def wait(self, poll_interval=30):
+        """
+        Poll the status until all tasks finished, printing the counts of the states whenever they change.
+        """
+        summary = None
+        while True:
+            states = self.status()
+            counts = Counter(states.values())
+            new_summary = ", ".join(f"{count} {state}" for state, count in sorted(counts.items()))
+            if new_summary != summary:
+                summary = new_summary
+                print(f"Job {self.job_id}: {summary}")
+            if all(state in FINAL_STATES for state in states.values()):
+                return states
+            time.sleep(poll_interval)
+
+    def log_path(self, task):
+        return f"{self.run_dir}/{LOG_FOLDER}/task_{task}.log"
+
+    def tail(self, task=None, lines=20, follow=True):
+        """
+        Show the log of a task (following it until interrupted) or the last lines of the logs of all tasks.
+        """
+        if task is None:
+            return self._conn.run(f"tail -n {lines} {self.run_dir}/{LOG_FOLDER}/task_*.log")
+        follow = "-F " if follow else ""
+        try:
+            return self._conn.run(f"tail -n {lines} {follow}{self.log_path(task)}")
+        except KeyboardInterrupt:
+            print()
+            return 0
+
+    def cancel(self):
+        return self._conn.run(f"scancel {self.job_id}")
+
+
+def submit_array(conn, code_path, run_dir, script, arg_sets, launcher, slurm_args="", pre_launch="", max_parallel=0, snapshot="link", python="python3"):
+    """
+    Snapshot the code into run_dir and submit one array task per argument set. Returns the SlurmArray or None if submitting failed.
+    """
+    command = f"{snapshot_command(code_path, run_dir, snapshot, python)} && mkdir -p {run_dir}/{LOG_FOLDER}"
+    command += f" && cat > {run_dir}/{BATCH_SCRIPT} && sbatch --parsable {slurm_args} {run_dir}/{BATCH_SCRIPT}"
+    proc = conn.popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    output, _ = proc.communicate(batch_script(run_dir, script, arg_sets, launcher, pre_launch, max_parallel).encode("utf-8"))
+    if proc.returncode != 0:
+        print("ERROR: Submitting the job array failed.")
+        return None
+    # With multiple clusters sbatch prints 'job_id;cluster'.
+    job_id = output.decode("utf-8").strip().splitlines()[-1].split(";")[0]
+    array = SlurmArray(conn.host, conn.user, conn.ssh_args, job_id, run_dir, list(arg_sets))
+    array.save()
+    print(f"Submitted job array {job_id} with {len(arg_sets)} tasks, logs are in {run_dir}/{LOG_FOLDER}.")
+    return array
+
+
+def allocation_script(idle_timeout):
+    """
+    Create the batch script of a placeholder job, which ends once no job step ran for idle_timeout seconds.
+    """
+    return "\n".join([
+        "#!/bin/bash",
+        "#SBATCH --job-name=rempy_allocation",
+        "MARKER=~/.rempy_cache/slurm/allocation_$SLURM_JOB_ID",
+        "mkdir -p ~/.rempy_cache/slurm && touch $MARKER",
+        "while true; do",
+        f"  sleep {IDLE_CHECK_INTERVAL}",
+        "  # Running steps keep the allocation alive, no matter how long they take.",
+        "  if [ -n \"$(squeue -h -s -j $SLURM_JOB_ID -o %i | grep -v -e '\\.batch$' -e '\\.extern$')\" ]; then touch $MARKER; fi",
+        f"  if [ $(( $(date +%s) - $(stat -c %Y $MARKER) )) -ge {idle_timeout} ]; then break; fi",
+        "done",
+        "rm -f $MARKER",
+    ]) + "\n"
+
+
+def _load_allocations():
+    if not os.path.exists(ALLOCATIONS):
+        return {}
+    try:
+        with open(ALLOCATIONS, "r") as f:
+            return json.loads(f.read())
+    except (OSError, ValueError):
+        return {}
+
+
+def _save_allocations(allocations):
+    os.makedirs(STATE_FOLDER, exist_ok=True)
+    tmp_path = f"{ALLOCATIONS}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(json.dumps(allocations))
+    os.replace(tmp_path, ALLOCATIONS)
+
+
+class Allocation(object):
+    def __init__(self, conn, job_id, key):
+        self._conn = conn
+        self.job_id = job_id
+        self._key = key
+
+    def state(self):
+        """
+        The state of the placeholder job (e.g. PENDING or RUNNING) or None if it is gone.
+        """
+        data = self._conn.check_output(f"squeue -h -j {self.job_id} -o %T")
+        if data is None or data.strip() == b"":
+            return None
+        return data.decode("utf-8").strip().splitlines()[0]
+
+    def wait_until_running(self, poll_interval=5):
+        state = self.state()
+        if state == "PENDING":
+            print(f"Waiting for allocation {self.job_id} to start...")
+        while state == "PENDING" or state == "CONFIGURING":
+            time.sleep(poll_interval)
+            state = self.state()
+        return state == "RUNNING"
+
+    def touch_command(self):
+        """
+        A command marking the allocation as used, run it with every step.
+        """
+        return f"touch ~/.rempy_cache/slurm/allocation_{self.job_id}"
+
+    def srun(self):
+        # --overlap, since the placeholder step itself holds all resources of the allocation.
+        return f"srun --jobid={self.job_id} --overlap"
+
+    def used(self):
+        allocations = _load_allocations()
+        if self._key in allocations:
+            allocations[self._key]["last_used"] = time.time()
+            _save_allocations(allocations)
+
+    def release(self):
+        self._conn.run(f"scancel {self.job_id}")
+        allocations = _load_allocations()
+        allocations.pop(self._key, None)
+        _save_allocations(allocations)
+
+
+def _allocation_key(conn, slurm_args):
+    return f"{conn.user}@{conn.host}:" + hashlib.md5(slurm_args.encode("utf-8")).hexdigest()
+
+
+def find_allocation(conn, slurm_args):
+    """
+    Get the allocation for the slurm args, if there is one which is still alive, otherwise None.
+    """
+    key = _allocation_key(conn, slurm_args)
+    entry = _load_allocations().get(key, None)
+    if entry is None:
+        return None
+    allocation = Allocation(conn, entry["job_id"], key)
+    if time.time() - entry["last_used"] > entry["idle_timeout"] + IDLE_CHECK_INTERVAL or allocation.state() is None:
+        allocations = _load_allocations()
+        allocations.pop(key, None)
+        _save_allocations(allocations)
+        return None
+    return allocation
+
+
+def get_allocation(conn, slurm_args, idle_timeout=IDLE_TIMEOUT):
+    """
+    Reuse the allocation for the slurm args or submit a new placeholder job. Returns None if no allocation could be obtained.
+    """
+    allocation = find_allocation(conn, slurm_args)
+    if allocation is None:
+        proc = conn.popen(f"sbatch --parsable {slurm_args}", stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        output, _ = proc.communicate(allocation_script(idle_timeout).encode("utf-8"))
+        if proc.returncode != 0:
+            print("ERROR: Submitting the allocation failed.")
+            return None
+        job_id = output.decode("utf-8").strip().splitlines()[-1].split(";")[0]
+        key = _allocation_key(conn, slurm_args)
+        allocations = _load_allocations()
+        allocations[key] = {"job_id": job_id, "idle_timeout": idle_timeout, "last_used": time.time()}
+        _save_allocations(allocations)
+        allocation = Allocation(conn, job_id, key)
+        print(f"Submitted allocation {job_id}, it is released after {idle_timeout // 60} minutes without runs.")
+    if not allocation.wait_until_running():
+        print(f"ERROR: Allocation {allocation.job_id} ended.")
+        allocation.release()
+        return None
+    allocation.used()
+    return allocation
@@ -0,0 +1,213 @@
+"""doc
+# session.py
+
+> An asyncio API to sync once and then run many jobs on one or more hosts, e.g. for parameter sweeps.
+
+A session reads the host config and syncs the code once when it is entered, if that fails a RuntimeError is raised.
+Jobs are then run over the multiplexed ssh connection of their host without syncing again.
+Leaving the session waits for all jobs, unless it is left with an exception, then the remaining jobs are cancelled.
+Every job runs in its own process group on the remote (via `setsid`), which is killed when the job is cancelled.
+At most `max_jobs` jobs run per host at the same time, further jobs wait for a free slot on any host of the session.
+
+```
+import asyncio
+from rempy.session import Session
+
+async def sweep():
+    async with Session("example.com", max_jobs=4) as session:
+        jobs = [session.submit("train.py", f"--lr={lr}") for lr in [0.1, 0.01, 0.001]]
+        for job in await session.wait(jobs):
+            print(job.args, job.returncode, f"{job.duration:.1f}s", job.output.getvalue()[-200:])
+
+asyncio.run(sweep())
+```
+
+The output of a job (stdout and stderr) is written to its own handle as it arrives, an `io.StringIO` unless another file-like object is given.
+Hosts can be a single host, a list of hosts or a host group of the config (see `rempy.config.get_hosts`).
+
+License: MIT (see main license)
+Authors:
+* Michael Fuerst (Lead)
+"""
+import io
+import os
+import time
+import shlex
+import codecs
+import asyncio
+from uuid import uuid4
+
+from rempy.config import create_sync_manager, get_hosts
+from rempy.runtime.remote_cli import snapshot_command
+from rempy.sync.hashing import DEFAULT_ALGORITHM
+from rempy.sync.manager import MultiSyncManager
+
+
+JOBS_FOLDER = "$HOME/.rempy_cache/jobs"
+
+
+class Job(object):
+    def __init__(self, script, args, launcher, output):
+        self.script = script
+        self.args = args
+        self.launcher = launcher
+        self.output = output if output is not None else io.StringIO()
+        self.host = None
+        self.returncode = None
+        self.submitted = time.time()
+        self.started = None
+        self.finished = None
+        self._task = None
+        # The remote writes the id of the process group of the job in here.
+        self._pgid_file = f"{JOBS_FOLDER}/{uuid4().hex}.pgid"
+
+    @property
+    def wait_time(self):
+        """
+        Seconds the job waited for a free slot.
+        """
+        if self.started is None:
+            return None
+        return self.started - self.submitted
+
+    @property
+    def duration(self):
+        """
+        Seconds the job ran.
+        """
+        if self.started is None or self.finished is None:
+            return None
+        return self.finished - self.started
+
+    async def wait(self):
+        await self._task
+        return self
+
+    def cancel(self):
+        self._task.cancel()
+
+
+class Session(object):
+    def __init__(self, host, user=None, local_workdir=None, remote_path=None, package_name=None, hash=DEFAULT_ALGORITHM, ssh_args="", compression=None, verify=False, max_jobs=1, pre_launch="", run_path=""):
+        """
+        Create a session for a host, a list of hosts or a host group, see the class docs.
+
+        The remote path defaults to the remote_path of each host in the config.
+        With a run_path, every job runs in its own snapshot of the code (see `rempy.runtime.remote_cli.snapshot_command`).
+        """
+        if isinstance(host, str):
+            host = get_hosts(host)
+        if user is None:
+            user = os.environ["USER"]
+        if local_workdir is None:
+            local_workdir = os.getcwd()
+        if package_name is None:
+            package_name = os.path.basename(os.path.abspath(local_workdir))
+        self._managers = [create_sync_manager(h, user, local_workdir, remote_path, package_name, hash, ssh_args, compression, verify) for h in host]
+        self._max_jobs = max_jobs
+        self._pre_launch = pre_launch
+        self._run_path = run_path
+        self._slots = None
+        self._jobs = []
+
+    async def __aenter__(self):
+        if not await self.sync():
+            # Jobs would run against stale code.
+            failed = [m.host for m in self._managers if not m.in_sync]
+            raise RuntimeError(f"Syncing the code to {', '.join(failed)} failed.")
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            await self.wait()
+        await self.close()
+
+    async def sync(self):
+        """
+        Sync the code to all hosts of the session. Returns if all hosts are in sync.
+        """
+        if len(self._managers) > 1:
+            manager = MultiSyncManager(self._managers)
+        else:
+            manager = self._managers[0]
+        await asyncio.get_running_loop().run_in_executor(None, manager.sync)
+        return all(m.in_sync for m in self._managers)
+
+    def submit(self, script, args="", launcher="python", output=None):
+        """
+        Queue a job and return its Job handle right away. Must be called while the event loop is running.
+        """
+        if self._slots is None:
+            self._slots = asyncio.Queue()
+            for _ in range(self._max_jobs):
+                for manager in self._managers:
+                    self._slots.put_nowait(manager)
+        job = Job(script, args, launcher, output)
+        job._task = asyncio.ensure_future(self._run(job))
+        self._jobs.append(job)
+        return job
+
+    async def run(self, script, args="", launcher="python", output=None):
+        """
+        Run a job and return its Job handle once it finished.
+        """
+        return await self.submit(script, args, launcher, output).wait()
+
+    async def wait(self, jobs=None):
+        """
+        Wait for the given jobs (default all submitted jobs) and return them.
+        """
+        if jobs is None:
+            jobs = list(self._jobs)
+        await asyncio.gather(*[job._task for job in jobs], return_exceptions=True)
+        return jobs
+
+    async def close(self):
+        """
+        Cancel all jobs which did not finish yet.
+        """
+        for job in self._jobs:
+            job.cancel()
+        await asyncio.gather(*[job._task for job in self._jobs], return_exceptions=True)
+
+    def _command(self, manager, job):
+        workdir = manager.remote_dir
+        command = ""
+        if self._run_path != "":
+            # Jobs start within the same second, so the timestamp alone is not unique.
+            run_path = os.path.join(self._run_path, f"{time.strftime('%Y-%m-%d_%H%M%S')}_{id(job):x}")
+            command = f"{snapshot_command(workdir, run_path, python=manager.python)} && "
+            workdir = run_path
+        pre_launch = f"{self._pre_launch} && " if self._pre_launch != "" else ""
+        command = f"echo $$ > {job._pgid_file} && {command}cd {workdir} && {pre_launch}{job.launcher} {job.script} {job.args}"
+        # In its own process group, so cancelling the job can kill everything it started on the remote.
+        return f"mkdir -p {JOBS_FOLDER} && setsid sh -c {shlex.quote(command)}; code=$?; rm -f {job._pgid_file}; exit $code"
+
+    async def _kill(self, manager, job):
+        command = f"test -f {job._pgid_file} && kill -TERM -- -$(cat {job._pgid_file}); rm -f {job._pgid_file}"
+        proc = await asyncio.create_subprocess_shell(manager.connection.ssh(command), stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.DEVNULL, stderr=asyncio.subprocess.DEVNULL)
+        await proc.wait()
+
+    async def _run(self, job):
+        manager = await self._slots.get()
+        proc = None
+        try:
+            job.host = manager.host
+            job.started = time.time()
+            proc = await asyncio.create_subprocess_shell(manager.connection.ssh(self._command(manager, job)), stdin=asyncio.subprocess.DEVNULL, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.STDOUT)
+            decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+            while True:
+                data = await proc.stdout.read(64 * 1024)
+                if not data:
+                    break
+                job.output.write(decoder.decode(data))
+            job.output.write(decoder.decode(b"", final=True))
+            job.returncode = await proc.wait()
+        finally:
+            if proc is not None and proc.returncode is None:
+                # Cancelled, killing ssh does not stop the remote processes.
+                proc.kill()
+                await proc.wait()
+                await self._kill(manager, job)
+            job.finished = time.time()
+            self._slots.put_nowait(manager)
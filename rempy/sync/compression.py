@@ -0,0 +1,159 @@
+"""doc
+# compression.py
+
+> Decides how to compress which part of a patch and compresses the patch stream in parallel.
+
+A policy is given as `codec:level`, e.g. `gzip:6` (default), `gzip:1` for fast links, `zstd:3` or `none` for a LAN.
+`zstd` requires the zstandard package locally (`pip install zstandard`) and the zstd command on the remote.
+
+Files which do not compress (by extension or since a sample of the file does not compress) are only stored.
+The stream is cut into chunks of about 1 MB, each chunk is compressed independently in a thread pool.
+Chunks become concatenated gzip members or zstd frames, which the remote decompresses as one stream.
+
+```
+policy = CompressionPolicy.parse("gzip:6")
+policy.compressible("model.pt")  # False
+for data in policy.compress([(b"raw tar data", True)]):
+    pipe.write(data)
+```
+
+License: MIT (see main license)
+Authors:
+* Michael Fuerst (Lead)
+"""
+import os
+import gzip
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+CODECS = ["gzip", "zstd", "none"]
+DEFAULT_COMPRESSION = "gzip:6"
+INCOMPRESSIBLE_EXTENSIONS = {
+    ".zip", ".gz", ".tgz", ".bz2", ".xz", ".lz4", ".zst", ".7z", ".rar", ".whl", ".jar",
+    ".jpg", ".jpeg", ".png", ".gif", ".webp", ".mp3", ".ogg", ".flac", ".mp4", ".mkv", ".avi", ".mov", ".webm",
+    ".npy", ".npz", ".pt", ".pth", ".ckpt", ".safetensors", ".onnx", ".tfrecord", ".parquet", ".pdf",
+}
+SAMPLE_SIZE = 64 * 1024
+# If a sample does not shrink below this ratio with fast compression, the file is considered incompressible.
+MIN_SAMPLE_RATIO = 0.9
+CHUNK_SIZE = 1024 * 1024
+
+
+class CompressionPolicy(object):
+    def __init__(self, codec="gzip", level=6, workers=None):
+        if codec not in CODECS:
+            raise NotImplementedError(f"No compression '{codec}' implemented.")
+        if codec == "zstd":
+            try:
+                import zstandard
+            except ImportError:
+                raise RuntimeError("The compression 'zstd' requires the zstandard package: 'pip install zstandard'.")
+        self.codec = codec
+        self.level = level
+        self.workers = workers if workers is not None else min(8, os.cpu_count() or 1)
+
+    @staticmethod
+    def parse(spec):
+        """
+        Create a policy from a string like 'gzip:6', 'zstd' or 'none'.
+        """
+        codec, _, level = spec.partition(":")
+        if level == "":
+            level = {"gzip": 6, "zstd": 3}.get(codec, 0)
+        return CompressionPolicy(codec, int(level))
+
+    @property
+    def tar_flags(self):
+        """
+        The flags for the remote 'tar' to read the stream produced by compress.
+        """
+        return "-xzf" if self.codec == "gzip" else "-xf"
+
+    @property
+    def remote_decompress(self):
+        """
+        A command the stream must be piped through on the remote before tar or an empty string.
+        """
+        return "zstd -d -c | " if self.codec == "zstd" else ""
+
+    @property
+    def remote_compress(self):
+        """
+        A command a stream produced on the remote is piped through to compress it (e.g. when pulling files) or an empty string.
+        """
+        if self.codec == "none" or self.level == 0:
+            return ""
+        if self.codec == "zstd":
+            return f" | zstd -q -c -{self.level}"
+        return f" | gzip -c -{self.level}"
+
+    def decompress_stream(self, f):
+        """
+        Wrap a file object reading a stream compressed by remote_compress, so it reads the decompressed stream.
+        """
+        if self.codec == "none" or self.level == 0:
+            return f
+        if self.codec == "zstd":
+            import zstandard
+            return zstandard.ZstdDecompressor().stream_reader(f)
+        return gzip.GzipFile(fileobj=f, mode="rb")
+
+    def compressible(self, path):
+        if self.codec == "none" or self.level == 0:
+            return False
+        if os.path.splitext(path)[1].lower() in INCOMPRESSIBLE_EXTENSIONS:
+            return False
+        try:
+            with open(path, "rb") as f:
+                sample = f.read(SAMPLE_SIZE)
+        except OSError:
+            return True
+        if len(sample) < 512:
+            return True
+        return len(zlib.compress(sample, 1)) < MIN_SAMPLE_RATIO * len(sample)
+
+    def _compress_chunk(self, data, compress):
+        if self.codec == "gzip":
+            compressor = zlib.compressobj(self.level if compress else 0, zlib.DEFLATED, 31)
+            return compressor.compress(data) + compressor.flush()
+        import zstandard
+        # zstd has no store mode, the fastest negative level is closest to it.
+        level = self.level if compress else -7
+        return zstandard.ZstdCompressor(level=level).compress(data)
+
+    def _chunks(self, pieces):
+        buffer = []
+        size = 0
+        mode = None
+        for data, compress in pieces:
+            if not data:
+                continue
+            if mode is not None and (compress != mode or size >= CHUNK_SIZE):
+                yield b"".join(buffer), mode
+                buffer, size = [], 0
+            buffer.append(data)
+            size += len(data)
+            mode = compress
+        if size > 0:
+            yield b"".join(buffer), mode
+
+    def compress(self, pieces):
+        """
+        Compress a stream of (data, compressible) pieces, yielding the compressed stream in order.
+        """
+        if self.codec == "none":
+            for data, _ in pieces:
+                if data:
+                    yield data
+            return
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            pending = deque()
+            for data, compress in self._chunks(pieces):
+                pending.append(pool.submit(self._compress_chunk, data, compress))
+                # Bound the memory used by chunks waiting for compression.
+                while len(pending) > 2 * self.workers:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
@@ -0,0 +1,266 @@
+"""doc
+# delta.py
+
+> Block level deltas, so a small edit of a large file only transfers the changed blocks.
+
+Files above a size threshold, which already exist on the remote, are not sent as a whole.
+Instead the block signature of the remote version (a hash for every block) is compared to the blocks of the local file.
+Only blocks the remote does not have are sent, together with instructions how to rebuild the file (see `rempy/remote/apply_delta.py`).
+
+Signatures only depend on the content, so they are cached in `~/.rempy_cache/signatures` by the hash in the manifest.
+When rempy sent a delta, it already knows the signature of the new remote version and does not need to ask the remote next time.
+
+Like rsync, a weak rolling checksum (adler32) slides over the local file byte by byte and candidates are confirmed by the block hash.
+So besides edits in place and moved blocks, blocks shifted by an insertion or a deletion (e.g. one line added to a large CSV) are found as well.
+Regions far from any match (e.g. a rewritten checkpoint) are only searched in samples, so a file that changed completely is given up quickly.
+
+License: MIT (see main license)
+Authors:
+* Michael Fuerst (Lead)
+"""
+import os
+import zlib
+import json
+import hashlib
+from json.decoder import JSONDecodeError
+
+from rempy.remote import remote_python
+from rempy.sync.hashing import BUFFER_SIZE
+
+
+DELTA_THRESHOLD = 32 * 1024 * 1024
+BLOCK_SIZE = 256 * 1024
+SIGNATURE_FOLDER = os.path.join(os.path.expanduser("~"), ".rempy_cache", "signatures")
+DELTA_FOLDER = ".rempy_delta"
+# If a delta would transfer more than this fraction of the file, the whole file is sent instead.
+MAX_LITERAL_RATIO = 0.8
+# How far after the last match every byte offset is searched, further away only one block in SKIP_BLOCKS is.
+SEARCH_BLOCKS = 4
+SKIP_BLOCKS = 32
+
+
+def block_hash(data):
+    return hashlib.blake2b(data, digest_size=16).hexdigest()
+
+
+def _signature_path(file_hash, algorithm):
+    return os.path.join(SIGNATURE_FOLDER, f"{algorithm}_{file_hash}.json")
+
+
+def load_signature(file_hash, algorithm):
+    path = _signature_path(file_hash, algorithm)
+    if not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r") as f:
+            signature = json.loads(f.read())
+    except (OSError, JSONDecodeError):
+        return None
+    # Signatures cached by older versions have no weak checksums.
+    return signature if "weak" in signature else None
+
+
+def save_signature(file_hash, algorithm, signature):
+    os.makedirs(SIGNATURE_FOLDER, exist_ok=True)
+    path = _signature_path(file_hash, algorithm)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        f.write(json.dumps(signature))
+    os.replace(tmp_path, path)
+
+
+def file_signature(path, block_size=BLOCK_SIZE):
+    """
+    Compute the signature of a file like the remote does (see `rempy/remote/signature.py`).
+    """
+    blocks = []
+    weak = []
+    size = 0
+    with open(path, "rb") as f:
+        while True:
+            block = f.read(block_size)
+            if not block:
+                break
+            size += len(block)
+            blocks.append(block_hash(block))
+            weak.append(zlib.adler32(block))
+    return {"block_size": block_size, "size": size, "blocks": blocks, "weak": weak}
+
+
+class Delta(object):
+    def __init__(self, path, signature):
+        """
+        Compute how to turn the remote version of a file (described by its signature) into the local file at path.
+        """
+        self._path = path
+        block_size = signature["block_size"]
+        remote_blocks = {}
+        for i, (w, h) in enumerate(zip(signature["weak"], signature["blocks"])):
+            remote_blocks.setdefault(w, {}).setdefault(h, i)
+        self._ops = []
+        self._used = {}
+        self._literals = []
+        self.file_size = os.path.getsize(path)
+        # Scanning gives up once the delta could not be used anyway.
+        max_literal = MAX_LITERAL_RATIO * self.file_size
+        literal_start = self._scan(remote_blocks, block_size, max_literal)
+        if literal_start is None:
+            # Not worth it, the whole file is sent instead.
+            self._literals = [[0, self.file_size]]
+            self.literal_size = self.file_size
+            self.signature = None
+            self._header = b""
+        else:
+            self._match_tail(signature, literal_start)
+            self.literal_size = sum(length for _, length in self._literals)
+            self.signature = file_signature(path, block_size)
+            result_hash = hashlib.blake2b(digest_size=16)
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(BUFFER_SIZE), b""):
+                    result_hash.update(chunk)
+            header = {"block_size": block_size, "ops": self._ops, "blocks": self._used, "hash": result_hash.hexdigest()}
+            self._header = (json.dumps(header) + "\n").encode("utf-8")
+        self.size = len(self._header) + self.literal_size
+
+    def _copy(self, j, h):
+        if self._ops and self._ops[-1][0] == "c" and self._ops[-1][1] + self._ops[-1][2] == j:
+            self._ops[-1][2] += 1
+        else:
+            self._ops.append(["c", j, 1])
+        self._used[str(j)] = h
+
+    def _literal(self, offset, length):
+        if length <= 0:
+            return
+        self._ops.append(["l", length])
+        self._literals.append([offset, length])
+
+    def _scan(self, remote_blocks, block_size, max_literal):
+        # Like rsync: the weak checksum of the window rolls along byte by byte and candidates are confirmed by the block hash.
+        # Returns where the unmatched rest of the file starts or None if too much of the file is unmatched.
+        literal_start = 0
+        literal_size = 0
+        pos = 0
+        search_until = SEARCH_BLOCKS * block_size
+        weak = None
+        buffer = b""
+        base = 0
+        size = self.file_size
+        with open(self._path, "rb") as f:
+            while pos + block_size <= size:
+                if pos + block_size + 1 > base + len(buffer):
+                    if pos > base + len(buffer):
+                        f.seek(pos)
+                        buffer = b""
+                    else:
+                        buffer = buffer[pos - base:]
+                    buffer += f.read(max(BUFFER_SIZE, 2 * block_size))
+                    base = pos
+                    if pos + block_size > base + len(buffer):
+                        # The file shrunk while scanning, the remote will notice by the hash.
+                        break
+                i = pos - base
+                if weak is None:
+                    weak = zlib.adler32(buffer[i:i + block_size])
+                candidates = remote_blocks.get(weak, None)
+                if candidates is not None:
+                    h = block_hash(buffer[i:i + block_size])
+                    j = candidates.get(h, None)
+                    if j is not None:
+                        self._literal(literal_start, pos - literal_start)
+                        literal_size += pos - literal_start
+                        self._copy(j, h)
+                        pos += block_size
+                        literal_start = pos
+                        search_until = pos + SEARCH_BLOCKS * block_size
+                        weak = None
+                        continue
+                if literal_size + pos - literal_start > max_literal:
+                    return None
+                if pos + block_size == size:
+                    break
+                if pos >= search_until:
+                    # Far from the last match only every SKIP_BLOCKS-th block is searched, so a rewritten file is given up quickly.
+                    pos = min(pos + SKIP_BLOCKS * block_size, size - block_size)
+                    search_until = pos + block_size
+                    weak = None
+                    continue
+                # Roll the adler32 of the window further until it is a candidate, the search ends or the buffer does.
+                end = min(search_until, size - block_size, base + len(buffer) - block_size) - base
+                a = weak & 0xffff
+                b = weak >> 16
+                while i < end:
+                    old = buffer[i]
+                    a = (a - old + buffer[i + block_size]) % 65521
+                    b = (b - block_size * old - 1 + a) % 65521
+                    i += 1
+                    if (b << 16) | a in remote_blocks:
+                        break
+                weak = (b << 16) | a
+                pos = base + i
+        return literal_start
+
+    def _match_tail(self, signature, literal_start):
+        # The last remote block is usually shorter than a block, so the window never matches it.
+        last = signature["size"] % signature["block_size"]
+        j = len(signature["blocks"]) - 1
+        if last > 0 and self.file_size - literal_start >= last:
+            with open(self._path, "rb") as f:
+                f.seek(self.file_size - last)
+                tail = f.read(last)
+            h = block_hash(tail)
+            if h == signature["blocks"][j]:
+                self._literal(literal_start, self.file_size - last - literal_start)
+                self._copy(j, h)
+                return
+        self._literal(literal_start, self.file_size - literal_start)
+
+    def iter_chunks(self, chunk_size=1024 * 1024):
+        yield self._header
+        with open(self._path, "rb") as f:
+            for offset, length in self._literals:
+                f.seek(offset)
+                while length > 0:
+                    chunk = f.read(min(chunk_size, length))
+                    if not chunk:
+                        # The file shrunk since computing the delta, the remote will notice by the hash.
+                        chunk = b"\0" * length
+                    length -= len(chunk)
+                    yield chunk
+
+
+def fetch_signatures(conn, remote_dir, paths, python="python3", block_size=BLOCK_SIZE):
+    """
+    Compute the signatures of files (relative to remote_dir) on the remote.
+    """
+    data = conn.check_output(f"cd {remote_dir} && {remote_python('signature', [block_size] + paths, python)}")
+    if data is None:
+        return {}
+    try:
+        return json.loads(data)
+    except JSONDecodeError:
+        return {}
+
+
+def prepare_deltas(conn, folder, remote_dir, changed, server_hashes, algorithm, threshold=DELTA_THRESHOLD, python="python3"):
+    """
+    Compute the deltas for all changed files above the threshold, which also exist on the remote.
+
+    Returns a dict mapping the file to its Delta, files not in there must be sent as a whole.
+    """
+    candidates = [f for f in changed if server_hashes.get(f, None) is not None and os.path.getsize(os.path.join(folder, f)) >= threshold]
+    signatures = {f: load_signature(server_hashes[f], algorithm) for f in candidates}
+    missing = [f for f in candidates if signatures[f] is None]
+    if len(missing) > 0:
+        for f, signature in fetch_signatures(conn, remote_dir, missing, python).items():
+            if signature is not None:
+                save_signature(server_hashes[f], algorithm, signature)
+                signatures[f] = signature
+    deltas = {}
+    for f in candidates:
+        if signatures.get(f, None) is None:
+            continue
+        delta = Delta(os.path.join(folder, f), signatures[f])
+        if delta.literal_size <= MAX_LITERAL_RATIO * delta.file_size:
+            deltas[f] = delta
+    return deltas
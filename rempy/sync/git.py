@@ -0,0 +1,70 @@
+"""doc
+# git.py
+
+> Reads the hashes of unmodified files from the index of git, so a git checkout is not hashed again.
+
+With the `git` hash algorithm (see `rempy.sync.hashing`), the hash of a file is its git blob id.
+For every tracked file, which git reports as unmodified, the blob id is taken from the index (`git ls-files -s`) instead of reading the file.
+Only modified and untracked files are hashed, so scanning a checkout scales with the number of dirty files.
+Files git converts on checkout (line endings or filters like git-lfs) are hashed as well, as their blob differs from the file.
+
+```
+blobs = clean_blob_ids("/path/to/checkout")
+# blobs maps paths relative to the folder to their blob ids or is None if the folder is not in a git checkout.
+```
+
+License: MIT (see main license)
+Authors:
+* Michael Fuerst (Lead)
+"""
+import subprocess
+
+
+def _git(root, args, stdin=None):
+    try:
+        result = subprocess.run(["git"] + args, cwd=root, input=stdin, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    except OSError:
+        # No git installed.
+        return None
+    if result.returncode != 0:
+        return None
+    return result.stdout.decode("utf-8", "surrogateescape")
+
+
+def clean_blob_ids(root):
+    """
+    Get the blob ids of all tracked files below root, which are unmodified and stored in git as they are.
+    """
+    listing = _git(root, ["ls-files", "--stage", "--eol", "-z"])
+    if listing is None:
+        return None
+    blobs = {}
+    for entry in listing.split("\0"):
+        if entry == "":
+            continue
+        # "<mode> <blob> <stage>\ti/<eol> w/<eol> attr/<attributes>\t<path>"
+        stage, eol, path = entry.split("\t", 2)
+        mode, blob, number = stage.split(" ")
+        # Symlinks and submodules are synced by their content, which is not what git stores.
+        if mode not in ("100644", "100755") or number != "0":
+            continue
+        eol = eol.split(None, 2)
+        if len(eol) != 3 or eol[0][2:] != eol[1][2:] or eol[2].strip() != "attr/":
+            continue
+        blobs[path] = blob
+    if len(blobs) > 0:
+        # Filters (e.g. git-lfs) store something else than the file, they do not show in the eol attributes.
+        filters = _git(root, ["check-attr", "-z", "--stdin", "filter"], "\0".join(blobs).encode("utf-8", "surrogateescape"))
+        if filters is None:
+            return None
+        fields = filters.split("\0")
+        for i in range(0, len(fields) - 2, 3):
+            if fields[i + 2] != "unspecified":
+                blobs.pop(fields[i], None)
+    # Stat based, so a file that was only touched is hashed as well, which is safe.
+    modified = _git(root, ["diff-files", "--name-only", "--relative", "-z"])
+    if modified is None:
+        return None
+    for path in modified.split("\0"):
+        blobs.pop(path, None)
+    return blobs
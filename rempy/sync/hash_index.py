@@ -0,0 +1,124 @@
+"""doc
+# hash_index.py
+
+> A persistent index that remembers file hashes, so unchanged files are never hashed twice.
+
+Every entry is keyed by the path relative to the synced folder and stores `(size, mtime_ns, inode, hash)`.
+There is one index per folder and hash algorithm.
+When the stat tuple of a file still matches, the cached hash is reused.
+The index lives in `~/.rempy_cache/hash_index` and survives across invocations of rempy.
+An index is shared by all threads of a process (e.g. the hosts of a `MultiSyncManager`), so every access holds its lock.
+
+```
+index = HashIndex("/path/to/project", "md5")
+hash = index.lookup("main.py", os.stat("/path/to/project/main.py"))
+if hash is None:
+    hash = compute_the_hash()
+    index.update("main.py", os.stat("/path/to/project/main.py"), hash)
+index.evict(["main.py"])  # Drop all entries for files that are gone.
+index.save()
+```
+
+License: MIT (see main license)
+Authors:
+* Michael Fuerst (Lead)
+"""
+import os
+import json
+import time
+import hashlib
+import threading
+from json.decoder import JSONDecodeError
+
+
+INDEX_FOLDER = os.path.join(os.path.expanduser("~"), ".rempy_cache", "hash_index")
+# Files modified this recently are not cached, as a second write within the
+# timestamp resolution of the filesystem would go unnoticed (racy git problem).
+RACY_WINDOW_NS = 2 * 10**9
+
+
+def _stat_key(st):
+    return [st.st_size, st.st_mtime_ns, st.st_ino]
+
+
+class HashIndex(object):
+    def __init__(self, root, algorithm="md5", index_folder=INDEX_FOLDER):
+        root = os.path.abspath(root)
+        name = hashlib.md5(root.encode("utf-8")).hexdigest() + f"_{algorithm}.json"
+        self._index_path = os.path.join(index_folder, name)
+        self._root = root
+        self._algorithm = algorithm
+        self._entries = {}
+        self._dirty = False
+        self._lock = threading.RLock()
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self._index_path):
+            return
+        try:
+            with open(self._index_path, "r") as f:
+                data = json.loads(f.read())
+        except (OSError, JSONDecodeError):
+            return
+        if data.get("root") == self._root and data.get("algorithm", "md5") == self._algorithm:
+            self._entries = data.get("entries", {})
+
+    def lookup(self, path, st):
+        with self._lock:
+            entry = self._entries.get(path, None)
+        if entry is None or entry[:3] != _stat_key(st):
+            return None
+        return entry[3]
+
+    def update(self, path, st, file_hash):
+        with self._lock:
+            if st.st_mtime_ns >= time.time_ns() - RACY_WINDOW_NS:
+                self._entries.pop(path, None)
+            else:
+                self._entries[path] = _stat_key(st) + [file_hash]
+            self._dirty = True
+
+    def evict(self, keep):
+        keep = set(keep)
+        with self._lock:
+            stale = [path for path in self._entries if path not in keep]
+            for path in stale:
+                del self._entries[path]
+            self._dirty |= len(stale) > 0
+
+    def clear(self):
+        """
+        Forget all hashes, also on disk.
+        """
+        with self._lock:
+            self._entries = {}
+            self._dirty = False
+            if os.path.exists(self._index_path):
+                os.remove(self._index_path)
+
+    def save(self):
+        with self._lock:
+            if not self._dirty:
+                return
+            os.makedirs(os.path.dirname(self._index_path), exist_ok=True)
+            tmp_path = f"{self._index_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                f.write(json.dumps({"root": self._root, "algorithm": self._algorithm, "entries": self._entries}))
+            os.replace(tmp_path, self._index_path)
+            self._dirty = False
+
+
+_INDEXES = {}
+_INDEXES_LOCK = threading.Lock()
+
+
+def get_hash_index(root, algorithm="md5"):
+    """
+    Get the index for a folder, loading it from disk only once per process.
+    """
+    key = (os.path.abspath(root), algorithm)
+    with _INDEXES_LOCK:
+        if key not in _INDEXES:
+            _INDEXES[key] = HashIndex(root, algorithm)
+        return _INDEXES[key]
@@ -0,0 +1,96 @@
+"""doc
+# hashing.py
+
+> A hashing engine that hashes many files concurrently using large read buffers.
+
+The hash algorithm can be chosen.
+`md5` is the default and what older versions of rempy used, `blake2b` is faster on most machines and `xxh3` is fastest but requires the xxhash package (`pip install xxhash`).
+`git` computes the blob ids of git, so clean files of a git checkout do not need to be hashed at all (see `rempy.sync.git`).
+
+```
+hashes = hash_files(["a.txt", "b.txt"], algorithm="blake2b")
+# hashes is a list of hex digests in the same order as the paths.
+```
+
+License: MIT (see main license)
+Authors:
+* Michael Fuerst (Lead)
+"""
+import os
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+
+
+DEFAULT_ALGORITHM = "md5"
+HASH_ALGORITHMS = ["md5", "sha1", "sha256", "blake2b", "xxh3", "xxh64", "git"]
+BUFFER_SIZE = 1024 * 1024
+# Files at least this large are read with a hint to the kernel to read ahead aggressively.
+LARGE_FILE_SIZE = 64 * 1024 * 1024
+
+
+def get_hasher(algorithm, size=0):
+    """
+    Create a hasher for the algorithm, the size of the data is only needed for git blob ids.
+    """
+    if algorithm == "git":
+        hasher = hashlib.sha1()
+        hasher.update(b"blob %d\0" % size)
+        return hasher
+    if algorithm in ["xxh3", "xxh64"]:
+        try:
+            import xxhash
+        except ImportError:
+            raise RuntimeError(f"The hash algorithm '{algorithm}' requires the xxhash package: 'pip install xxhash'.")
+        return xxhash.xxh3_128() if algorithm == "xxh3" else xxhash.xxh64()
+    if algorithm == "blake2b":
+        return hashlib.blake2b(digest_size=16)
+    if algorithm not in HASH_ALGORITHMS:
+        raise NotImplementedError(f"No hash algorithm '{algorithm}' implemented.")
+    return hashlib.new(algorithm)
+
+
+def hash_file(path, algorithm=DEFAULT_ALGORITHM, buffer_size=BUFFER_SIZE):
+    buffer = bytearray(buffer_size)
+    view = memoryview(buffer)
+    with open(path, "rb", buffering=0) as f:
+        size = os.fstat(f.fileno()).st_size
+        hasher = get_hasher(algorithm, size)
+        if hasattr(os, "posix_fadvise") and size >= LARGE_FILE_SIZE:
+            os.posix_fadvise(f.fileno(), 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        while True:
+            n = f.readinto(buffer)
+            if not n:
+                break
+            hasher.update(view[:n])
+    return hasher.hexdigest()
+
+
+def _size(path):
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return 0
+
+
+def hash_files(paths, algorithm=DEFAULT_ALGORITHM, workers=None):
+    """
+    Hash a list of files concurrently.
+
+    Threads are used, as hashlib releases the GIL while hashing large buffers.
+    The largest files are hashed first, so a huge file does not end up hashed alone after all others are done.
+    """
+    if len(paths) == 0:
+        return []
+    get_hasher(algorithm)  # Fail early and not in a worker.
+    if workers is None:
+        workers = min(32, (os.cpu_count() or 1) + 4)
+    workers = min(workers, len(paths))
+    if workers <= 1:
+        return [hash_file(path, algorithm) for path in paths]
+    order = sorted(range(len(paths)), key=lambda i: _size(paths[i]), reverse=True)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        hashes = pool.map(lambda i: hash_file(paths[i], algorithm), order)
+        result = [None] * len(paths)
+        for i, file_hash in zip(order, hashes):
+            result[i] = file_hash
+        return result
@@ -0,0 +1,246 @@
+"""doc
+# ignore.py
+
+> Compiled gitignore style rules for `.syncignore` files and a fast tree walker using them.
+
+Every folder can contain a `.syncignore`, its rules apply to the folder and everything below it.
+The syntax is the one of `.gitignore`:
+* Blank lines and lines starting with `#` are skipped.
+* `*` matches anything but `/`, `?` matches one character and `[a-z]` a character range.
+* A pattern without a `/` matches a name in any folder below, e.g. `*.pyc` or `__pycache__`.
+* A pattern with a `/` at the start or in the middle is relative to the folder of the `.syncignore`, e.g. `/build` or `docs/generated`.
+* `**/` matches any number of folders, e.g. `data/**/*.npy`, and a trailing `/**` everything inside a folder.
+* A trailing `/` only matches folders, e.g. `logs/`.
+* A leading `!` includes a file again, which an earlier rule excluded. Files in an excluded folder cannot be included again.
+
+Rules of deeper folders take precedence and within a file the last matching rule wins.
+Folders starting with a `.` are never synced.
+Optionally the `.gitignore` files are read as well, the `.syncignore` of the same folder takes precedence.
+
+```
+matcher = IgnoreMatcher("/path/to/project", forbidden_list=["*.log"])
+for path, st in matcher.walk():
+    pass  # path is relative to the root and st is its os.stat_result.
+matcher.ignored("data/train.npy")
+```
+
+License: MIT (see main license)
+Authors:
+* Michael Fuerst (Lead)
+"""
+import os
+import re
+from functools import lru_cache
+
+
+PYTHON_IGNORE_LIST = ["__pycache__", "*.pyc", ".ipynb_checkpoints", ".git", ".svn", ".hg", "CSV", ".DS_Store", "*.egg-info"]
+SYNCIGNORE = ".syncignore"
+GITIGNORE = ".gitignore"
+
+
+def _translate(pattern):
+    regex = []
+    i = 0
+    n = len(pattern)
+    while i < n:
+        if pattern.startswith("**/", i) and (i == 0 or pattern[i - 1] == "/"):
+            regex.append("(?:.*/)?")
+            i += 3
+        elif pattern.startswith("**", i) and i + 2 == n and (i == 0 or pattern[i - 1] == "/"):
+            regex.append(".*")
+            i += 2
+        elif pattern[i] == "*":
+            regex.append("[^/]*")
+            i += 1
+        elif pattern[i] == "?":
+            regex.append("[^/]")
+            i += 1
+        elif pattern[i] == "[" and pattern.find("]", i + 2) >= 0:
+            end = pattern.find("]", i + 2)
+            content = pattern[i + 1:end].replace("\\", "\\\\")
+            if content[0] == "!":
+                content = "^" + content[1:]
+            regex.append(f"[{content}]")
+            i = end + 1
+        elif pattern[i] == "\\" and i + 1 < n:
+            regex.append(re.escape(pattern[i + 1]))
+            i += 2
+        else:
+            regex.append(re.escape(pattern[i]))
+            i += 1
+    return "".join(regex)
+
+
+@lru_cache(maxsize=4096)
+def compile_rule(line):
+    """
+    Compile a line of a .syncignore into (regex, negate, dir_only) or None if it is no rule.
+    """
+    line = line.rstrip("\n\r")
+    if not line.endswith("\\ "):
+        line = line.rstrip(" ")
+    if line == "" or line.startswith("#"):
+        return None
+    negate = line.startswith("!")
+    if negate:
+        line = line[1:]
+    elif line.startswith("\\!") or line.startswith("\\#"):
+        line = line[1:]
+    dir_only = line.endswith("/")
+    line = line.rstrip("/")
+    if line == "":
+        return None
+    anchored = "/" in line
+    line = line.lstrip("/")
+    prefix = "" if anchored else "(?:.*/)?"
+    return re.compile(f"{prefix}{_translate(line)}\\Z"), negate, dir_only
+
+
+def compile_rules(lines, base=""):
+    """
+    Compile a list of patterns relative to the folder base (relative to the root, "" for the root itself).
+    """
+    rules = []
+    for line in lines:
+        rule = compile_rule(line)
+        if rule is not None:
+            rules.append((base,) + rule)
+    return tuple(rules)
+
+
+_SYNCIGNORE_CACHE = {}
+
+
+def read_syncignore(folder, base, name=SYNCIGNORE):
+    """
+    Read and compile the .syncignore (or another ignore file) of a folder, reusing the compiled rules as long as the file did not change.
+    """
+    path = os.path.join(folder, name)
+    try:
+        st = os.stat(path)
+    except OSError:
+        return ()
+    key = (path, base)
+    cached = _SYNCIGNORE_CACHE.get(key, None)
+    if cached is not None and cached[0] == (st.st_mtime_ns, st.st_size):
+        return cached[1]
+    with open(path, "r") as f:
+        rules = compile_rules(f.read().split("\n"), base)
+    _SYNCIGNORE_CACHE[key] = ((st.st_mtime_ns, st.st_size), rules)
+    return rules
+
+
+def match(rules, path, is_dir):
+    """
+    Check if rules exclude a path (relative to the root). The last matching rule decides.
+    """
+    for base, regex, negate, dir_only in reversed(rules):
+        if dir_only and not is_dir:
+            continue
+        if base != "":
+            if not path.startswith(base + "/"):
+                continue
+            relative = path[len(base) + 1:]
+        else:
+            relative = path
+        if regex.match(relative):
+            return not negate
+    return False
+
+
+class IgnoreMatcher(object):
+    def __init__(self, root, forbidden_list=[], gitignore=False):
+        self._root = os.path.abspath(root)
+        self._global_rules = compile_rules(PYTHON_IGNORE_LIST + list(forbidden_list))
+        self._gitignore = gitignore
+
+    def _rules_for(self, folder, parent_rules):
+        path = os.path.join(self._root, folder)
+        if self._gitignore:
+            parent_rules = parent_rules + read_syncignore(path, folder, GITIGNORE)
+        return parent_rules + read_syncignore(path, folder)
+
+    def ignored(self, path, is_dir=False):
+        """
+        Check if a file (or folder) given relative to the root is excluded, also checking all its parent folders.
+        """
+        parts = path.split("/")
+        rules = self._rules_for("", self._global_rules)
+        folder = ""
+        for i, name in enumerate(parts):
+            current = name if folder == "" else folder + "/" + name
+            current_is_dir = is_dir or i < len(parts) - 1
+            if current_is_dir and name.startswith("."):
+                return True
+            if match(rules, current, current_is_dir):
+                return True
+            if i < len(parts) - 1:
+                rules = self._rules_for(current, rules)
+            folder = current
+        return False
+
+    def walk(self, folder=""):
+        """
+        List all files which are not excluded as (path, stat) tuples, optionally only below a folder (relative to the root).
+
+        Uses os.scandir and every file is stat'ed only once, so hashing can reuse the results.
+        """
+        result = []
+        if folder == "":
+            rules = self._rules_for("", self._global_rules)
+        else:
+            rules = self._global_rules
+            parts = folder.split("/")
+            for i in range(len(parts) + 1):
+                rules = self._rules_for("/".join(parts[:i]), rules)
+        stack = [(folder, rules)]
+        while stack:
+            current, rules = stack.pop()
+            try:
+                entries = list(os.scandir(os.path.join(self._root, current)))
+            except OSError:
+                continue
+            for entry in entries:
+                path = entry.name if current == "" else current + "/" + entry.name
+                try:
+                    is_dir = entry.is_dir()
+                    if is_dir:
+                        # Like os.walk, symlinks to folders are not followed.
+                        if entry.is_symlink() or entry.name.startswith(".") or match(rules, path, True):
+                            continue
+                        stack.append((path, self._rules_for(path, rules)))
+                    elif not match(rules, path, False):
+                        result.append((path, entry.stat()))
+                except OSError:
+                    # The entry vanished or is a broken symlink.
+                    continue
+        result.sort(key=lambda item: item[0])
+        return result
+
+    def empty_folders(self):
+        """
+        List all folders (relative to the root) which contain no files that are not excluded, not even in subfolders.
+        """
+        folders = set()
+        non_empty = set()
+        stack = [("", self._rules_for("", self._global_rules))]
+        while stack:
+            current, rules = stack.pop()
+            folders.add(current)
+            try:
+                entries = list(os.scandir(os.path.join(self._root, current)))
+            except OSError:
+                continue
+            for entry in entries:
+                path = entry.name if current == "" else current + "/" + entry.name
+                if entry.is_dir(follow_symlinks=False):
+                    if not entry.name.startswith(".") and not match(rules, path, True):
+                        stack.append((path, self._rules_for(path, rules)))
+                elif not match(rules, path, False):
+                    parent = current
+                    while parent not in non_empty:
+                        non_empty.add(parent)
+                        if parent == "":
+                            break
+                        parent = parent.rsplit("/", 1)[0] if "/" in parent else ""
+        return sorted(folders - non_empty)
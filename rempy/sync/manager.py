@@ -10,55 +10,359 @@ Authors:
 import os
 import json
 import time
+from concurrent.futures import ThreadPoolExecutor
 from json.decoder import JSONDecodeError
 
-from rempy.sync.patcher import pack_patch
+from rempy.connection import get_connection
+from rempy.profiling import count_bytes, phase
+from rempy.sync.compression import DEFAULT_COMPRESSION, CompressionPolicy
+from rempy.sync.delta import DELTA_THRESHOLD, prepare_deltas, save_signature
+from rempy.sync.hashing import DEFAULT_ALGORITHM
+from rempy.sync.merkle import fetch_remote_hashes
+from rempy.sync.patcher import compute_patch, compute_incremental_patch, dump_manifest, dump_patch_info, defer_large_files, get_files_hash_map, iter_patch, pack_files, load_manifest, load_pending, update_files_hash_map
+from rempy.sync.transport import PARALLEL_MIN_SIZE, send_sharded, send_stream, send_stream_fanout, send_zip, split_shards
+from rempy.sync.verify import verify_remote
+from rempy.sync.watcher import create_watcher
 
 
 class SyncManager(object):
-    def __init__(self, host, user, local_workdir, remote_workdir, package_name):
-        self._conn = None
+    def __init__(self, host, user, local_workdir, remote_workdir, package_name, hash_algorithm=DEFAULT_ALGORITHM, ssh_args="", transport="stream", delta_threshold=DELTA_THRESHOLD, python="python3", compression=DEFAULT_COMPRESSION, parallel_streams=1, verify=False, lazy_threshold=0, gitignore=False, connection=None):
+        self._conn = connection if connection is not None else get_connection(host, user, ssh_args)
+        self._verify = verify
+        self._transport = transport
+        self._delta_threshold = delta_threshold
+        self._python = python
+        self._policy = CompressionPolicy.parse(compression)
+        self._parallel_streams = parallel_streams
+        self._lazy_threshold = lazy_threshold
+        self._gitignore = gitignore
+        self._pending = {}
         self._host = host
         self._user = user
         self._local_workdir = local_workdir
         self._remote_workdir = remote_workdir
         self._package_name = package_name
+        self._hash_algorithm = hash_algorithm
+        self._remote_algorithm = hash_algorithm
+        self._in_sync = False
+        # Set when a patch failed, the remote might have changed in between (see `rempy/remote/commit_staging.py`).
+        self._stale = False
 
-    def _run(self, cmd):
-        print(f"> {cmd}")
-        os.system(cmd)
-    
-    def _get_remote_hashes(self):
-        local_hash_path = os.path.join(self._local_workdir, ".md5.json")
-        self._run(f"scp {self._user}@{self._host}:{self._remote_workdir}/{self._package_name}/.md5.json {local_hash_path}")
-        data = ""
-        if os.path.exists(local_hash_path):
-            with open(local_hash_path, "r") as f:
-                data = f.read()
-            os.remove(local_hash_path)
+    @property
+    def host(self):
+        return self._host
+
+    @property
+    def remote_dir(self):
+        return f"{self._remote_workdir}/{self._package_name}"
+
+    @property
+    def connection(self):
+        return self._conn
+
+    @property
+    def python(self):
+        return self._python
+
+    @property
+    def in_sync(self):
+        return self._in_sync
+
+    def _get_remote_hashes(self, local_hashes=None):
+        self._stale = False
+        with phase("manifest", self._host) as manifest:
+            # Only the folders which differ from the local hashes are sent (see rempy.sync.merkle).
+            result = fetch_remote_hashes(self._conn, self.remote_dir, local_hashes, self._hash_algorithm, self._python, manifest)
+        if result is not None:
+            hashes, algorithm, self._pending = result
+            self._remote_algorithm = algorithm if algorithm is not None else self._hash_algorithm
+            return self._verify_remote(hashes)
+        with phase("manifest", self._host) as manifest:
+            data = self._conn.check_output(f"cat {self._remote_workdir}/{self._package_name}/.md5.json")
+            manifest.add("bytes", len(data) if data is not None else 0)
+        if data is not None:
             try:
-                return json.loads(data)
+                hashes, self._remote_algorithm = load_manifest(data)
+                self._pending = load_pending(data)
+                return self._verify_remote(hashes)
             except JSONDecodeError:
                 pass
         print(f"No valid json from server: {data}")
+        self._remote_algorithm = self._hash_algorithm
+        self._pending = {}
         return {}
 
-    def sync(self, hashes=None):
-        if hashes is None:
-            hashes = self._get_remote_hashes()
-        patch_path, deleted, hashes = pack_patch(self._local_workdir, hashes)
-        if patch_path is not None:
-            self._run(f"ssh {self._user}@{self._host} \"mkdir -p {self._remote_workdir}\"")
-            self._run(f"scp {patch_path} {self._user}@{self._host}:{self._remote_workdir}/patch.zip")
-            self._run(f"ssh {self._user}@{self._host} \"cd {self._remote_workdir} && unzip -q -o patch.zip -d '{self._package_name}' && rm patch.zip\"")
-            self._run(f"rm {patch_path}")
-            if len(deleted) > 0:
-                deleted = " ".join(deleted)
-                self._run(f"ssh {self._user}@{self._host} \"cd {self._remote_workdir} && rm -rf {deleted}\"")
+    def _verify_remote(self, hashes):
+        if self._verify and len(hashes) > 0:
+            with phase("verify", self._host) as verify:
+                for f in verify_remote(self._conn, self.remote_dir, self._python) or []:
+                    # Unlike a missing entry, this also works if the file was deleted locally.
+                    hashes[f] = None
+                    verify.add("drifted")
         return hashes
 
-    def watch(self, check_interval):
-        old_hashes = self.sync()
+    @property
+    def pending(self):
+        """
+        The files held back by the last lazy sync with their local hashes.
+
+        Read from the manifest of the remote when its hashes are fetched, so this includes files held back by an earlier call of rempy.
+        """
+        return self._pending
+
+    def sync(self, hashes=None, paths=None, local_hashes=None, lazy=False):
+        """
+        Sync the local folder to the remote and return the hashes the remote has afterwards.
+
+        When the hashes returned by the previous sync are given, only the changed paths (relative to the local folder) are checked.
+        If the previous sync failed, the hashes of the remote are fetched again and all files are checked.
+        The local hashes can be given if they are already known, then the local folder is not scanned.
+        A lazy sync holds back changed files of at least lazy_threshold bytes, they are sent by the next sync that is not lazy (e.g. before a run).
+        """
+        with phase("sync", self._host):
+            return self._sync(hashes, paths, local_hashes, lazy)
+
+    def _sync(self, hashes, paths, local_hashes, lazy):
+        if hashes is None or self._stale:
+            if local_hashes is None:
+                # Scanned first, so only the folders that differ are fetched from the remote.
+                local_hashes = get_files_hash_map(self._local_workdir, [], algorithm=self._hash_algorithm, gitignore=self._gitignore)
+            hashes = self._get_remote_hashes(local_hashes)
+        remote_dir = self.remote_dir
+        success = True
+        if paths is not None and self._in_sync and local_hashes is None:
+            changed, deleted, should_be = compute_incremental_patch(self._local_workdir, hashes, paths, algorithm=self._hash_algorithm, gitignore=self._gitignore)
+        else:
+            changed, deleted, should_be = compute_patch(self._local_workdir, hashes, algorithm=self._hash_algorithm, server_algorithm=self._remote_algorithm, local_hashes=local_hashes, gitignore=self._gitignore)
+        changed, should_be, pending = self._defer(changed, deleted, hashes, should_be, lazy)
+        if changed is not None:
+            if self._transport == "zip":
+                patch_path = pack_files(self._local_workdir, changed, deleted, should_be, self._hash_algorithm, self._policy, pending=pending, base=hashes)
+                success = send_zip(self._conn, remote_dir, patch_path, self._python)
+            else:
+                success = self._send_stream(remote_dir, hashes, changed, deleted, should_be, pending)
+        if success:
+            self._pending = pending
+        return self._finish(success, hashes, should_be)
+
+    def _defer(self, changed, deleted, hashes, should_be, lazy):
+        if changed is not None and not lazy and len(self._pending) > 0:
+            print(f"Sending {len(self._pending)} large files held back by an earlier sync to {self._host}.")
+        if changed is None or not lazy or self._lazy_threshold <= 0 or self._remote_algorithm != self._hash_algorithm:
+            return changed, should_be, {}
+        changed, should_be, pending = defer_large_files(self._local_workdir, changed, hashes, should_be, self._lazy_threshold)
+        if len(pending) > 0 and pending != self._pending:
+            size = sum(os.path.getsize(os.path.join(self._local_workdir, f)) for f in pending)
+            print(f"Holding back {len(pending)} large files ({size / 1024**2:.1f} MB) from {self._host}, they are sent before the next run.")
+        if len(changed) == 0 and len(deleted) == 0 and pending == self._pending:
+            # Only send a patch if the listing of the pending files in the manifest changes.
+            return None, should_be, pending
+        return changed, should_be, pending
+
+    def _finish(self, success, hashes, should_be):
+        self._in_sync = success
+        if not success:
+            # Keep the old state, the next sync compares to the hashes the remote has then.
+            print(f"ERROR: Failed to apply the patch on {self._host}.")
+            self._stale = True
+            return hashes
+        self._remote_algorithm = self._hash_algorithm
+        return should_be
+
+    def _send_stream(self, remote_dir, hashes, changed, deleted, should_be, pending):
+        manifest = dump_manifest(should_be, self._hash_algorithm, pending, base=hashes)
+        patch_info = dump_patch_info(deleted, should_be)
+        deltas = {}
+        if self._delta_threshold > 0 and self._remote_algorithm == self._hash_algorithm:
+            deltas = self._prepare_deltas(remote_dir, changed, hashes)
+        if len(deltas) > 0:
+            full = [f for f in changed if f not in deltas]
+            if self._send_patch(remote_dir, full, manifest, patch_info, deltas):
+                for f, delta in deltas.items():
+                    save_signature(should_be[f], self._hash_algorithm, delta.signature)
+                return True
+            print("Applying the deltas failed, sending the complete files instead.")
+        return self._send_patch(remote_dir, changed, manifest, patch_info, {})
+
+    def _prepare_deltas(self, remote_dir, changed, hashes):
+        with phase("deltas", self._host) as profile:
+            deltas = prepare_deltas(self._conn, self._local_workdir, remote_dir, changed, hashes, self._hash_algorithm, self._delta_threshold, self._python)
+            profile.add("files", len(deltas))
+            profile.add("bytes", sum(delta.size for delta in deltas.values()))
+        return deltas
+
+    def _send_patch(self, remote_dir, files, manifest, patch_info, deltas):
+        apply_deltas = len(deltas) > 0
+        with phase("transfer", self._host) as profile:
+            if self._parallel_streams > 1:
+                sizes = {f: os.path.getsize(os.path.join(self._local_workdir, f)) for f in files}
+                sizes.update({f: delta.size for f, delta in deltas.items()})
+                if sum(sizes.values()) >= PARALLEL_MIN_SIZE:
+                    streams = []
+                    for i, shard in enumerate(split_shards(sizes, self._parallel_streams)):
+                        shard_files = [f for f in shard if f not in deltas]
+                        shard_deltas = {f: deltas[f] for f in shard if f in deltas}
+                        first = i == 0
+                        chunks = iter_patch(self._local_workdir, shard_files, manifest if first else None, self._policy, deltas=shard_deltas, profile=profile, patch_info=patch_info if first else None)
+                        streams.append(count_bytes(chunks, profile, "transferred_bytes"))
+                    return send_sharded(self._conn, remote_dir, streams, self._policy, apply_deltas, self._python)
+            chunks = iter_patch(self._local_workdir, files, manifest, self._policy, deltas=deltas, profile=profile, patch_info=patch_info)
+            return send_stream(self._conn, remote_dir, count_bytes(chunks, profile, "transferred_bytes"), self._policy, apply_deltas, self._python)
+
+    def watch(self, check_interval, debounce=0.2):
+        """
+        Keep the remote in sync. Uses inotify if available and otherwise checks every check_interval seconds.
+        """
+        watcher = create_watcher(self._local_workdir, gitignore=self._gitignore)
+        old_hashes = self.sync(lazy=True)
+        if watcher is None:
+            while True:
+                time.sleep(check_interval)
+                old_hashes = self.sync(hashes=old_hashes, lazy=True)
+        while True:
+            # Retry failed syncs after check_interval seconds even if nothing changed.
+            paths = watcher.wait_for_changes(debounce, timeout=None if self._in_sync else check_interval)
+            old_hashes = self.sync(hashes=old_hashes, paths=paths, lazy=True)
+
+
+class MultiSyncManager(object):
+    def __init__(self, managers):
+        """
+        Sync the same local folder to several hosts, given a SyncManager for every host.
+
+        The local folder is scanned once, the manifests of all hosts are fetched in parallel
+        and hosts with the same remote state get the same patch, which is packed only once.
+        """
+        self._managers = managers
+        self._local_workdir = managers[0]._local_workdir
+        self._hash_algorithm = managers[0]._hash_algorithm
+        self._gitignore = managers[0]._gitignore
+        self._local_hashes = None
+
+    def sync(self, hashes=None, paths=None, lazy=False, local_hashes=None):
+        """
+        Sync all hosts and return the hashes every host has afterwards as a list (in the order of the managers).
+
+        When the hashes returned by the previous sync are given, only the changed paths (relative to the local folder) are scanned again.
+        Lazy syncs hold back large files and known local hashes are used like in `SyncManager.sync`.
+        """
+        with phase("sync", ",".join(manager.host for manager in self._managers)):
+            return self._sync(hashes, paths, lazy, local_hashes)
+
+    def _sync(self, hashes, paths, lazy, local_hashes):
+        start = time.time()
+        if local_hashes is not None:
+            self._local_hashes = local_hashes
+        elif paths is not None and self._local_hashes is not None:
+            self._local_hashes, _ = update_files_hash_map(self._local_workdir, self._local_hashes, paths, algorithm=self._hash_algorithm, gitignore=self._gitignore)
+        else:
+            self._local_hashes = get_files_hash_map(self._local_workdir, [], algorithm=self._hash_algorithm, gitignore=self._gitignore)
+        scan_time = time.time() - start
+        manifest_times = [0.0] * len(self._managers)
+        patch_times = [0.0] * len(self._managers)
+        with ThreadPoolExecutor(max_workers=len(self._managers)) as pool:
+            hashes = list(hashes) if hashes is not None else [None] * len(self._managers)
+            # Also hosts whose last patch failed, their state is unknown.
+            stale = [i for i, manager in enumerate(self._managers) if hashes[i] is None or manager._stale]
+
+            def fetch(i):
+                start = time.time()
+                remote_hashes = self._managers[i]._get_remote_hashes(self._local_hashes)
+                manifest_times[i] = time.time() - start
+                return remote_hashes
+            for i, remote_hashes in zip(stale, pool.map(fetch, stale)):
+                hashes[i] = remote_hashes
+            groups = {}
+            for i, manager in enumerate(self._managers):
+                groups.setdefault(self._state_key(manager, hashes[i]), []).append(i)
+
+            def sync_group(group):
+                start = time.time()
+                results = self._sync_group(group, hashes, lazy)
+                for i in group:
+                    patch_times[i] = time.time() - start
+                return results
+            new_hashes = list(hashes)
+            for results in pool.map(sync_group, groups.values()):
+                for i, should_be in results.items():
+                    new_hashes[i] = should_be
+        self._print_summary(hashes, new_hashes, scan_time, manifest_times, patch_times, len(groups))
+        return new_hashes
+
+    def _state_key(self, manager, hashes):
+        # Hosts can only share a patch, if they have the same files and read the patch the same way.
+        settings = (manager._remote_algorithm, manager._transport, manager._policy.codec, manager._policy.level, manager._delta_threshold, manager._parallel_streams, manager._lazy_threshold)
+        return settings + (json.dumps(hashes, sort_keys=True),)
+
+    def _sync_group(self, group, hashes, lazy):
+        managers = [self._managers[i] for i in group]
+        first = managers[0]
+        if len(group) > 1 and first._transport == "stream" and first._parallel_streams <= 1:
+            return dict(zip(group, self._send_fanout(managers, hashes[group[0]], lazy)))
+
+        def sync(i):
+            return self._managers[i].sync(hashes[i], local_hashes=self._local_hashes, lazy=lazy)
+        with ThreadPoolExecutor(max_workers=len(group)) as pool:
+            return dict(zip(group, pool.map(sync, group)))
+
+    def _send_fanout(self, managers, hashes, lazy):
+        first = managers[0]
+        changed, deleted, should_be = compute_patch(self._local_workdir, hashes, algorithm=self._hash_algorithm, server_algorithm=first._remote_algorithm, local_hashes=self._local_hashes, gitignore=self._gitignore)
+        # Hosts in a group have the same state and settings, so the first decides for all of them.
+        changed, should_be, pending = first._defer(changed, deleted, hashes, should_be, lazy)
+        if changed is None:
+            return [manager._finish(True, hashes, should_be) for manager in managers]
+        manifest = dump_manifest(should_be, self._hash_algorithm, pending, base=hashes)
+        patch_info = dump_patch_info(deleted, should_be)
+        deltas = {}
+        if first._delta_threshold > 0 and first._remote_algorithm == self._hash_algorithm:
+            # All hosts have the same files, so the signatures of the first host are valid for all of them.
+            deltas = first._prepare_deltas(first.remote_dir, changed, hashes)
+        full = [f for f in changed if f not in deltas]
+        targets = [(manager._conn, manager.remote_dir, manager._python) for manager in managers]
+        with phase("transfer", ",".join(manager.host for manager in managers)) as profile:
+            chunks = iter_patch(self._local_workdir, full, manifest, first._policy, deltas=deltas, profile=profile, patch_info=patch_info)
+            results = send_stream_fanout(targets, count_bytes(chunks, profile, "transferred_bytes"), first._policy, len(deltas) > 0)
+        if len(deltas) > 0 and any(results):
+            for f, delta in deltas.items():
+                save_signature(should_be[f], self._hash_algorithm, delta.signature)
+        new_hashes = []
+        for manager, success in zip(managers, results):
+            if not success and len(deltas) > 0:
+                print(f"Applying the deltas on {manager.host} failed, sending the complete files instead.")
+                success = manager._send_patch(manager.remote_dir, changed, manifest, patch_info, {})
+            if success:
+                manager._pending = pending
+            new_hashes.append(manager._finish(success, hashes, should_be))
+        return new_hashes
+
+    def _print_summary(self, hashes, new_hashes, scan_time, manifest_times, patch_times, patches):
+        print(f"Synced {len(self._managers)} hosts with {patches} distinct patches (local scan {scan_time:.2f}s).")
+        print(f"{'Host':<24} {'Status':<32} {'Manifest':>9} {'Patch':>9}")
+        for i, manager in enumerate(self._managers):
+            if not manager._in_sync:
+                status = "FAILED"
+            else:
+                changed = sum(1 for f, h in new_hashes[i].items() if hashes[i].get(f, None) != h)
+                deleted = sum(1 for f in hashes[i] if f not in new_hashes[i])
+                status = "up to date" if changed == 0 and deleted == 0 else f"{changed} changed, {deleted} deleted"
+            print(f"{manager.host:<24} {status:<32} {manifest_times[i]:>8.2f}s {patch_times[i]:>8.2f}s")
+
+    @property
+    def in_sync(self):
+        return all(manager._in_sync for manager in self._managers)
+
+    def watch(self, check_interval, debounce=0.2):
+        """
+        Keep all hosts in sync. Uses inotify if available and otherwise checks every check_interval seconds.
+        """
+        watcher = create_watcher(self._local_workdir, gitignore=self._gitignore)
+        old_hashes = self.sync(lazy=True)
         while True:
-            time.sleep(check_interval)
-            old_hashes = self.sync(hashes=old_hashes)
+            if watcher is None:
+                time.sleep(check_interval)
+                paths = None
+            else:
+                # Retry failed syncs after check_interval seconds even if nothing changed.
+                paths = watcher.wait_for_changes(debounce, timeout=None if self.in_sync else check_interval)
+            old_hashes = self.sync(hashes=old_hashes, paths=paths, lazy=True)
@@ -0,0 +1,126 @@
+"""doc
+# merkle.py
+
+> Compares the local files to the manifest of the remote folder by folder, so only folders that differ are transferred.
+
+The manifest (`.md5.json`) stores the hashes as a tree of folders, where every folder has a digest over the names and hashes of its files and the digests of its subfolders.
+To fetch the hashes of the remote, the remote sends the digest of the root first (see `rempy/remote/tree.py`).
+If it matches the local one, the remote has the same files and nothing else is sent.
+Otherwise the remote lists the folders that differ and the local side descends into those subfolders with a different digest only.
+The hashes of all other folders are taken from the local hashes.
+A patch also only carries the folders which changed, unchanged ones are given by their digest and filled in by the remote (see `rempy/remote/commit_staging.py`).
+
+```
+tree = build_tree({"main.py": "abc", "data/a.txt": "def"})  # {"h": ..., "f": {"main.py": "abc"}, "d": {"data": {"h": ..., "f": {"a.txt": "def"}}}}
+hashes, algorithm, pending = fetch_remote_hashes(conn, "/home/foo/Testing/rempy", local_hashes, "blake2b")
+```
+
+License: MIT (see main license)
+Authors:
+* Michael Fuerst (Lead)
+"""
+import json
+import zlib
+import subprocess
+
+from rempy.remote import remote_python
+# Shared with the scripts on the remote, so both sides compute the same digests.
+from rempy.remote.common import build_tree, flatten_tree
+
+
+def prune_tree(tree, base):
+    """
+    Replace the subfolders of the tree, which are the same in the base tree, by their digests.
+
+    Returns the pruned tree and if anything was pruned.
+    """
+    pruned = {key: value for key, value in tree.items() if key != "d"}
+    folders = {}
+    any_pruned = False
+    for name, child in tree.get("d", {}).items():
+        base_child = base.get("d", {}).get(name, None) if base is not None else None
+        if base_child is not None and base_child["h"] == child["h"]:
+            folders[name] = child["h"]
+            any_pruned = True
+        else:
+            folders[name], child_pruned = prune_tree(child, base_child)
+            any_pruned = any_pruned or child_pruned
+    if len(folders) > 0:
+        pruned["d"] = folders
+    return pruned, any_pruned
+
+
+def __send(proc, message):
+    proc.stdin.write(json.dumps(message).encode("utf-8") + b"\n")
+    proc.stdin.flush()
+
+
+def __receive(proc, profile):
+    # Replies are compressed and prefixed with their length, see `rempy/remote/tree.py`.
+    size = proc.stdout.read(4)
+    if len(size) < 4:
+        raise ValueError("The remote closed the connection.")
+    data = proc.stdout.read(int.from_bytes(size, "big"))
+    if profile is not None:
+        profile.add("bytes", len(size) + len(data))
+    return json.loads(zlib.decompress(data))
+
+
+def __descend(proc, header, local_hashes, algorithm, profile):
+    if local_hashes is None or header["algorithm"] != algorithm:
+        # Hashes of another algorithm cannot be compared, so the remote sends its whole tree.
+        __send(proc, None)
+        return flatten_tree(__receive(proc, profile))
+    local_tree = build_tree(local_hashes)
+    if local_tree["h"] == header["root"]:
+        return dict(local_hashes)
+    hashes = {}
+    wanted = {"": local_tree}
+    while len(wanted) > 0:
+        __send(proc, sorted(wanted))
+        listing = __receive(proc, profile)
+        if profile is not None:
+            profile.add("rounds")
+        next_wanted = {}
+        for folder, node in listing.items():
+            prefix = f"{folder}/" if folder != "" else ""
+            local_node = wanted[folder]
+            for name, h in node.get("f", {}).items():
+                hashes[prefix + name] = h
+            for name, digest in node.get("d", {}).items():
+                local_child = local_node.get("d", {}).get(name, None) if local_node is not None else None
+                if local_child is not None and local_child["h"] == digest:
+                    flatten_tree(local_child, f"{prefix}{name}/", hashes)
+                else:
+                    next_wanted[prefix + name] = local_child
+        wanted = next_wanted
+    return hashes
+
+
+def fetch_remote_hashes(conn, remote_dir, local_hashes=None, algorithm=None, python="python3", profile=None):
+    """
+    Get the hashes of the files on the remote, their algorithm and the files held back by a lazy sync, descending only into folders that differ from the local hashes.
+
+    Without a manifest on the remote, the hashes are empty and the algorithm is None.
+    Returns None if the remote cannot compare the trees (e.g. no python on the remote or an unreadable manifest).
+    Pass a Phase (see `rempy.profiling`) as profile to count the received bytes and the rounds of descending.
+    """
+    proc = conn.popen(remote_python("tree", [remote_dir], python), stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    try:
+        header = __receive(proc, profile)
+        if "error" in header:
+            print(f"ERROR: Cannot read the manifest on the remote: {header['error']}")
+            return None
+        if header["root"] is None:
+            return {}, None, {}
+        return __descend(proc, header, local_hashes, algorithm, profile), header["algorithm"], header.get("pending", {})
+    except (ValueError, KeyError, OSError, zlib.error):
+        # The remote stopped answering, e.g. there is no python.
+        return None
+    finally:
+        try:
+            proc.stdin.close()
+        except OSError:
+            pass
+        proc.stdout.close()
+        proc.wait()
@@ -6,89 +6,62 @@
 Simply call the pack_patch function with a path and a dict containing the hashes from the server.
 The server hashes will be stored in a ".md5.json", which is part of each patch.
 This way the server knows its hashes without any software required on the server.
+Each patch also carries the files to delete (see `dump_patch_info`), so the remote applies it in one go (see `rempy/remote/commit_staging.py`).
+The manifest also records the hash algorithm (see `rempy.sync.hashing`), older manifests are plain md5 dicts.
+Hashes are stored as a tree with a digest per folder (see `rempy.sync.merkle`), so a patch only carries the folders that changed.
+Local hashes are cached in a persistent index (see `rempy.sync.hash_index`), so only modified files get hashed again.
 
 ```
-server_hashes = {"fname": "md5"}
+server_hashes, server_algorithm = load_manifest(data_of_md5_json)
 folder = "."
-patch_file_path, deleted, hashes = pack_patch(folder, server_hashes, forbidden_list=[])
-# patch_file_path is the path to a zip with the changed files.
+patch_file_path, deleted, hashes = pack_patch(folder, server_hashes, forbidden_list=[], algorithm="blake2b", server_algorithm=server_algorithm)
+# patch_file_path is the path to a zip (in the temp folder) with the changed files.
 # deleted is a list of deleted files.
 # hashes are the hashes both sides have once the patch is applied.
 ```
 
+Instead of writing a zip, the patch can also be streamed as a tar archive without touching the disk.
+```
+changed, deleted, hashes = compute_patch(folder, server_hashes)
+for chunk in iter_patch(folder, changed, dump_manifest(hashes), patch_info=dump_patch_info(deleted, hashes)):
+    pipe.write(chunk)
+```
+
 License: MIT (see main license)
 Authors:
 * Michael Fuerst (Lead)
 """
 import os
 import json
+import stat
 import shutil
-import hashlib
+import tarfile
+import tempfile
 import zipfile
 import time
 import datetime
 
+from rempy.profiling import phase
+from rempy.sync.compression import DEFAULT_COMPRESSION, CompressionPolicy
+from rempy.sync.delta import DELTA_FOLDER
+from rempy.sync.git import clean_blob_ids
+from rempy.sync.hash_index import get_hash_index
+from rempy.sync.hashing import BUFFER_SIZE, DEFAULT_ALGORITHM, hash_file, hash_files
+from rempy.sync.ignore import IgnoreMatcher
+from rempy.sync.merkle import build_tree, flatten_tree, prune_tree
+
+
+# Tells the remote what to remove, see dump_patch_info.
+PATCH_INFO = ".rempy_patch.json"
+
+
+def is_ignored(root, path, forbidden_list, is_dir=False):
+    """
+    Check if a file (or folder) given relative to root is excluded from syncing.
 
-PYTHON_IGNORE_LIST = ["__pycache__", "*.pyc", ".ipynb_checkpoints", ".git", ".svn", ".hg", "CSV", ".DS_Store", "*.egg-info"]
-
-
-def __md5(fname):
-    hash_md5 = hashlib.md5()
-    with open(fname, "rb") as f:
-        for chunk in iter(lambda: f.read(4096), b""):
-            hash_md5.update(chunk)
-    return hash_md5.hexdigest()
-
-
-def __ignore(candidate, forbidden_list):
-    # Parse list to find simple placeholder notations
-    start_list = []
-    end_list = []
-    for item in forbidden_list:
-        if item.startswith("*"):
-            end_list.append(item.replace("*", ""))
-        if item.endswith("*"):
-            start_list.append(item.replace("*", ""))
-    # Test
-    ignore_file = candidate in forbidden_list
-    for item in start_list:
-        ignore_file |= candidate.startswith(item)
-    for item in end_list:
-        ignore_file |= candidate.endswith(item)
-    return ignore_file
-
-
-def __get_syncignore(folder):
-    syncignore = []
-    ignore_file = os.path.join(folder, ".syncignore")
-    if os.path.exists(ignore_file):
-        with open(ignore_file, "r") as f:
-            syncignore = f.read().split("\n")
-    return syncignore
-
-
-def __get_all_files(root, forbidden_list):
-    all_files = []
-    root_with_sep = root + os.sep
-    for path, subdirs, files in os.walk(root):
-        local_syncignore = __get_syncignore(path)
-        local_syncignore.extend(forbidden_list)
-        files = [x for x in files if not __ignore(x, local_syncignore)]
-        subdirs[:] = [x for x in subdirs if not x.startswith(".") and not __ignore(x, local_syncignore)]
-        for name in files:
-            all_files.append(os.path.join(path, name).replace(root_with_sep, "").replace(os.sep, "/"))
-    return all_files
-
-
-def __get_empty_folders(root, forbidden_list):
-    forbidden_list.extend(PYTHON_IGNORE_LIST)
-    empty_folders = []
-    for path, subdirs, files in os.walk(root):
-        files = [x for x in files if not __ignore(x, forbidden_list)]
-        subdirs[:] = [x for x in subdirs if not x.startswith(".") and not __ignore(x, forbidden_list)]
-        if len(files) == 0:
-            empty_folders.append(path)
-    return empty_folders
+    Uses the same rules as walking the tree, so the path is ignored if any of its parent folders is.
+    """
+    return IgnoreMatcher(root, forbidden_list).ignored(path, is_dir)
 
 
 def __diff(should_be, current_state, verbose=False):
@@ -111,37 +84,348 @@ def __diff(should_be, current_state, verbose=False):
     return changed, deleted
 
 
-def get_files_hash_map(root, forbidden_list):
-    forbidden_list.extend(PYTHON_IGNORE_LIST)
-    files = __get_all_files(root, forbidden_list)
-    md5s = [__md5(os.path.join(root, f).replace(os.sep, "/")) for f in files]
-    hash_map = dict(zip(files, md5s))
+def load_manifest(data):
+    """
+    Parse the content of a ".md5.json" into the hashes and the algorithm used to compute them.
+    """
+    manifest = json.loads(data)
+    if isinstance(manifest.get("tree", None), dict):
+        return flatten_tree(manifest["tree"]), manifest["algorithm"]
+    if isinstance(manifest.get("files", None), dict):
+        return manifest["files"], manifest.get("algorithm", DEFAULT_ALGORITHM)
+    # Older versions of rempy stored a plain dict of md5 hashes.
+    return manifest, "md5"
+
+
+def load_pending(data):
+    """
+    Get the files held back by a lazy sync (with their local hashes) from the content of a ".md5.json", see dump_manifest.
+    """
+    pending = json.loads(data).get("pending", {})
+    # In the plain dict of older versions, "pending" would be the hash of a file.
+    return pending if isinstance(pending, dict) else {}
+
+
+def dump_manifest(hashes, algorithm=DEFAULT_ALGORITHM, pending=None, base=None):
+    """
+    Serialize the hashes of the remote, pending are files that are held back for now (with their local hashes).
+
+    Given the hashes the remote has before the patch as base, folders which are the same in both only appear with their digest.
+    """
+    tree, partial = prune_tree(build_tree(hashes), build_tree(base) if base is not None else None)
+    # Older versions of rempy read the empty files and send everything again, instead of misreading the tree.
+    manifest = {"version": 3, "algorithm": algorithm, "files": {}, "tree": tree}
+    if partial:
+        manifest["partial"] = True
+    if pending:
+        manifest["pending"] = pending
+    return json.dumps(manifest, separators=(",", ":"))
+
+
+def dump_patch_info(deleted, hashes):
+    """
+    Describe what the remote removes when applying a patch (see `rempy/remote/commit_staging.py`), given the deleted files and the hashes after the patch.
+
+    Besides the deleted files, this lists their folders which have no files left afterwards.
+    """
+    folders = set()
+    for name in deleted:
+        parts = name.split("/")[:-1]
+        folders.update("/".join(parts[:i]) for i in range(1, len(parts) + 1))
+    if len(folders) > 0:
+        for name in hashes:
+            parts = name.split("/")[:-1]
+            folders.difference_update("/".join(parts[:i]) for i in range(1, len(parts) + 1))
+    return json.dumps({"deleted": sorted(deleted), "folders": sorted(folders)})
+
+
+def __hash_with_index(root, files, index, algorithm, workers, scan, known=None):
+    hash_map = {}
+    missing = []
+    for f, st in files:
+        if known is not None and f in known:
+            hash_map[f] = known[f]
+            scan.add("git")
+            continue
+        if index is not None:
+            hash_map[f] = index.lookup(f, st)
+        if hash_map.get(f, None) is None:
+            missing.append((f, st))
+    scan.add("files", len(files))
+    scan.add("hashed", len(missing))
+    scan.add("cached", len(files) - len(missing))
+    paths = [os.path.join(root, f) for f, _ in missing]
+    try:
+        hashes = hash_files(paths, algorithm=algorithm, workers=workers)
+    except FileNotFoundError:
+        # A file vanished while hashing (e.g. a temporary file of an editor), only that one is left out.
+        hashes = [__hash_if_exists(path, algorithm) for path in paths]
+    for (f, st), file_hash in zip(missing, hashes):
+        if file_hash is None:
+            hash_map.pop(f, None)
+            continue
+        hash_map[f] = file_hash
+        if index is not None:
+            index.update(f, st, file_hash)
     return hash_map
 
 
-def pack_patch(folder, server_hashes, forbidden_list=[], verbose=False):
-    should_be = get_files_hash_map(folder, forbidden_list=forbidden_list)
-    changed, deleted = __diff(should_be, server_hashes, verbose=verbose)
-    if len(changed) == 0 and len(deleted) == 0:
+def __hash_if_exists(path, algorithm):
+    try:
+        return hash_file(path, algorithm)
+    except FileNotFoundError:
+        return None
+
+
+def get_files_hash_map(root, forbidden_list, use_index=True, algorithm=DEFAULT_ALGORITHM, workers=None, gitignore=False):
+    with phase("scan") as scan:
+        files = IgnoreMatcher(root, forbidden_list, gitignore).walk()
+        index = get_hash_index(root, algorithm) if use_index else None
+        # Git already knows the blob ids of unmodified files, only the others are hashed.
+        known = clean_blob_ids(root) if algorithm == "git" else None
+        hash_map = __hash_with_index(root, files, index, algorithm, workers, scan, known)
+        if index is not None:
+            index.evict(hash_map.keys())
+            index.save()
+    return hash_map
+
+
+def update_files_hash_map(root, hash_map, paths, forbidden_list=[], algorithm=DEFAULT_ALGORITHM, workers=None, gitignore=False):
+    """
+    Update a hash map for a set of changed paths (files or folders relative to root) without walking the whole tree.
+
+    Returns the new hash map and the set of files which might have changed.
+    """
+    hash_map = dict(hash_map)
+    affected = set()
+    candidates = []
+    matcher = IgnoreMatcher(root, forbidden_list, gitignore)
+    for path in paths:
+        full_path = os.path.join(root, path)
+        if path in hash_map:
+            del hash_map[path]
+            affected.add(path)
+        elif not os.path.isfile(full_path):
+            # Might have been a folder, so forget everything that was inside.
+            prefix = path + "/"
+            removed = [f for f in hash_map if f.startswith(prefix)]
+            for f in removed:
+                del hash_map[f]
+            affected.update(removed)
+        try:
+            st = os.stat(full_path)
+        except OSError:
+            continue
+        if os.path.isdir(full_path) and not matcher.ignored(path, is_dir=True):
+            candidates.extend(matcher.walk(path))
+        elif os.path.isfile(full_path) and not matcher.ignored(path):
+            candidates.append((path, st))
+    index = get_hash_index(root, algorithm)
+    with phase("scan") as scan:
+        hash_map.update(__hash_with_index(root, candidates, index, algorithm, workers, scan))
+        index.save()
+    # Files that vanished while hashing are left out of the hash map, so they count as deleted.
+    affected.update(f for f, _ in candidates)
+    return hash_map, affected
+
+
+def get_hashes(root, paths, algorithm=DEFAULT_ALGORITHM, workers=None):
+    """
+    Hash the given files (relative to root) using the hash index, files which do not exist are left out.
+    """
+    files = []
+    for path in paths:
+        try:
+            st = os.stat(os.path.join(root, path))
+        except OSError:
+            continue
+        if stat.S_ISREG(st.st_mode):
+            files.append((path, st))
+    index = get_hash_index(root, algorithm)
+    with phase("scan") as scan:
+        hash_map = __hash_with_index(root, files, index, algorithm, workers, scan)
+        index.save()
+    return hash_map
+
+
+def compute_patch(folder, server_hashes, forbidden_list=[], verbose=False, algorithm=DEFAULT_ALGORITHM, server_algorithm=None, local_hashes=None, gitignore=False):
+    """
+    Compute which files changed and which were deleted compared to the server.
+
+    Returns changed, deleted and the hashes both sides have once the patch is applied.
+    Changed is None if there is nothing to patch.
+    Pass the local hashes if they are already known (e.g. when patching several servers), to not scan the folder again.
+    """
+    if server_algorithm is None:
+        server_algorithm = algorithm
+    should_be = local_hashes
+    if should_be is None:
+        should_be = get_files_hash_map(folder, forbidden_list=forbidden_list, algorithm=algorithm, gitignore=gitignore)
+    if server_algorithm != algorithm:
+        # Hashes of different algorithms cannot be compared, so diff in the algorithm of the server.
+        comparable = get_files_hash_map(folder, forbidden_list=forbidden_list, algorithm=server_algorithm, gitignore=gitignore)
+    else:
+        comparable = should_be
+    with phase("diff") as diff:
+        changed, deleted = __diff(comparable, server_hashes, verbose=verbose)
+        diff.add("changed", len(changed))
+        diff.add("deleted", len(deleted))
+    if len(changed) == 0 and len(deleted) == 0 and server_algorithm == algorithm:
         # If there is no change do not create a patch.
         # Would be a waste of time...
         return None, [], should_be
-    with open(os.path.join(folder, ".md5.json"), "w") as f:
-        f.write(json.dumps(should_be))
-    changed.append(".md5.json")
+    return changed, deleted, should_be
+
+
+def compute_incremental_patch(folder, server_hashes, paths, forbidden_list=[], verbose=False, algorithm=DEFAULT_ALGORITHM, gitignore=False):
+    """
+    Like compute_patch, but only looks at the given paths (files or folders relative to folder).
+
+    The server hashes must be the hashes returned by the previous sync, as everything else is assumed unchanged.
+    """
+    should_be, affected = update_files_hash_map(folder, server_hashes, paths, forbidden_list, algorithm, gitignore=gitignore)
+    with phase("diff") as diff:
+        changed = [f for f in sorted(affected) if f in should_be and should_be[f] != server_hashes.get(f, None)]
+        deleted = [f for f in sorted(affected) if f in server_hashes and f not in should_be]
+        diff.add("changed", len(changed))
+        diff.add("deleted", len(deleted))
+    if verbose:
+        for f in changed:
+            print("Changed {}".format(f))
+        for f in deleted:
+            print("Deleted {}".format(f))
+    if len(changed) == 0 and len(deleted) == 0:
+        return None, [], should_be
+    return changed, deleted, should_be
+
+
+def __count_raw(chunks, profile):
+    for chunk, compress in chunks:
+        profile.add("raw_bytes", len(chunk))
+        yield chunk, compress
+
+
+def __iter_tar(folder, changed, manifest, patch_info, policy, chunk_size, deltas):
+    def member(name, size, mtime, mode):
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mtime = mtime
+        info.mode = mode
+        return info.tobuf(format=tarfile.PAX_FORMAT), True
+
+    def padding(size):
+        return b"\0" * (-size % tarfile.BLOCKSIZE), True
+
+    for name in changed:
+        path = os.path.join(folder, name)
+        compress = policy.compressible(path)
+        with open(path, "rb") as f:
+            st = os.fstat(f.fileno())
+            yield member(name, st.st_size, st.st_mtime, st.st_mode & 0o777)
+            remaining = st.st_size
+            while remaining > 0:
+                chunk = f.read(min(chunk_size, remaining))
+                if not chunk:
+                    # The file shrunk while packing, fill up to the size announced in the header.
+                    chunk = b"\0" * remaining
+                remaining -= len(chunk)
+                yield chunk, compress
+        yield padding(st.st_size)
+    for name, delta in deltas.items():
+        compress = policy.compressible(os.path.join(folder, name))
+        yield member(f"{DELTA_FOLDER}/{name}", delta.size, time.time(), 0o644)
+        for chunk in delta.iter_chunks(chunk_size):
+            yield chunk, compress
+        yield padding(delta.size)
+    # The patch info comes last, the remote only applies a patch if it arrived (see `rempy/remote/commit_staging.py`).
+    for name, data in [(".md5.json", manifest), (PATCH_INFO, patch_info)]:
+        if data is not None:
+            data = data.encode("utf-8")
+            yield member(name, len(data), time.time(), 0o644)
+            yield data, True
+            yield padding(len(data))
+    yield b"\0" * 2 * tarfile.BLOCKSIZE, True
+
+
+def iter_patch(folder, changed, manifest, policy=None, chunk_size=BUFFER_SIZE, deltas={}, profile=None, patch_info=None):
+    """
+    Generate a tar archive of the changed files, the manifest and the patch info (see dump_patch_info), compressed according to the policy (see `rempy.sync.compression`).
+
+    The archive is yielded in chunks while reading the files, so it can be piped directly into a remote 'tar -x'.
+    Deltas (see `rempy.sync.delta`) are stored in ".rempy_delta", the remote rebuilds the files from them before committing the patch.
+    When a patch is split into several archives, pass None as manifest and patch info for all but one.
+    Pass a Phase (see `rempy.profiling`) as profile to count the files and the bytes before compression.
+    """
+    if policy is None:
+        policy = CompressionPolicy.parse(DEFAULT_COMPRESSION)
+    chunks = __iter_tar(folder, changed, manifest, patch_info, policy, chunk_size, deltas)
+    if profile is not None:
+        profile.add("files", len(changed) + len(deltas))
+        chunks = __count_raw(chunks, profile)
+    return policy.compress(chunks)
+
+
+def defer_large_files(folder, changed, server_hashes, hashes, threshold):
+    """
+    Hold back the changed files of at least threshold bytes, they are only listed as pending in the manifest (see dump_manifest).
+
+    Returns the files to send now, the hashes the remote has afterwards and the pending files with their local hashes.
+    """
+    now = []
+    pending = {}
+    hashes = dict(hashes)
+    for f in changed:
+        if os.path.getsize(os.path.join(folder, f)) < threshold:
+            now.append(f)
+            continue
+        pending[f] = hashes[f]
+        # The remote keeps the version it has (if any), so the manifest must keep describing that one.
+        if server_hashes.get(f, None) is not None:
+            hashes[f] = server_hashes[f]
+        else:
+            del hashes[f]
+    return now, hashes, pending
+
+
+def pack_files(folder, changed, deleted, hashes, algorithm=DEFAULT_ALGORITHM, policy=None, verbose=False, pending=None, base=None):
+    """
+    Write a zip patch of the changed files, the patch info and the manifest to a temporary file and return its path.
+
+    The base hashes are the hashes of the remote before the patch, see dump_manifest.
+    """
+    if policy is None:
+        policy = CompressionPolicy.parse(DEFAULT_COMPRESSION)
     timestamp = datetime.datetime.fromtimestamp(time.time()).strftime('%Y-%m-%d_%H.%M.%S')
-    patch_name = timestamp  + "_" + folder.replace("\\", "/").split("/")[-1] + ".zip"
+    handle, patch_name = tempfile.mkstemp(prefix=f"{timestamp}_{os.path.basename(os.path.abspath(folder))}_", suffix=".zip")
+    os.close(handle)
     if verbose:
         print("Compressing patch in {}".format(patch_name))
-    with zipfile.ZipFile(patch_name, 'w', zipfile.ZIP_DEFLATED) as ziph:
+    # ZipFile.write copies the files in blocks and marks them as zip64 upfront, so no file is ever loaded as a whole.
+    with phase("pack") as pack, zipfile.ZipFile(patch_name, 'w', zipfile.ZIP_DEFLATED, allowZip64=True, compresslevel=min(policy.level, 9)) as ziph:
         for file in changed:
+            path = os.path.join(folder, file)
             if verbose:
-                print(os.path.join(folder, file).replace(os.sep, "/"))
-            ziph.write(os.path.join(".", file).replace(os.sep, "/"))
+                print(path.replace(os.sep, "/"))
+            if policy.compressible(path):
+                # Zip files only support deflate, so only the level of the policy is used (at most 9).
+                ziph.write(path, file.replace(os.sep, "/"), zipfile.ZIP_DEFLATED)
+            else:
+                ziph.write(path, file.replace(os.sep, "/"), zipfile.ZIP_STORED)
+        ziph.writestr(".md5.json", dump_manifest(hashes, algorithm, pending, base))
+        ziph.writestr(PATCH_INFO, dump_patch_info(deleted, hashes))
+        pack.add("files", len(changed))
+        pack.add("raw_bytes", sum(info.file_size for info in ziph.infolist()))
+        pack.add("compressed_bytes", sum(info.compress_size for info in ziph.infolist()))
     if verbose:
         print("Packed patch in {}".format(patch_name))
-    os.remove(os.path.join(folder, ".md5.json"))
-    return patch_name, deleted, should_be
+    return patch_name
+
+
+def pack_patch(folder, server_hashes, forbidden_list=[], verbose=False, algorithm=DEFAULT_ALGORITHM, server_algorithm=None, policy=None, local_hashes=None):
+    changed, deleted, should_be = compute_patch(folder, server_hashes, forbidden_list, verbose, algorithm, server_algorithm, local_hashes)
+    if changed is None:
+        return None, [], should_be
+    return pack_files(folder, changed, deleted, should_be, algorithm, policy, verbose), deleted, should_be
 
 
 def apply_patch(name, target):
@@ -149,9 +433,10 @@ def apply_patch(name, target):
         zip_ref.extractall(target)
 
     # remove emtpy dirs
-    empty_dirs = __get_empty_folders(target, [])
+    empty_dirs = IgnoreMatcher(target).empty_folders()
     for d in empty_dirs:
-        if os.path.exists(d):
+        d = os.path.join(target, d)
+        if d != os.path.join(target, "") and os.path.exists(d):
             shutil.rmtree(d)
 
 
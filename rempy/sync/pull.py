@@ -0,0 +1,175 @@
+"""doc
+# pull.py
+
+> Pulls files from the remote back to the local machine (e.g. checkpoints, metrics and logs of runs), only transferring what is new or changed.
+
+The remote hashes its files (see `rempy/remote/manifest.py`) and these hashes are compared to the local copies (using the hash index).
+Only files that differ are sent as a single tar stream over the ssh connection and written to the local folder.
+Every file is written to a temporary file first and then moved into place, so no file is ever half written locally.
+Files deleted on the remote are kept locally.
+
+```
+puller = PullManager("example.com", "foo", "/home/foo/Runs/2021-01-01_120000_test", "outputs", include=["*.csv", "*.txt"], max_size=100 * 1024 * 1024)
+puller.pull()
+puller.watch(10)  # Follow a running job.
+```
+
+License: MIT (see main license)
+Authors:
+* Michael Fuerst (Lead)
+"""
+import os
+import json
+import time
+import tarfile
+import threading
+import subprocess
+from json.decoder import JSONDecodeError
+
+from rempy.connection import get_connection
+from rempy.profiling import phase
+from rempy.remote import remote_python
+from rempy.sync.compression import DEFAULT_COMPRESSION, CompressionPolicy
+from rempy.sync.hash_index import get_hash_index
+from rempy.sync.hashing import BUFFER_SIZE, DEFAULT_ALGORITHM, get_hasher
+from rempy.sync.patcher import get_hashes
+
+
+# Default folder for pulled files in the local folder, it starts with a "." so it is never synced back.
+PULL_FOLDER = ".rempy_pulled"
+
+
+class _CountingReader(object):
+    def __init__(self, f, profile):
+        self._f = f
+        self._profile = profile
+
+    def read(self, size=-1):
+        data = self._f.read(size)
+        self._profile.add("transferred_bytes", len(data))
+        return data
+
+
+class PullManager(object):
+    def __init__(self, host, user, remote_dir, local_dir, hash_algorithm=DEFAULT_ALGORITHM, ssh_args="", include=[], exclude=[], max_size=None, python="python3", compression=DEFAULT_COMPRESSION, connection=None):
+        """
+        Pull the files in remote_dir, which match the include and exclude patterns and are at most max_size bytes, into local_dir.
+        """
+        self._conn = connection if connection is not None else get_connection(host, user, ssh_args)
+        self._host = host
+        self._remote_dir = remote_dir
+        self._local_dir = local_dir
+        self._hash_algorithm = hash_algorithm
+        self._options = json.dumps({"include": include, "exclude": exclude, "max_size": max_size})
+        self._python = python
+        self._policy = CompressionPolicy.parse(compression)
+        self._reported = set()
+
+    def _get_remote_hashes(self):
+        with phase("manifest", self._host) as manifest:
+            data = self._conn.check_output(remote_python("manifest", [self._remote_dir, self._hash_algorithm, self._options], self._python))
+            manifest.add("bytes", len(data) if data is not None else 0)
+        if data is None:
+            return None
+        try:
+            result = json.loads(data)
+        except JSONDecodeError:
+            print(f"No valid json from server: {data}")
+            return None
+        if "error" in result:
+            print(f"ERROR: Cannot list the files on the remote: {result['error']}")
+            return None
+        skipped = [f for f in sorted(result["skipped"]) if f not in self._reported]
+        if len(skipped) > 0:
+            print(f"Skipping {len(skipped)} files larger than the max size: {', '.join(skipped[:5])}{', ...' if len(skipped) > 5 else ''}")
+            self._reported.update(skipped)
+        return result["files"]
+
+    def pull(self):
+        """
+        Pull all new and changed files once. Returns if pulling succeeded.
+        """
+        with phase("pull", self._host):
+            hashes = self._get_remote_hashes()
+            if hashes is None:
+                return False
+            local_hashes = get_hashes(self._local_dir, hashes.keys(), algorithm=self._hash_algorithm)
+            with phase("diff") as diff:
+                changed = sorted(f for f, h in hashes.items() if local_hashes.get(f, None) != h)
+                diff.add("changed", len(changed))
+            if len(changed) == 0:
+                return True
+            print(f"Pulling {len(changed)} files from {self._host}.")
+            return self._receive(changed)
+
+    def _receive(self, changed):
+        command = f"cd {self._remote_dir} && tar -chf - --null -T -{self._policy.remote_compress}"
+        wanted = set(changed)
+        received = 0
+        index = get_hash_index(self._local_dir, self._hash_algorithm)
+        with phase("transfer", self._host) as profile:
+            proc = self._conn.popen(command, stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+            def send_names():
+                # Via stdin, so the list is not limited by the maximum length of a command line.
+                # From a thread, as tar already writes to stdout while reading the names.
+                try:
+                    proc.stdin.write(b"\0".join(f.encode("utf-8") for f in changed))
+                    proc.stdin.close()
+                except BrokenPipeError:
+                    pass
+            writer = threading.Thread(target=send_names)
+            writer.start()
+            try:
+                with tarfile.open(fileobj=self._policy.decompress_stream(_CountingReader(proc.stdout, profile)), mode="r|") as tar:
+                    for member in tar:
+                        if member.name not in wanted:
+                            continue
+                        if member.isfile():
+                            self._write(tar.extractfile(member), member, index)
+                        elif member.islnk() and member.linkname in wanted:
+                            # tar sends files with the same inode (e.g. hardlinks of run snapshots) once, the others refer to the first.
+                            with open(os.path.join(self._local_dir, member.linkname), "rb") as source:
+                                self._write(source, member, index)
+                        else:
+                            continue
+                        received += 1
+                        profile.add("files")
+                        profile.add("raw_bytes", member.size)
+            except (tarfile.TarError, EOFError, OSError) as e:
+                print(f"ERROR: Receiving the files failed: {e}")
+            finally:
+                index.save()
+                proc.stdout.close()
+                writer.join()
+                proc.wait()
+        if received < len(changed):
+            # Missing files are pulled again next time.
+            print(f"WARNING: {len(changed) - received} files could not be pulled, e.g. since they were deleted on the remote.")
+        return received == len(changed)
+
+    def _write(self, source, member, index):
+        path = os.path.join(self._local_dir, member.name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = path + ".rempy_tmp"
+        hasher = get_hasher(self._hash_algorithm, member.size)
+        with open(tmp_path, "wb") as f:
+            while True:
+                data = source.read(BUFFER_SIZE)
+                if not data:
+                    break
+                hasher.update(data)
+                f.write(data)
+        os.chmod(tmp_path, member.mode & 0o777)
+        os.utime(tmp_path, (member.mtime, member.mtime))
+        os.replace(tmp_path, path)
+        # The hash of what arrived, a file that changed while it was sent differs from the manifest and is pulled again.
+        index.update(member.name, os.stat(path), hasher.hexdigest())
+
+    def watch(self, check_interval):
+        """
+        Keep pulling every check_interval seconds, e.g. to follow the outputs of a running job.
+        """
+        while True:
+            self.pull()
+            time.sleep(check_interval)
@@ -0,0 +1,199 @@
+"""doc
+# transport.py
+
+> Implements how patches get to the remote and are applied there.
+
+There are two transports:
+* `stream` (default): The patch is packed as a tar stream directly into the stdin of a single remote `tar -x`. No temporary files are written locally and packing overlaps with the transfer. Large files are sent as block deltas (see `rempy.sync.delta`).
+  With `parallel_streams` larger than 1, large patches are split into shards, which are uploaded over parallel ssh connections and applied once all arrived.
+* `zip`: The patch is written as a zip file, piped to the remote and unzipped there. Use this if the remote has no tar.
+
+Either way, the patch is extracted into a staging folder, which `rempy/remote/commit_staging.py` moves into place (deleting the files listed in the patch) once it completely arrived.
+So every patch is a single ssh command and an interrupted transfer leaves the remote in its old state. Applying patches requires python 3 on the remote.
+
+License: MIT (see main license)
+Authors:
+* Michael Fuerst (Lead)
+"""
+import os
+import heapq
+import queue
+import threading
+import subprocess
+from uuid import uuid4
+
+from rempy.profiling import phase
+from rempy.remote import remote_python
+from rempy.sync.compression import DEFAULT_COMPRESSION, CompressionPolicy
+
+
+TRANSPORTS = ["stream", "zip"]
+STAGING_FOLDER = ".rempy_staging"
+# Patches smaller than this are not worth the handshakes of parallel connections.
+PARALLEL_MIN_SIZE = 16 * 1024 * 1024
+# Chunks buffered per host when sending the same patch to several hosts.
+FANOUT_QUEUE_SIZE = 16
+
+
+def _staging_folder(remote_dir):
+    return f"{remote_dir}/{STAGING_FOLDER}/{uuid4().hex}"
+
+
+def _apply_command(remote_dir, staging, apply_deltas, python):
+    command = remote_python("commit_staging", [staging, remote_dir], python)
+    if apply_deltas:
+        command = f"{remote_python('apply_delta', [remote_dir, staging], python)} && {command}"
+    return command
+
+
+def _discard_command(staging):
+    # If anything fails, the staging folder is discarded and the remote keeps its old state.
+    return f"{{ rm -rf {staging} {staging}.zip; rmdir {os.path.dirname(staging)} 2> /dev/null; false; }}"
+
+
+def send_stream(conn, remote_dir, chunks, policy=None, apply_deltas=False, python="python3"):
+    """
+    Pipe the chunks of a tar archive (see `rempy.sync.patcher.iter_patch`) into a remote 'tar -x' and apply it, all in one ssh command.
+    """
+    if policy is None:
+        policy = CompressionPolicy.parse(DEFAULT_COMPRESSION)
+    proc = conn.popen(_stream_command(remote_dir, policy, apply_deltas, python), stdin=subprocess.PIPE)
+    return _pipe(proc, chunks)
+
+
+def _stream_command(remote_dir, policy, apply_deltas, python):
+    staging = _staging_folder(remote_dir)
+    extract = f"mkdir -p {staging} && {policy.remote_decompress}tar {policy.tar_flags} - -C {staging}"
+    return f"{extract} && {_apply_command(remote_dir, staging, apply_deltas, python)} || {_discard_command(staging)}"
+
+
+def _pipe(proc, chunks):
+    try:
+        for chunk in chunks:
+            if chunk:
+                proc.stdin.write(chunk)
+        proc.stdin.close()
+    except BrokenPipeError:
+        print("ERROR: The remote stopped reading the patch.")
+    except BaseException as e:
+        # Closing stdin would end the archive early at a member boundary, which tar accepts, so ssh is killed instead.
+        proc.kill()
+        proc.wait()
+        try:
+            proc.stdin.close()
+        except OSError:
+            pass
+        if not isinstance(e, Exception):
+            raise
+        print(f"ERROR: Sending the patch failed: {e}")
+        return False
+    return proc.wait() == 0
+
+
+def _raise_errors(chunks):
+    for chunk in chunks:
+        if isinstance(chunk, BaseException):
+            raise chunk
+        yield chunk
+
+
+def send_stream_fanout(targets, chunks, policy=None, apply_deltas=False):
+    """
+    Pipe the same tar archive into a remote 'tar -x' on several hosts at once, given a list of (conn, remote_dir, python).
+
+    The archive is only packed and compressed once. Returns for every target if the patch was applied.
+    """
+    if policy is None:
+        policy = CompressionPolicy.parse(DEFAULT_COMPRESSION)
+    # Every host has its own writer, so a slow host only stalls the others once its queue is full.
+    queues = [queue.Queue(maxsize=FANOUT_QUEUE_SIZE) for _ in targets]
+    results = [False] * len(targets)
+
+    def upload(i):
+        conn, remote_dir, python = targets[i]
+        received = iter(queues[i].get, None)
+        try:
+            proc = conn.popen(_stream_command(remote_dir, policy, apply_deltas, python), stdin=subprocess.PIPE)
+            results[i] = _pipe(proc, _raise_errors(received))
+        except Exception as e:
+            print(f"ERROR: Sending the patch to {conn.host} failed: {e}")
+        finally:
+            # Keep consuming if the upload stopped early, so the other hosts are not blocked.
+            for _ in received:
+                pass
+
+    threads = [threading.Thread(target=upload, args=(i,)) for i in range(len(targets))]
+    for thread in threads:
+        thread.start()
+    try:
+        for chunk in chunks:
+            for q in queues:
+                q.put(chunk)
+    except BaseException as e:
+        # Passed on to the uploads, so they kill their ssh instead of ending the archive (see _pipe).
+        for q in queues:
+            q.put(e)
+        if not isinstance(e, Exception):
+            raise
+    finally:
+        for q in queues:
+            q.put(None)
+        for thread in threads:
+            thread.join()
+    return results
+
+
+def split_shards(sizes, count):
+    """
+    Split files into count shards of about equal size, given a dict of the file sizes.
+    """
+    shards = [[] for _ in range(count)]
+    heap = [(0, i) for i in range(count)]
+    for name in sorted(sizes, key=lambda name: sizes[name], reverse=True):
+        size, i = heapq.heappop(heap)
+        shards[i].append(name)
+        heapq.heappush(heap, (size + sizes[name], i))
+    return [shard for shard in shards if len(shard) > 0]
+
+
+def send_sharded(conn, remote_dir, streams, policy=None, apply_deltas=False, python="python3"):
+    """
+    Upload several tar archives over separate ssh connections in parallel and apply them once all arrived.
+
+    Every archive is extracted into the same staging folder, which is then committed in one go.
+    If any upload fails, nothing is applied and the staging folder is removed.
+    """
+    if policy is None:
+        policy = CompressionPolicy.parse(DEFAULT_COMPRESSION)
+    staging = _staging_folder(remote_dir)
+    results = [False] * len(streams)
+
+    def upload(i):
+        command = f"mkdir -p {staging} && {policy.remote_decompress}tar {policy.tar_flags} - -C {staging}"
+        # Separate TCP connections, as multiplexed channels share the window of one connection.
+        proc = conn.popen(command, multiplex=False, stdin=subprocess.PIPE)
+        results[i] = _pipe(proc, streams[i])
+
+    threads = [threading.Thread(target=upload, args=(i,)) for i in range(len(streams))]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if not all(results):
+        conn.run(_discard_command(staging))
+        return False
+    with phase("apply", conn.host):
+        return conn.run(f"{_apply_command(remote_dir, staging, apply_deltas, python)} || {_discard_command(staging)}") == 0
+
+
+def send_zip(conn, remote_dir, patch_path, python="python3"):
+    """
+    Pipe a zip patch (see `rempy.sync.patcher.pack_patch`) to the remote, unzip it into a staging folder and apply it, all in one ssh command.
+    """
+    staging = _staging_folder(remote_dir)
+    extract = f"mkdir -p {staging} && cat > {staging}.zip && unzip -q -o {staging}.zip -d {staging} && rm {staging}.zip"
+    command = f"{extract} && {_apply_command(remote_dir, staging, False, python)} || {_discard_command(staging)}"
+    with phase("upload", conn.host, transferred_bytes=os.path.getsize(patch_path)), open(patch_path, "rb") as f:
+        success = conn.popen(command, stdin=f).wait() == 0
+    os.remove(patch_path)
+    return success
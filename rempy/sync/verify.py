@@ -0,0 +1,42 @@
+"""doc
+# verify.py
+
+> Detects files on the remote that drifted from the manifest, so only those are sent again.
+
+rempy trusts the `.md5.json` on the remote, so files edited on the remote or lost by an interrupted patch go unnoticed.
+With verification the remote hashes its files (see `rempy/remote/verify.py`) and reports which ones do not match the manifest.
+The remote caches hashes by stat, so verifying an unchanged folder only costs a stat per file.
+
+```
+drift = verify_remote(conn, "/home/foo/Testing/rempy")
+for f in drift:
+    server_hashes[f] = None  # They get sent again with the next patch.
+```
+
+License: MIT (see main license)
+Authors:
+* Michael Fuerst (Lead)
+"""
+import json
+from json.decoder import JSONDecodeError
+
+from rempy.remote import remote_python
+
+
+def verify_remote(conn, remote_dir, python="python3"):
+    """
+    Return the files (relative to remote_dir) which do not match the manifest on the remote or None if verifying failed.
+    """
+    data = conn.check_output(remote_python("verify", [remote_dir], python))
+    if data is None:
+        return None
+    try:
+        result = json.loads(data)
+    except JSONDecodeError:
+        return None
+    if "error" in result:
+        print(f"WARNING: Cannot verify the remote: {result['error']}")
+        return None
+    if len(result["drift"]) > 0:
+        print(f"Found {len(result['drift'])} of {result['files']} files modified on the remote, they will be sent again.")
+    return result["drift"]
@@ -0,0 +1,153 @@
+"""doc
+# watcher.py
+
+> Watches a folder for changes using inotify, so watch mode only syncs when and what changed.
+
+```
+watcher = create_watcher("/path/to/project", forbidden_list=[])
+if watcher is None:
+    pass  # No inotify on this system, fall back to polling.
+paths = watcher.wait_for_changes(debounce=0.2)
+# paths is a set of changed files and folders relative to the root, or None if the events overflowed and everything must be rechecked.
+```
+
+License: MIT (see main license)
+Authors:
+* Michael Fuerst (Lead)
+"""
+import os
+import sys
+import time
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+
+from rempy.sync.ignore import IgnoreMatcher
+
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_DELETE_SELF
+EVENT_HEADER = struct.Struct("iIII")
+# Wait at most this many times the debounce for the changes to settle.
+MAX_DEBOUNCE = 10
+
+
+class InotifyWatcher(object):
+    def __init__(self, root, forbidden_list=[], gitignore=False):
+        self._root = os.path.abspath(root)
+        self._matcher = IgnoreMatcher(root, forbidden_list, gitignore)
+        self._libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._fd = self._libc.inotify_init1(os.O_CLOEXEC)
+        if self._fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+        self._folders = {}
+        self._add_tree("")
+
+    def _add_tree(self, path):
+        folder = os.path.join(self._root, path)
+        wd = self._libc.inotify_add_watch(self._fd, folder.encode("utf-8"), WATCH_MASK)
+        if wd < 0:
+            if ctypes.get_errno() == errno.ENOSPC:
+                raise OSError(errno.ENOSPC, "inotify watch limit reached (see fs.inotify.max_user_watches)")
+            # The folder vanished in the meantime.
+            return
+        self._folders[wd] = path
+        try:
+            entries = list(os.scandir(folder))
+        except OSError:
+            return
+        for entry in entries:
+            child = entry.name if path == "" else path + "/" + entry.name
+            if entry.is_dir(follow_symlinks=False) and not self._matcher.ignored(child, is_dir=True):
+                self._add_tree(child)
+
+    def _remove_tree(self, path):
+        prefix = path + "/"
+        for wd, folder in list(self._folders.items()):
+            if folder == path or folder.startswith(prefix):
+                self._libc.inotify_rm_watch(self._fd, wd)
+                del self._folders[wd]
+
+    def _read_events(self, paths):
+        data = os.read(self._fd, 64 * 1024)
+        offset = 0
+        overflow = False
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            name = data[offset + EVENT_HEADER.size:offset + EVENT_HEADER.size + length].rstrip(b"\0").decode("utf-8", "surrogateescape")
+            offset += EVENT_HEADER.size + length
+            if mask & IN_Q_OVERFLOW:
+                overflow = True
+                continue
+            if mask & IN_IGNORED:
+                self._folders.pop(wd, None)
+                continue
+            folder = self._folders.get(wd, None)
+            if folder is None or name == "":
+                continue
+            path = name if folder == "" else folder + "/" + name
+            paths.add(path)
+            if mask & IN_ISDIR and mask & IN_MOVED_FROM:
+                # Stop watching, if the folder was moved into the tree again it gets added by the IN_MOVED_TO.
+                self._remove_tree(path)
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                try:
+                    if not self._matcher.ignored(path, is_dir=True):
+                        self._add_tree(path)
+                except OSError:
+                    overflow = True
+        return overflow
+
+    def wait_for_changes(self, debounce=0.2, timeout=None):
+        """
+        Block until something changed and then until nothing changed for debounce seconds.
+
+        Files that change all the time (e.g. a log written by the script) would delay the sync forever, so at most MAX_DEBOUNCE times debounce seconds are waited.
+        Returns the changed paths, None if every file must be checked or an empty set on timeout.
+        """
+        paths = set()
+        overflow = False
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        deadline = time.monotonic() + MAX_DEBOUNCE * debounce
+        while readable:
+            overflow |= self._read_events(paths)
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            readable, _, _ = select.select([self._fd], [], [], min(debounce, remaining))
+        return None if overflow else paths
+
+    def fileno(self):
+        """
+        The inotify file descriptor, it is readable when there are changes (e.g. to wait for them with select).
+        """
+        return self._fd
+
+    def close(self):
+        os.close(self._fd)
+
+
+def create_watcher(root, forbidden_list=[], gitignore=False):
+    """
+    Create an inotify watcher for the folder or return None if inotify is not available.
+    """
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        return InotifyWatcher(root, forbidden_list, gitignore)
+    except (OSError, AttributeError) as e:
+        print(f"Cannot use inotify, falling back to polling: {e}")
+        return None
@@ -0,0 +1,72 @@
+import io
+import os
+import json
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+
+from rempy.remote.commit_staging import MANIFEST, PATCH_INFO, main
+
+
+class TestCommitStaging(unittest.TestCase):
+    def setUp(self):
+        self._folder = tempfile.TemporaryDirectory()
+        self._target = os.path.join(self._folder.name, "target")
+        self._staging = os.path.join(self._target, ".rempy_staging", "patch")
+        os.makedirs(self._staging)
+        self._write(self._target, "a.txt", "old")
+        self._write(self._target, "old/b.txt", "old")
+        self._write(self._target, MANIFEST, json.dumps({"a.txt": "1", "old/b.txt": "2"}))
+
+    def tearDown(self):
+        self._folder.cleanup()
+
+    def _write(self, folder, name, content):
+        path = os.path.join(folder, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(content)
+
+    def _read(self, name):
+        with open(os.path.join(self._target, name), "r") as f:
+            return f.read()
+
+    def test_commit(self):
+        self._write(self._staging, "a.txt", "new")
+        self._write(self._staging, "c/d.txt", "new")
+        self._write(self._staging, MANIFEST, "{}")
+        self._write(self._staging, PATCH_INFO, json.dumps({"deleted": ["old/b.txt"], "folders": ["old"]}))
+        main(self._staging, self._target)
+        self.assertEqual(self._read("a.txt"), "new")
+        self.assertEqual(self._read("c/d.txt"), "new")
+        self.assertEqual(self._read(MANIFEST), "{}")
+        self.assertFalse(os.path.exists(os.path.join(self._target, "old")))
+        self.assertFalse(os.path.exists(os.path.join(self._target, PATCH_INFO)))
+        self.assertFalse(os.path.exists(os.path.dirname(self._staging)))
+
+    def test_file_replaced_by_folder(self):
+        self._write(self._staging, "a.txt/inner.txt", "new")
+        self._write(self._staging, PATCH_INFO, json.dumps({"deleted": ["a.txt"], "folders": []}))
+        main(self._staging, self._target)
+        self.assertEqual(self._read("a.txt/inner.txt"), "new")
+
+    def test_keep_outputs(self):
+        # The folder has no synced files left, but the remote wrote an output into it.
+        self._write(self._target, "old/output.txt", "result")
+        self._write(self._staging, PATCH_INFO, json.dumps({"deleted": ["old/b.txt"], "folders": ["old"]}))
+        main(self._staging, self._target)
+        self.assertFalse(os.path.exists(os.path.join(self._target, "old/b.txt")))
+        self.assertEqual(self._read("old/output.txt"), "result")
+
+    def test_incomplete_patch(self):
+        # The stream ended before the patch info, e.g. as packing failed.
+        self._write(self._staging, "a.txt", "new")
+        with redirect_stdout(io.StringIO()), self.assertRaises(SystemExit):
+            main(self._staging, self._target)
+        self.assertEqual(self._read("a.txt"), "old")
+        self.assertEqual(self._read("old/b.txt"), "old")
+        self.assertFalse(os.path.exists(self._staging))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,65 @@
+import os
+import random
+import tempfile
+import unittest
+
+from rempy.remote.apply_delta import _rebuild
+from rempy.sync.delta import Delta, file_signature
+
+
+BLOCK_SIZE = 1024
+
+
+class TestDelta(unittest.TestCase):
+    def setUp(self):
+        self._folder = tempfile.TemporaryDirectory()
+        rng = random.Random(42)
+        self._old = bytes(rng.getrandbits(8) for _ in range(200 * BLOCK_SIZE + 123))
+
+    def tearDown(self):
+        self._folder.cleanup()
+
+    def _check(self, new):
+        old_path = os.path.join(self._folder.name, "old.csv")
+        new_path = os.path.join(self._folder.name, "new.csv")
+        delta_path = os.path.join(self._folder.name, "delta")
+        rebuilt_path = os.path.join(self._folder.name, "rebuilt.csv")
+        with open(old_path, "wb") as f:
+            f.write(self._old)
+        with open(new_path, "wb") as f:
+            f.write(new)
+        delta = Delta(new_path, file_signature(old_path, BLOCK_SIZE))
+        with open(delta_path, "wb") as f:
+            for chunk in delta.iter_chunks():
+                f.write(chunk)
+        _rebuild(delta_path, old_path, rebuilt_path)
+        with open(rebuilt_path, "rb") as f:
+            self.assertEqual(f.read(), new)
+        self.assertEqual(delta.signature, file_signature(new_path, BLOCK_SIZE))
+        return delta
+
+    def test_insertion(self):
+        delta = self._check(self._old[:5000] + b"a,new,line\n" + self._old[5000:])
+        # Only the block around the insertion is sent, the shifted blocks after it are matched.
+        self.assertLess(delta.literal_size, 2 * BLOCK_SIZE)
+
+    def test_deletion(self):
+        delta = self._check(self._old[:5000] + self._old[5017:])
+        self.assertLess(delta.literal_size, 2 * BLOCK_SIZE)
+
+    def test_edit_in_place(self):
+        delta = self._check(self._old[:5000] + b"X" + self._old[5001:])
+        self.assertLessEqual(delta.literal_size, BLOCK_SIZE)
+
+    def test_rewritten(self):
+        path = os.path.join(self._folder.name, "new.csv")
+        with open(path, "wb") as f:
+            f.write(bytes(reversed(self._old)))
+        with open(os.path.join(self._folder.name, "old.csv"), "wb") as f:
+            f.write(self._old)
+        delta = Delta(path, file_signature(os.path.join(self._folder.name, "old.csv"), BLOCK_SIZE))
+        self.assertEqual(delta.literal_size, delta.file_size)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,94 @@
+import os
+import tempfile
+import unittest
+
+from rempy.sync.ignore import IgnoreMatcher, compile_rules, match
+
+
+def ignored(patterns, path, is_dir=False):
+    return match(compile_rules(patterns), path, is_dir)
+
+
+class TestRules(unittest.TestCase):
+    def test_name(self):
+        self.assertTrue(ignored(["*.pyc"], "a.pyc"))
+        self.assertTrue(ignored(["*.pyc"], "deep/folder/a.pyc"))
+        self.assertFalse(ignored(["*.pyc"], "a.py"))
+        # A star does not match a slash.
+        self.assertFalse(ignored(["a*c"], "ab/c"))
+
+    def test_anchored(self):
+        self.assertTrue(ignored(["/build"], "build", True))
+        self.assertFalse(ignored(["/build"], "src/build", True))
+        self.assertTrue(ignored(["docs/generated"], "docs/generated", True))
+        self.assertFalse(ignored(["docs/generated"], "src/docs/generated", True))
+
+    def test_double_star(self):
+        self.assertTrue(ignored(["data/**/*.npy"], "data/x.npy"))
+        self.assertTrue(ignored(["data/**/*.npy"], "data/a/b/x.npy"))
+        self.assertFalse(ignored(["data/**/*.npy"], "other/data/x.npy"))
+        self.assertTrue(ignored(["**/cache"], "a/b/cache", True))
+        self.assertTrue(ignored(["logs/**"], "logs/a/b.txt"))
+        self.assertFalse(ignored(["logs/**"], "logs", True))
+
+    def test_folder_only(self):
+        self.assertTrue(ignored(["logs/"], "logs", True))
+        self.assertTrue(ignored(["logs/"], "a/logs", True))
+        self.assertFalse(ignored(["logs/"], "logs", False))
+
+    def test_negation(self):
+        self.assertFalse(ignored(["*.log", "!keep.log"], "keep.log"))
+        self.assertTrue(ignored(["*.log", "!keep.log"], "other.log"))
+        # The last matching rule wins.
+        self.assertTrue(ignored(["!keep.log", "*.log"], "keep.log"))
+
+    def test_comments_and_escapes(self):
+        self.assertEqual(compile_rules(["", "# comment", "   "]), ())
+        self.assertTrue(ignored(["\\#notes"], "#notes"))
+        self.assertTrue(ignored(["\\!bang"], "!bang"))
+        self.assertTrue(ignored(["file[0-9].txt"], "file3.txt"))
+        self.assertFalse(ignored(["file[!0-9].txt"], "file3.txt"))
+
+
+class TestMatcher(unittest.TestCase):
+    def setUp(self):
+        self._folder = tempfile.TemporaryDirectory()
+        self._root = self._folder.name
+        for name in ["main.py", "debug.log", "keep.log", "build/out.o", "src/build/gen.py", "src/data/x.npy", "logs/run.txt", ".hidden/a.py", "__pycache__/m.pyc"]:
+            self._write(name, "")
+        self._write(".syncignore", "*.log\n!keep.log\n/build\nlogs/\n")
+        self._write("src/.syncignore", "data/\n")
+
+    def tearDown(self):
+        self._folder.cleanup()
+
+    def _write(self, name, content):
+        path = os.path.join(self._root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write(content)
+
+    def test_walk(self):
+        files = [path for path, _ in IgnoreMatcher(self._root).walk()]
+        self.assertEqual(files, [".syncignore", "keep.log", "main.py", "src/.syncignore", "src/build/gen.py"])
+
+    def test_ignored(self):
+        matcher = IgnoreMatcher(self._root)
+        self.assertTrue(matcher.ignored("debug.log"))
+        self.assertFalse(matcher.ignored("keep.log"))
+        self.assertTrue(matcher.ignored("build/out.o"))
+        self.assertFalse(matcher.ignored("src/build/gen.py"))
+        # Rules of a .syncignore only apply below its folder.
+        self.assertTrue(matcher.ignored("src/data/x.npy"))
+        self.assertFalse(matcher.ignored("data/x.npy"))
+        self.assertTrue(matcher.ignored(".hidden/a.py"))
+
+    def test_gitignore(self):
+        self._write(".gitignore", "main.py\nkeep.log\n")
+        self.assertEqual([path for path, _ in IgnoreMatcher(self._root).walk()], [".gitignore", ".syncignore", "keep.log", "main.py", "src/.syncignore", "src/build/gen.py"])
+        # The .syncignore of the same folder takes precedence.
+        self.assertEqual([path for path, _ in IgnoreMatcher(self._root, gitignore=True).walk()], [".gitignore", ".syncignore", "keep.log", "src/.syncignore", "src/build/gen.py"])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,117 @@
+import os
+import json
+import tempfile
+import unittest
+
+from rempy.connection import LocalConnection
+from rempy.profiling import Phase
+from rempy.remote.commit_staging import merge_manifest
+from rempy.sync.merkle import build_tree, fetch_remote_hashes, flatten_tree, prune_tree
+from rempy.sync.patcher import dump_manifest, load_manifest
+
+
+HASHES = {"main.py": "1", "src/a.py": "2", "src/b.py": "3", "src/deep/c.py": "4", "data/x.csv": "5"}
+
+
+class TestTree(unittest.TestCase):
+    def test_flatten(self):
+        self.assertEqual(flatten_tree(build_tree(HASHES)), HASHES)
+
+    def test_digests(self):
+        tree = build_tree(HASHES)
+        changed = build_tree(dict(HASHES, **{"src/deep/c.py": "changed"}))
+        self.assertNotEqual(tree["h"], changed["h"])
+        self.assertNotEqual(tree["d"]["src"]["h"], changed["d"]["src"]["h"])
+        self.assertEqual(tree["d"]["data"]["h"], changed["d"]["data"]["h"])
+        # A file moved into another folder changes the digest, although the hashes are the same.
+        moved = build_tree({"main.py": "1", "src/a.py": "2", "src/b.py": "3", "src/c.py": "4", "data/x.csv": "5"})
+        self.assertNotEqual(tree["h"], moved["h"])
+
+    def test_prune(self):
+        base = build_tree(HASHES)
+        pruned, any_pruned = prune_tree(build_tree(dict(HASHES, **{"src/a.py": "changed"})), base)
+        self.assertTrue(any_pruned)
+        self.assertEqual(pruned["d"]["data"], base["d"]["data"]["h"])
+        self.assertEqual(pruned["d"]["src"]["d"]["deep"], base["d"]["src"]["d"]["deep"]["h"])
+        self.assertEqual(pruned["d"]["src"]["f"]["a.py"], "changed")
+
+
+class TestManifest(unittest.TestCase):
+    def setUp(self):
+        self._folder = tempfile.TemporaryDirectory()
+        self._old = os.path.join(self._folder.name, "old.json")
+        self._new = os.path.join(self._folder.name, "new.json")
+
+    def tearDown(self):
+        self._folder.cleanup()
+
+    def _merge(self, old, new):
+        with open(self._old, "w") as f:
+            f.write(old)
+        with open(self._new, "w") as f:
+            f.write(new)
+        return merge_manifest(self._new, self._old)
+
+    def test_merge_partial(self):
+        hashes = dict(HASHES, **{"src/a.py": "changed", "new.txt": "6"})
+        manifest = dump_manifest(hashes, "md5", base=HASHES)
+        self.assertTrue(json.loads(manifest)["partial"])
+        self.assertTrue(self._merge(dump_manifest(HASHES, "md5"), manifest))
+        with open(self._new, "r") as f:
+            merged = f.read()
+        self.assertEqual(load_manifest(merged), (hashes, "md5"))
+        self.assertNotIn("partial", json.loads(merged))
+
+    def test_merge_old_format(self):
+        # Remotes synced by older versions have a flat dict of hashes.
+        hashes = dict(HASHES, **{"main.py": "changed"})
+        self.assertTrue(self._merge(json.dumps(HASHES), dump_manifest(hashes, "md5", base=HASHES)))
+        with open(self._new, "r") as f:
+            self.assertEqual(load_manifest(f.read())[0], hashes)
+
+    def test_merge_changed_remote(self):
+        # The remote changed since the patch was computed, so a pruned folder is not the same anymore.
+        remote = dict(HASHES, **{"data/x.csv": "other"})
+        manifest = dump_manifest(dict(HASHES, **{"main.py": "changed"}), "md5", base=HASHES)
+        self.assertFalse(self._merge(dump_manifest(remote, "md5"), manifest))
+
+
+class TestFetch(unittest.TestCase):
+    def setUp(self):
+        self._folder = tempfile.TemporaryDirectory()
+        self._hashes = {f"folder{i}/sub{j}/file{k}.py": f"{i}{j}{k}" for i in range(4) for j in range(4) for k in range(4)}
+        with open(os.path.join(self._folder.name, ".md5.json"), "w") as f:
+            f.write(dump_manifest(self._hashes, "md5"))
+
+    def tearDown(self):
+        self._folder.cleanup()
+
+    def _fetch(self, local_hashes, algorithm="md5"):
+        profile = Phase("manifest")
+        result = fetch_remote_hashes(LocalConnection(), self._folder.name, local_hashes, algorithm, profile=profile)
+        return result, profile.counters.get("rounds", 0)
+
+    def test_same(self):
+        (hashes, algorithm, pending), rounds = self._fetch(dict(self._hashes))
+        self.assertEqual((hashes, algorithm, pending), (self._hashes, "md5", {}))
+        self.assertEqual(rounds, 0)
+
+    def test_changed(self):
+        local = dict(self._hashes, **{"folder1/sub2/file3.py": "changed", "folder3/new.py": "new"})
+        del local["folder0/sub0/file0.py"]
+        (hashes, _, _), rounds = self._fetch(local)
+        self.assertEqual(hashes, self._hashes)
+        # Only the root, the changed folders and their changed subfolders are listed.
+        self.assertEqual(rounds, 3)
+
+    def test_other_algorithm(self):
+        (hashes, algorithm, _), _ = self._fetch(dict(self._hashes), "blake2b")
+        self.assertEqual((hashes, algorithm), (self._hashes, "md5"))
+
+    def test_no_manifest(self):
+        os.remove(os.path.join(self._folder.name, ".md5.json"))
+        self.assertEqual(self._fetch(dict(self._hashes))[0], ({}, None, {}))
+
+
+if __name__ == "__main__":
+    unittest.main()
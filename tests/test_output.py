@@ -0,0 +1,103 @@
+import io
+import os
+import tempfile
+import unittest
+
+from rempy.runtime.output import OutputStream
+
+
+def screen(text):
+    # What a terminal shows for the text, a carriage return moves back to the start of the line.
+    lines = [""]
+    cursor = 0
+    for c in text:
+        if c == "\n":
+            lines.append("")
+            cursor = 0
+        elif c == "\r":
+            cursor = 0
+        else:
+            line = lines[-1]
+            lines[-1] = line[:cursor] + c + line[cursor + 1:]
+            cursor += 1
+    return lines
+
+
+class TestOutputStream(unittest.TestCase):
+    def setUp(self):
+        self._folder = tempfile.TemporaryDirectory()
+        self._mirror = os.path.join(self._folder.name, "run.log")
+        self._out = io.StringIO()
+
+    def tearDown(self):
+        self._folder.cleanup()
+
+    def _stream(self, **kwargs):
+        stream = OutputStream(out=self._out, mirror=self._mirror, min_interval=0, **kwargs)
+        stream.output = True
+        return stream
+
+    def _mirrored(self):
+        with open(self._mirror, "r") as f:
+            return f.read()
+
+    def test_lines(self):
+        stream = self._stream()
+        stream.write(b"first\nsec")
+        stream.write(b"ond\n")
+        stream.close()
+        self.assertEqual(screen(self._out.getvalue()), ["first", "second", ""])
+        self.assertEqual(self._mirrored(), "first\nsecond\n")
+
+    def test_not_started(self):
+        stream = OutputStream(out=self._out)
+        stream.write(b"login banner\n")
+        stream.close()
+        self.assertEqual(self._out.getvalue(), "")
+        self.assertEqual(stream.received, len(b"login banner\n"))
+
+    def test_carriage_return(self):
+        stream = self._stream()
+        for i in range(0, 101, 20):
+            stream.write(f"\r{i:3d}% done".encode("utf-8"))
+        stream.write(b"\r50%\n")
+        stream.close()
+        # Only the last redraw and what the longer ones before left behind it are visible.
+        self.assertEqual(screen(self._out.getvalue()), ["50%% done", ""])
+        self.assertEqual(self._mirrored(), "50%% done\n")
+
+    def test_split_characters(self):
+        stream = self._stream()
+        data = "größe\n".encode("utf-8")
+        for i in range(len(data)):
+            stream.write(data[i:i + 1])
+        stream.close()
+        self.assertEqual(screen(self._out.getvalue()), ["größe", ""])
+
+    def test_escape_sequences(self):
+        stream = self._stream()
+        stream.write(b"\x1b[31mred\x1b[0m and \x1b[3")
+        stream.write(b"2mgreen\x1b[0m\n")
+        stream.close()
+        self.assertEqual(screen(self._out.getvalue()), ["red and green", ""])
+        self.assertEqual(self._mirrored(), "red and green\n")
+
+    def test_echo(self):
+        stream = self._stream()
+        stream.expect_echo("python train.py --lr=0.1")
+        stream.write(b"$ python train.py --lr=0.1\r\nepoch 1\n")
+        stream.close()
+        self.assertEqual(screen(self._out.getvalue()), ["epoch 1", ""])
+
+    def test_endless_line(self):
+        stream = self._stream(max_buffer=16)
+        stream.write(b"x" * 32)
+        stream.write(b"abc")
+        stream.write(b"\rX\n")
+        stream.close()
+        # The endless line is given up, what follows it is a line of its own.
+        self.assertTrue(self._mirrored().endswith("Xbc\n"))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,45 @@
+import os
+import tempfile
+import unittest
+from unittest import mock
+
+from rempy.sync import patcher
+from rempy.sync.hash_index import HashIndex
+from rempy.sync.hashing import hash_file, hash_files
+
+
+class TestIncrementalPatch(unittest.TestCase):
+    def setUp(self):
+        self._folder = tempfile.TemporaryDirectory()
+        self._root = os.path.join(self._folder.name, "project")
+        os.makedirs(self._root)
+        index = HashIndex(self._root, index_folder=os.path.join(self._folder.name, "index"))
+        self._index = mock.patch.object(patcher, "get_hash_index", return_value=index)
+        self._index.start()
+
+    def tearDown(self):
+        self._index.stop()
+        self._folder.cleanup()
+
+    def _write(self, name, content):
+        with open(os.path.join(self._root, name), "w") as f:
+            f.write(content)
+
+    def test_vanishing_file(self):
+        self._write("main.py", "print('new')")
+        self._write(".main.py.swp", "swap")
+        server_hashes = {"main.py": "old"}
+
+        def vanish(paths, **kwargs):
+            # The editor removes its temporary file while the changes are hashed.
+            os.remove(os.path.join(self._root, ".main.py.swp"))
+            return hash_files(paths, **kwargs)
+        with mock.patch.object(patcher, "hash_files", side_effect=vanish):
+            changed, deleted, should_be = patcher.compute_incremental_patch(self._root, server_hashes, ["main.py", ".main.py.swp"])
+        self.assertEqual(changed, ["main.py"])
+        self.assertEqual(deleted, [])
+        self.assertEqual(should_be, {"main.py": hash_file(os.path.join(self._root, "main.py"))})
+
+
+if __name__ == "__main__":
+    unittest.main()
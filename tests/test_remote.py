@@ -0,0 +1,42 @@
+import os
+import re
+import zlib
+import base64
+import tempfile
+import unittest
+
+from rempy import remote
+from rempy.remote import remote_python
+from rempy.remote.common import hash_file as remote_hash_file
+from rempy.sync.hashing import hash_file
+
+
+SCRIPTS = [name[:-3] for name in os.listdir(os.path.dirname(remote.__file__)) if name.endswith(".py") and name not in ["__init__.py", "common.py"]]
+
+
+def inlined_source(script):
+    code = re.search(r"b64decode\('([^']*)'\)", remote_python(script)).group(1)
+    return zlib.decompress(base64.b64decode(code)).decode("utf-8")
+
+
+class TestRemoteScripts(unittest.TestCase):
+    def test_inlined(self):
+        for script in SCRIPTS:
+            with self.subTest(script=script):
+                source = inlined_source(script)
+                # rempy is not installed on the remote, so the scripts must not import from it.
+                self.assertIsNone(re.search(r"^\s*(from|import) rempy", source, re.MULTILINE))
+                compile(source, script, "exec")
+
+    def test_same_hashes(self):
+        with tempfile.TemporaryDirectory() as folder:
+            path = os.path.join(folder, "data.bin")
+            with open(path, "wb") as f:
+                f.write(os.urandom(3 * 1024 * 1024 + 17))
+            for algorithm in ["md5", "sha1", "sha256", "blake2b", "git"]:
+                with self.subTest(algorithm=algorithm):
+                    self.assertEqual(remote_hash_file(path, algorithm), hash_file(path, algorithm))
+
+
+if __name__ == "__main__":
+    unittest.main()
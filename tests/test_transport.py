@@ -0,0 +1,35 @@
+import io
+import os
+import tempfile
+import unittest
+import subprocess
+from contextlib import redirect_stdout
+
+from rempy.sync.transport import _pipe
+
+
+class TestPipe(unittest.TestCase):
+    def setUp(self):
+        self._folder = tempfile.TemporaryDirectory()
+        self._done = os.path.join(self._folder.name, "done")
+        self._proc = subprocess.Popen(["sh", "-c", f"cat > /dev/null && touch {self._done}"], stdin=subprocess.PIPE)
+
+    def tearDown(self):
+        self._folder.cleanup()
+
+    def test_complete(self):
+        self.assertTrue(_pipe(self._proc, [b"a", b"b"]))
+        self.assertTrue(os.path.exists(self._done))
+
+    def test_failed_packing(self):
+        def chunks():
+            yield b"a"
+            raise FileNotFoundError("deleted after the scan")
+        with redirect_stdout(io.StringIO()):
+            self.assertFalse(_pipe(self._proc, chunks()))
+        # The command must not see the end of its input, which it would take as a complete patch.
+        self.assertFalse(os.path.exists(self._done))
+
+
+if __name__ == "__main__":
+    unittest.main()